@@ -0,0 +1,402 @@
+import asyncio
+import random
+import struct
+from operator import attrgetter
+from dnsClient import DNSPacket, DNSClientException, DNSTimeoutException, ID_STRUCT, \
+    DEFAULT_UDP_PAYLOAD_SIZE, get_server_health, parse_servers, select_upstreams, decode_response, get_response_key
+from dnsStats import STATS
+
+BIND_ATTEMPTS = 16      # random source ports tried before leaving the choice to the kernel
+
+
+class DNSClientProtocol(asyncio.DatagramProtocol):
+    "Hands every datagram received on one socket of the pool back to the resolver"
+
+    def __init__(self, resolver, shard):
+        self.resolver = resolver
+        self.shard = shard
+
+    def datagram_received(self, data, addr):
+        self.resolver.response_received(data, addr, self.shard)
+
+    def error_received(self, exc):
+        pass    # ICMP errors are handled as timeouts by the waiting queries
+
+    def connection_lost(self, exc):
+        self.resolver.connection_lost(exc, self.shard)
+
+
+class UDPShard:
+    "One UDP socket of an AsyncResolver's pool, bound to a random source port"
+
+    def __init__(self):
+        self.transport = None
+        self.connected = False  # sends go to the only upstream without an address
+        self.port = None
+        self.in_flight = 0
+        self.uses = 0
+        self.retired = False    # replaced in the pool, closed once its last query is done
+        self.opening = None     # task binding a replacement socket, awaited by the queries that picked it meanwhile
+
+    async def open(self, resolver, remote_addr=None):
+        loop = asyncio.get_running_loop()
+        for attempt in range(BIND_ATTEMPTS + 1):
+            port = random.randint(1024, 65535) if attempt < BIND_ATTEMPTS else 0
+            try:
+                self.transport, _ = await loop.create_datagram_endpoint(lambda: DNSClientProtocol(resolver, self),
+                                                                        local_addr=("0.0.0.0", port),
+                                                                        remote_addr=remote_addr)
+                break
+            except OSError:
+                if attempt == BIND_ATTEMPTS:
+                    raise
+        self.connected = remote_addr is not None
+        self.port = self.transport.get_extra_info("sockname")[1]
+        return self
+
+    def close(self):
+        if self.opening is not None and not self.opening.done():
+            self.opening.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def sendto(self, data, addr):
+        if self.connected:
+            self.transport.sendto(data)
+        else:
+            self.transport.sendto(data, addr)
+
+
+class AsyncTCPConnection:
+    """Persistent TCP connection that pipelines queries and matches answers arriving in any order (RFC 7766), over TLS
+    when given an SSL context (RFC 7858)"""
+
+    def __init__(self, server, port=53, ssl=None, server_hostname=None):
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.server_hostname = server_hostname
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.pending = {}   # (ID, QNAME, QTYPE, QCLASS) -> future of the raw response
+        self.queries = 0
+
+    @property
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing() and not self.reader_task.done()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.server, self.port, ssl=self.ssl,
+                                                                 server_hostname=self.server_hostname)
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+        return self
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+    async def query(self, data, key, timeout):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        self.queries += 1
+        try:
+            self.writer.write(ID_STRUCT.pack(len(data)) + data)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(key, None)
+
+    async def read_responses(self):
+        error = DNSClientException("TCP connection closed by the DNS server")
+        try:
+            while True:
+                length = ID_STRUCT.unpack(await self.reader.readexactly(2))[0]
+                data = await self.reader.readexactly(length)
+                try:
+                    future = self.pending.get(get_response_key(data))
+                except (IndexError, struct.error, DNSClientException):
+                    continue
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = DNSClientException("TCP connection to the DNS server failed: {}".format(e))
+        finally:
+            self.writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+
+class AsyncResolver:
+    """Keeps many queries in flight on a pool of UDP sockets, matching replies to queries by socket, ID and question.
+    Each query goes out on the least loaded socket, and a socket is replaced by one on a new random source port after
+    max_socket_uses queries. With several upstream servers each query goes to the best one, optionally hedged to the
+    next best"""
+
+    def __init__(self, server, port=53, timeout=5, retries=3, cache=None, udp_payload_size=DEFAULT_UDP_PAYLOAD_SIZE,
+                 deadline=None, hedge=None, stats=None, sockets=1, max_socket_uses=None, capture=None):
+        self.servers = parse_servers(server)
+        self.server = self.servers[0]
+        self.port = port
+        self.timeout = timeout  # upper bound of each retransmission timeout, which adapts to the measured RTT
+        self.retries = retries
+        self.deadline = deadline if deadline is not None else timeout * (retries + 1)
+        self.hedge = hedge      # latency percentile after which a duplicate query goes to the next best server
+        self.health = {server: get_server_health(server, port) for server in self.servers}
+        self.cache = cache
+        self.stats = STATS if stats is None else stats
+        self.capture = capture  # CaptureWriter logging every raw query and response
+        self.udp_payload_size = udp_payload_size
+        self.sockets = max(1, sockets)
+        self.max_socket_uses = max_socket_uses
+        self.shards = []
+        self.pending = {}   # (UDPShard, ID, QNAME, QTYPE, QCLASS) -> future of the raw response and the server sending it
+        self.tcp_connections = {}   # server -> AsyncTCPConnection
+        self.tcp_lock = asyncio.Lock()
+
+        self.queries = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.truncated = 0
+        self.hedged = 0
+        self.rotations = 0
+
+    @property
+    def rtt_estimator(self):
+        "RTT estimator of the currently best upstream"
+        return self.health[select_upstreams(self.servers, self.port)[0]].rtt_estimator
+
+    async def open(self):
+        while len(self.shards) < self.sockets:
+            self.shards.append(await self.open_shard())
+        return self
+
+    async def open_shard(self, shard=None):
+        # with a single upstream the socket is connected, so the kernel drops datagrams from any other address
+        remote_addr = (self.server, self.port) if len(self.servers) == 1 else None
+        return await (UDPShard() if shard is None else shard).open(self, remote_addr)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+        for connection in self.tcp_connections.values():
+            connection.close()
+        self.tcp_connections = {}
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def allocate_id(self, shard, QNAME, QTYPE, QCLASS):
+        while True:
+            ID = random.getrandbits(16)
+            if (shard, ID, QNAME, QTYPE, QCLASS) not in self.pending:
+                return ID
+
+    async def get_shard(self):
+        """Picks the least loaded socket of the pool, replacing it once it has been used max_socket_uses times. The
+        socket is reserved before anything is awaited, so it cannot be closed under the query"""
+        shard = min(self.shards, key=attrgetter("in_flight"))
+        shard.in_flight += 1
+        shard.uses += 1
+        if self.max_socket_uses and shard.uses >= self.max_socket_uses:
+            self.replace_shard(shard)
+        if shard.opening is not None:
+            try:
+                await asyncio.shield(shard.opening)
+            except BaseException:
+                self.release_shard(shard)
+                if shard.opening.cancelled():
+                    raise DNSClientException("Resolver socket closed")
+                raise
+        return shard
+
+    def replace_shard(self, shard):
+        "Retires a socket, putting a new one in its place at once so no later query picks it, even during a burst"
+        shard.retired = True
+        replacement = UDPShard()
+        replacement.opening = asyncio.ensure_future(self.open_shard(replacement))
+        self.shards[self.shards.index(shard)] = replacement
+        self.rotations += 1
+
+    def release_shard(self, shard):
+        shard.in_flight -= 1
+        if shard.retired and shard.in_flight == 0:
+            shard.close()
+
+    async def query(self, name, qtype="A"):
+        if not self.shards:
+            await self.open()
+
+        timer = self.stats.start(qtype)
+        packet = DNSPacket.get_request_dns_packet(name, qtype, self.udp_payload_size)
+        question = packet.question
+        if self.cache is not None:
+            cached = self.cache.get(question.QNAME, question.QTYPE, question.QCLASS)
+            if cached is not None:
+                return cached
+
+        key_name = question.QNAME.rstrip(".").lower()
+        shard = await self.get_shard()
+        ID = self.allocate_id(shard, key_name, question.QTYPE, question.QCLASS)
+        packet.header.ID = ID
+        key = None
+        try:
+            data = packet.to_bytes()
+
+            question_key = (ID, key_name, question.QTYPE, question.QCLASS)
+            key = (shard,) + question_key
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.pending[key] = future
+            self.queries += 1
+            deadline = loop.time() + self.deadline
+            transmissions = {}  # server -> number of times the query was sent to it
+            ranked = select_upstreams(self.servers, self.port)
+            server = ranked[0]
+            if timer is not None:
+                timer.mark("encode")
+            # the ID is kept across retransmissions so a late reply to an earlier attempt still completes the query
+            for attempt in range(self.retries + 1):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                if attempt > 0:
+                    self.retransmissions += 1
+                # retries move on to the next best upstream, and a hedged duplicate goes to the one after it
+                server = ranked[attempt % len(ranked)]
+                health = self.health[server]
+                sent = {}
+                self.send(shard, data, server, sent, transmissions)
+                if timer is not None:
+                    timer.mark("send")
+                timeout = health.rtt_estimator.get_timeout(attempt, min(self.timeout, remaining))
+                hedge_delay = None
+                if self.hedge is not None and len(ranked) > 1:
+                    hedge_delay = health.get_latency_percentile(self.hedge)
+                try:
+                    if hedge_delay is not None and hedge_delay < timeout:
+                        try:
+                            reply, server = await asyncio.wait_for(asyncio.shield(future), hedge_delay)
+                        except asyncio.TimeoutError:
+                            self.hedged += 1
+                            self.send(shard, data, ranked[(attempt + 1) % len(ranked)], sent, transmissions)
+                            reply, server = await asyncio.wait_for(asyncio.shield(future), timeout - hedge_delay)
+                    else:
+                        reply, server = await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    if timer is not None:
+                        timer.mark("retry")
+                    for sent_to in sent:
+                        self.stats.count_timeout(sent_to, qtype)
+                        self.health[sent_to].rtt_estimator.timed_out()
+                        self.health[sent_to].record_failure()
+                    continue
+
+                health = self.health[server]
+                # a late reply from the server of an earlier attempt completes the query but is not timed
+                rtt = loop.time() - sent[server] if server in sent else None
+                if rtt is not None and transmissions[server] == 1:
+                    health.rtt_estimator.observe(rtt)
+                if timer is not None:
+                    timer.mark("wait")
+                if self.capture is not None:
+                    self.capture.write(data, reply, server, self.port)
+                response = self.decode(reply)
+                if timer is not None:
+                    timer.mark("decode")
+                self.stats.count_rcode(server, qtype, response.header.FLAGS.RCODE)
+                if response.header.FLAGS.RCODE in (2, 5):   # SERVFAIL or REFUSED
+                    health.record_failure()
+                    if len(self.servers) > 1 and attempt < self.retries:
+                        future = self.pending[key] = loop.create_future()
+                        continue
+                else:
+                    health.record_success(rtt)
+                if response.header.FLAGS.TC:
+                    self.truncated += 1
+                    self.stats.count_truncated(server, qtype)
+                    response = await self.query_tcp(data, question_key, server)
+                    if timer is not None:
+                        timer.mark("wait")
+                if timer is not None:
+                    timer.finish(server)
+                if self.cache is not None:
+                    self.cache.put(response)
+                return response
+            self.timeouts += 1
+            if timer is not None:
+                timer.finish(server)
+            raise DNSTimeoutException("Maximum number of retries exceeded: {}".format(self.retries))
+        finally:
+            if key is not None:
+                del self.pending[key]
+                if not future.done():
+                    future.cancel()
+            self.release_shard(shard)
+
+    def send(self, shard, data, server, sent, transmissions):
+        sent[server] = asyncio.get_running_loop().time()
+        transmissions[server] = transmissions.get(server, 0) + 1
+        if shard.transport is None:
+            raise DNSClientException("Resolver socket closed")
+        shard.sendto(data, (server, self.port))
+
+    async def get_tcp_connection(self, server=None):
+        server = self.server if server is None else server
+        async with self.tcp_lock:   # truncated answers arriving together share one new connection per server
+            connection = self.tcp_connections.get(server)
+            if connection is None or not connection.is_open:
+                connection = self.tcp_connections[server] = AsyncTCPConnection(server, self.port)
+                await connection.open()
+            return connection
+
+    async def query_tcp(self, data, key, server=None):
+        "Repeats a truncated query on the persistent TCP connection, reconnecting once if the server closed it"
+        for attempt in range(2):
+            try:
+                connection = await self.get_tcp_connection(server)
+                response = await connection.query(data, key, self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise DNSTimeoutException("No TCP response after {} seconds".format(self.timeout))
+            except (OSError, DNSClientException) as e:
+                if attempt == 1:
+                    raise DNSClientException("TCP fallback failed: {}".format(e))
+                continue
+            if self.capture is not None:
+                self.capture.write(data, response, connection.server, self.port)
+            return self.decode(response)
+
+    def decode(self, data):
+        return decode_response(data, self.stats)
+
+    def response_received(self, data, addr, shard):
+        server = self.server if addr is None else addr[0]
+        if server not in self.health:
+            self.unmatched += 1
+            return
+        try:
+            key = (shard,) + get_response_key(data)
+        except (IndexError, struct.error, DNSClientException):
+            self.unmatched += 1
+            return
+
+        future = self.pending.get(key)
+        if future is None or future.done():
+            self.unmatched += 1
+            self.stats.count_id_mismatch(server)
+            return
+        future.set_result((data, server))
+
+    def connection_lost(self, exc, shard):
+        for key, future in self.pending.items():
+            if key[0] is shard and not future.done():
+                future.set_exception(DNSClientException("Resolver socket closed"))
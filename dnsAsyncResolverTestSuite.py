@@ -0,0 +1,194 @@
+import unittest
+import asyncio
+import struct
+import dnsClient
+from dnsAsyncResolver import AsyncResolver
+from dnsTestServer import DNSTestServer
+
+
+class TestResponder(asyncio.DatagramProtocol):
+
+    def __init__(self, drop=0, delay=lambda name: 0, wrong_id_first=False):
+        self.drop = drop
+        self.delay = delay
+        self.wrong_id_first = wrong_id_first
+        self.received = []
+        self.source_ports = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        request = dnsClient.DNSPacket.unpack(data)
+        self.received.append(request.header.ID)
+        self.source_ports.append(addr[1])
+        if self.drop > 0:
+            self.drop -= 1
+            return
+        name = request.question.QNAME
+        response = bytearray(data[:dnsClient.DNSPacket.Question.unpack_from(data, 12)[1]])
+        struct.pack_into("!HHHHHH", response, 0, request.header.ID, 0x8180, 1, 1, 0, 0)
+        response += struct.pack("!HHHIH", 0xC00C, 1, 1, 60, 4) + bytes([10, 0, 0, len(name)])
+        if self.wrong_id_first:
+            self.wrong_id_first = False
+            self.transport.sendto(b"\x00\x00" + bytes(response[2:]), addr)
+        asyncio.get_running_loop().call_later(self.delay(name), self.transport.sendto, bytes(response), addr)
+
+
+class TestAsyncResolver(unittest.TestCase):
+
+    def run_with_responder(self, responder, coroutine_function, **resolver_options):
+        async def run():
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(lambda: responder, local_addr=("127.0.0.1", 0))
+            port = transport.get_extra_info("sockname")[1]
+            try:
+                async with AsyncResolver("127.0.0.1", port, **resolver_options) as resolver:
+                    return await coroutine_function(resolver)
+            finally:
+                transport.close()
+        return asyncio.run(run())
+
+    def test_header_ids_are_random_per_packet(self):
+        flags = dnsClient.DNSPacket.Header.Flags.get_request_flags(0b0)
+        ids = {dnsClient.DNSPacket.Header.get_request_header(flags).ID for _ in range(32)}
+        self.assertGreater(len(ids), 1)
+
+    def test_many_in_flight_queries_answered_out_of_order(self):
+        names = ["{}.example.com".format("a" * i) for i in range(1, 40)]
+        responder = TestResponder(delay=lambda name: 0.05 / len(name))
+
+        async def resolve_all(resolver):
+            return await asyncio.gather(*(resolver.query(name) for name in names)), resolver
+
+        responses, resolver = self.run_with_responder(responder, resolve_all, timeout=2, retries=0)
+        for name, response in zip(names, responses):
+            self.assertEqual(response.question.QNAME, name)
+            self.assertEqual(response.answer[0].RDATA.DATA, "10.0.0.{}".format(len(name)))
+        self.assertEqual(resolver.pending, {})
+        self.assertEqual(resolver.queries, len(names))
+
+    def test_retransmits_after_timeout_with_same_id(self):
+        responder = TestResponder(drop=2)
+
+        async def resolve(resolver):
+            return await resolver.query("mcgill.ca", "A"), resolver
+
+        response, resolver = self.run_with_responder(responder, resolve, timeout=0.1, retries=3)
+        self.assertEqual(response.answer[0].RDATA.DATA, "10.0.0.9")
+        self.assertEqual(resolver.retransmissions, 2)
+        self.assertEqual(len(set(responder.received)), 1)
+
+    def test_ignores_reply_with_wrong_id(self):
+        responder = TestResponder(wrong_id_first=True)
+
+        async def resolve(resolver):
+            return await resolver.query("mcgill.ca", "A"), resolver
+
+        response, resolver = self.run_with_responder(responder, resolve, timeout=1, retries=0)
+        self.assertEqual(response.header.ID, responder.received[0])
+        self.assertEqual(resolver.unmatched, 1)
+
+    def test_timeout_after_retries(self):
+        responder = TestResponder(drop=10)
+
+        async def resolve(resolver):
+            try:
+                await resolver.query("mcgill.ca", "A")
+            finally:
+                self.assertEqual(resolver.timeouts, 1)
+
+        with self.assertRaises(dnsClient.DNSTimeoutException):
+            self.run_with_responder(responder, resolve, timeout=0.05, retries=2)
+        self.assertEqual(len(responder.received), 3)
+
+    def test_queries_spread_over_a_pool_of_sockets(self):
+        names = ["host{}.example.com".format(i) for i in range(200)]
+        responder = TestResponder(delay=lambda name: 0.01)
+
+        async def resolve_all(resolver):
+            return await asyncio.gather(*(resolver.query(name) for name in names)), resolver, list(resolver.shards)
+
+        responses, resolver, shards = self.run_with_responder(responder, resolve_all, timeout=2, retries=0, sockets=4)
+        self.assertEqual([response.question.QNAME for response in responses], names)
+        self.assertEqual(len(set(responder.source_ports)), 4)
+        self.assertEqual(max(responder.source_ports.count(port) for port in set(responder.source_ports)), 50)
+        self.assertEqual((resolver.pending, [shard.in_flight for shard in shards]), ({}, [0, 0, 0, 0]))
+
+    def test_unencodable_name_releases_its_socket(self):
+        async def resolve(resolver):
+            with self.assertRaises(dnsClient.DNSClientException):
+                await resolver.query("bücher.example", "A")
+            return resolver, [shard.in_flight for shard in resolver.shards]
+
+        resolver, in_flight = self.run_with_responder(TestResponder(), resolve, timeout=1, retries=0)
+        self.assertEqual((resolver.pending, in_flight), ({}, [0]))
+
+    def test_sockets_rotate_to_new_source_ports(self):
+        responder = TestResponder()
+
+        async def resolve(resolver):
+            for i in range(20):
+                await resolver.query("host{}.example.com".format(i))
+            return resolver, [shard.transport is not None for shard in resolver.shards]
+
+        resolver, shards_open = self.run_with_responder(responder, resolve, timeout=1, retries=0, max_socket_uses=5)
+        self.assertEqual(resolver.rotations, 4)
+        self.assertEqual([len(set(responder.source_ports[i:i + 5])) for i in range(0, 20, 5)], [1, 1, 1, 1])
+        self.assertEqual(len(set(responder.source_ports)), 4)
+        self.assertEqual(shards_open, [True])
+
+    def test_sockets_rotate_under_concurrent_queries(self):
+        names = ["host{}.example.com".format(i) for i in range(150)]
+        responder = TestResponder(delay=lambda name: 0.01)
+
+        async def resolve_all(resolver):
+            responses = await asyncio.gather(*(resolver.query(name) for name in names), return_exceptions=True)
+            return responses, resolver, [shard.transport is not None for shard in resolver.shards]
+
+        responses, resolver, shards_open = self.run_with_responder(responder, resolve_all, timeout=2, retries=0,
+                                                                   max_socket_uses=3)
+        self.assertEqual([response.question.QNAME for response in responses], names)
+        self.assertEqual(resolver.rotations, 50)
+        self.assertEqual(max(responder.source_ports.count(port) for port in set(responder.source_ports)), 3)
+        self.assertEqual((resolver.pending, shards_open), ({}, [True]))
+
+    def test_upstreams_fail_over_and_hedge(self):
+        dnsClient.SERVER_HEALTH.clear()
+        dnsClient.RTT_ESTIMATORS.clear()
+        with DNSTestServer(rcode=5) as primary, DNSTestServer(host="127.0.0.2", port=primary.port) as secondary:
+            async def resolve():
+                async with AsyncResolver("127.0.0.1,127.0.0.2", primary.port, timeout=2, hedge=0.5) as resolver:
+                    refused = await resolver.query("example.com", "A")
+                    for _ in range(5):
+                        await resolver.query("example.com", "A")
+                    secondary.latency = 0.5
+                    primary.rcode = None
+                    hedged = await resolver.query("example.com", "A")
+                    return (refused, hedged, resolver)
+
+            refused, hedged, resolver = asyncio.run(resolve())
+        self.assertEqual(refused.header.FLAGS.RCODE, 0)
+        self.assertEqual(hedged.answer[0].RDATA.DATA, "93.184.216.34")
+        self.assertEqual(resolver.hedged, 1)
+        self.assertEqual(primary.udp_queries, 2)
+        self.assertEqual(resolver.health["127.0.0.1"].failures, 1)
+
+    def test_late_reply_after_failover_completes_the_query(self):
+        dnsClient.SERVER_HEALTH.clear()
+        dnsClient.RTT_ESTIMATORS.clear()
+        with DNSTestServer(latency=0.15) as primary, \
+                DNSTestServer(host="127.0.0.2", port=primary.port, latency=5) as secondary:
+            async def resolve():
+                async with AsyncResolver("127.0.0.1,127.0.0.2", primary.port, timeout=0.1, retries=3) as resolver:
+                    return await resolver.query("example.com", "A"), resolver
+
+            # the primary answers while the retry to the secondary is outstanding
+            response, resolver = asyncio.run(resolve())
+        self.assertEqual(response.answer[0].RDATA.DATA, "93.184.216.34")
+        self.assertEqual((primary.udp_queries, secondary.udp_queries, resolver.retransmissions), (1, 1, 1))
+        self.assertEqual(resolver.health["127.0.0.1"].successes, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
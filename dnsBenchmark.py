@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import dnsClient
+import dnsColumnar
+from dnsClient import DNSPacket, SOAData
+from dnsAsyncResolver import AsyncResolver
+from dnsTestServer import DNSTestServer
+
+SAMPLE_ID = 0x827a
+
+
+def build_response(name, qtype, answers=(), authority=(), additional=(), ID=SAMPLE_ID):
+    "Encodes a response with name compression, returning it with its question and a matching request header"
+    flags = DNSPacket.Header.Flags(1, 0, 0, 0, 1, 1, 0, 0)
+    header = DNSPacket.Header(flags, 1, len(answers), len(authority), len(additional), ID)
+    question = DNSPacket.Question(name, qtype, 0x0001)
+    data = DNSPacket(header, question, list(answers), list(authority), list(additional)).to_bytes()
+    request_header = DNSPacket.Header(DNSPacket.Header.Flags.get_request_flags(0b0), 1, 0, 0, 0, ID)
+    return (data, question, request_header)
+
+
+def record(name, TYPE, data, ttl=300, preference=None):
+    if TYPE == 0x000f:
+        return DNSPacket.Answer(name, TYPE, 0x0001, ttl, 0, DNSPacket.RDATA(None, preference, data))
+    return DNSPacket.Answer(name, TYPE, 0x0001, ttl, 0, DNSPacket.RDATA(data, None, None))
+
+
+def build_sample_response():
+    "Builds a www.mcgill.ca response with a CNAME and two compressed A records"
+    data, question, _ = build_response("www.mcgill.ca", 0x0001, [
+        record("www.mcgill.ca", 0x0005, "mcgill.ca"),
+        record("mcgill.ca", 0x0001, "132.216.177.160", 3600),
+        record("mcgill.ca", 0x0001, "132.216.177.161", 3600)])
+    return (data, question)
+
+
+def build_corpus():
+    "Recorded-style responses covering the shapes the decoders have to handle"
+    servers = ["{}.gtld-servers.net".format(letter) for letter in "abcdefghijklm"]
+    chain = ["www.example.com", "cdn.example.net", "edge.cdn.example.net", "pop1.edge.cdn.example.net"]
+    return {
+        "a": build_response("mcgill.ca", 0x0001, [record("mcgill.ca", 0x0001, "132.216.177.160")]),
+        "ns": build_response("mcgill.ca", 0x0002, [record("mcgill.ca", 0x0002, "ns{}.mcgill.ca".format(i))
+                                                   for i in range(1, 5)]),
+        "mx": build_response("example.com", 0x000f, [record("example.com", 0x000f, "mx{}.mail.example.com".format(i),
+                                                            preference=10 * i) for i in range(1, 6)]),
+        "cname_chain": build_response(chain[0], 0x0001,
+                                      [record(chain[i], 0x0005, chain[i + 1]) for i in range(len(chain) - 1)] +
+                                      [record(chain[-1], 0x0001, "10.0.0.{}".format(i)) for i in range(1, 3)]),
+        "heavy_compression": build_response("hosts.a.b.c.example.com", 0x0001,
+                                            [record("hosts.a.b.c.example.com", 0x0001, "10.1.0.{}".format(i))
+                                             for i in range(1, 41)]),
+        "large_additional": build_response("com", 0x0002, [record("com", 0x0002, server) for server in servers],
+                                           [record("com", 0x0006, SOAData(servers[0], "nstld.verisign-grs.com",
+                                                                          1, 1800, 900, 604800, 86400))],
+                                           [record(server, 0x0001, "192.{}.{}.30".format(i, i))
+                                            for i, server in enumerate(servers)]),
+    }
+
+
+def best_rate(function, iterations, repeat):
+    "Runs function(iterations) `repeat` times and returns the best rate in operations per second"
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(iterations)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return iterations / best if best > 0 else float("inf")
+
+
+def bench_encode(iterations, repeat):
+    def dns_packet(n):
+        for _ in range(n):
+            flags = DNSPacket.Header.Flags.get_request_flags(0b0)
+            header = DNSPacket.Header.get_request_header(flags)
+            question = DNSPacket.Question.get_request_question("www.mcgill.ca", "A")
+            DNSPacket(header, question, answer=None).to_bytes()
+
+    def hex_string(n):
+        for _ in range(n):
+            flags = DNSPacket.Header.Flags.get_request_flags(0b0)
+            header = DNSPacket.Header.get_request_header(flags)
+            question = DNSPacket.Question.get_request_question("www.mcgill.ca", "A")
+            bytes.fromhex(DNSPacket(header, question, answer=None).__str__())
+
+    return {"encode.to_bytes": best_rate(dns_packet, iterations, repeat),
+            "encode.hex_string": best_rate(hex_string, iterations, repeat)}
+
+
+def bench_decode(iterations, repeat):
+    results = {}
+    for name, (data, question, request_header) in build_corpus().items():
+        def legacy(n):
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(n):
+                    dnsClient.get_response_information(data, question, request_header)
+
+        def unpack(n):
+            for _ in range(n):
+                DNSPacket.unpack(data)
+
+        results["decode.get_response_information.{}".format(name)] = best_rate(legacy, iterations, repeat)
+        results["decode.unpack.{}".format(name)] = best_rate(unpack, iterations, repeat)
+        if dnsColumnar.np is not None:
+            results["decode.batch.{}".format(name)] = best_rate(lambda n: dnsColumnar.decode_batch([data] * n),
+                                                                iterations, repeat)
+    return results
+
+
+async def resolve_many(port, names, concurrency):
+    async with AsyncResolver("127.0.0.1", port, timeout=2, retries=2) as resolver:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(name):
+            async with semaphore:
+                await resolver.query(name)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(resolve(name) for name in names))
+        return time.perf_counter() - start
+
+
+def bench_end_to_end(queries, concurrency):
+    with DNSTestServer() as server:
+        names = ["example.com" if i % 2 else "www.example.com" for i in range(queries)]
+        async_elapsed = asyncio.run(resolve_many(server.port, names, concurrency))
+
+        sync_queries = max(1, queries // 10)
+        args = argparse.Namespace(server="127.0.0.1", name="www.example.com", p=server.port, t=2, r=2, mx=False,
+                                  ns=False, no_cache=True)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(sync_queries):
+                dnsClient.main(args)
+        sync_elapsed = time.perf_counter() - start
+    return {"e2e.async_resolver_qps": queries / async_elapsed, "e2e.main_qps": sync_queries / sync_elapsed}
+
+
+def run(args):
+    results = {}
+    if "encode" in args.only:
+        results.update(bench_encode(args.n, args.repeat))
+    if "decode" in args.only:
+        results.update(bench_decode(args.n, args.repeat))
+    if "e2e" in args.only:
+        results.update(bench_end_to_end(args.queries, args.concurrency))
+    return {"python": platform.python_version(), "timestamp": time.time(), "unit": "ops/s",
+            "results": {name: round(rate, 1) for name, rate in sorted(results.items())}}
+
+
+def compare(baseline, current, threshold):
+    "Returns (name, baseline, current, change) for every shared benchmark, and the names that regressed"
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline["results"]) & set(current["results"])):
+        before, after = baseline["results"][name], current["results"][name]
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+        if change < -threshold:
+            regressions.append(name)
+    return (rows, regressions)
+
+
+def main(args):
+    if args.command == "compare":
+        with open(args.baseline) as baseline_file, open(args.current) as current_file:
+            rows, regressions = compare(json.load(baseline_file), json.load(current_file), args.threshold)
+        for name, before, after, change in rows:
+            flag = "REGRESSION" if name in regressions else ""
+            print(f"{name:<52} {before:>12.1f} {after:>12.1f} {change:>+8.1%} {flag}")
+        return 0 if regressions else 1
+
+    report = run(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DNS Client benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and print JSON results')
+    run_parser.add_argument('-n', type=int, help='Iterations per encode and decode benchmark', default=5000)
+    run_parser.add_argument('--repeat', type=int, help='Runs per benchmark, the best one is reported', default=3)
+    run_parser.add_argument('--queries', type=int, help='Queries sent in the end-to-end benchmark', default=2000)
+    run_parser.add_argument('--concurrency', type=int, help='Queries in flight in the end-to-end benchmark',
+                            default=100)
+    run_parser.add_argument('--only', nargs='+', choices=['encode', 'decode', 'e2e'], default=['encode', 'decode', 'e2e'],
+                            help='Benchmark groups to run')
+    run_parser.add_argument('-o', '--output', help='Also write the JSON results to this file')
+    compare_parser = subparsers.add_parser('compare', help='Compare two JSON results and flag regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, help='Allowed slowdown before flagging, as a fraction',
+                                default=0.10)
+
+    args = parser.parse_args(sys.argv[1:] or ['run'])
+    sys.exit(0 if main(args) else 1)
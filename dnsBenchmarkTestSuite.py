@@ -0,0 +1,42 @@
+import unittest
+import contextlib
+import io
+import dnsClient
+import dnsBenchmark
+
+
+class TestBenchmarkCorpus(unittest.TestCase):
+
+    def test_corpus_decodes_through_both_paths(self):
+        for name, (data, question, request_header) in dnsBenchmark.build_corpus().items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                answers, _, _ = dnsClient.get_response_information(data, question, request_header)
+            packet = dnsClient.DNSPacket.unpack(data)
+            self.assertEqual(len(answers), len(packet.answer), name)
+            self.assertEqual([answer.TTL for answer in answers], [answer.TTL for answer in packet.answer], name)
+
+    def test_corpus_uses_compression(self):
+        data, _, _ = dnsBenchmark.build_corpus()["heavy_compression"]
+        packet = dnsClient.DNSPacket.unpack(data)
+        self.assertEqual(len(packet.answer), 40)
+        self.assertLess(len(data), 40 * 16 + 50)
+        self.assertEqual({answer.NAME for answer in packet.answer}, {"hosts.a.b.c.example.com"})
+
+
+class TestBenchmarkCompare(unittest.TestCase):
+
+    def test_compare_flags_regressions_beyond_threshold(self):
+        baseline = {"results": {"decode": 100.0, "encode": 100.0, "only_in_baseline": 1.0}}
+        current = {"results": {"decode": 85.0, "encode": 95.0}}
+        rows, regressions = dnsBenchmark.compare(baseline, current, 0.10)
+        self.assertEqual([row[0] for row in rows], ["decode", "encode"])
+        self.assertEqual(regressions, ["decode"])
+
+    def test_run_reports_json_results(self):
+        args = type("Args", (), {"only": ["encode"], "n": 10, "repeat": 1})()
+        report = dnsBenchmark.run(args)
+        self.assertEqual(set(report["results"]), {"encode.to_bytes", "encode.hex_string"})
+
+
+if __name__ == '__main__':
+    unittest.main()
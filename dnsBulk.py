@@ -0,0 +1,464 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+from dnsClient import DNSPacket, DNSClientException, DNSTimeoutException, ResponseCache, validate_server, \
+    DEFAULT_UDP_PAYLOAD_SIZE
+from dnsAsyncResolver import AsyncResolver
+from dnsEncrypted import EncryptedResolver, DOH_PATH
+from dnsCapture import CaptureWriter
+
+READ_BATCH_SIZE = 256
+QUERIES_PER_SOCKET = 256    # in-flight queries per UDP socket when --sockets is not given
+
+
+class BulkSummary:
+
+    def __init__(self):
+        self.names = 0
+        self.answered = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.elapsed = 0.0
+        self.rtt = {}
+        self.hedged = 0
+        self.upstreams = {}     # server -> ServerHealth.to_dict(), when several servers are used
+        self.workers = []       # BulkWorker.to_dict() of each worker process
+
+    def qps(self):
+        return self.names / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (f"Resolved {self.names} names in {self.elapsed:.3f} seconds ({self.qps():.1f} QPS): "
+                f"{self.answered} answered, {self.errors} errors, {self.timeouts} timeouts, {self.retries} retries, "
+                f"srtt {self.format_ms(self.rtt.get('srtt'))}, rto {self.format_ms(self.rtt.get('rto'))}" +
+                "".join(f"\n  {server}: {health['successes']} answered, {health['failures']} failures, "
+                        f"p50 {self.format_ms(health['p50'])}, p90 {self.format_ms(health['p90'])}" +
+                        ("" if health["available"] else ", circuit open")
+                        for server, health in self.upstreams.items()) +
+                (f"\n  {self.hedged} hedged queries" if self.upstreams else "") +
+                "".join(f"\n  worker {worker['worker']}: {worker['names']} names, {worker['answered']} answered, "
+                        f"{worker['errors']} errors, {worker['timeouts']} timeouts, {worker['retries']} retries" +
+                        (", crashed" if worker["crashed"] else "")
+                        for worker in self.workers))
+
+    @staticmethod
+    def format_ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.1f} ms"
+
+
+def parse_line(line):
+    "Returns (name, qtype) for a 'name [type]' input line, or None for blank lines and comments"
+    fields = line.split()
+    if not fields or fields[0].startswith("#"):
+        return None
+    qtype = fields[1].upper() if len(fields) > 1 else "A"
+    return (fields[0], qtype)
+
+
+def read_batch(input_file):
+    return list(itertools.islice(input_file, READ_BATCH_SIZE))
+
+
+def response_to_dict(name, qtype, response, elapsed):
+    return {"name": name, "type": qtype, "rcode": response.header.FLAGS.RCODE, "aa": response.header.FLAGS.AA,
+            "answers": [answer.to_dict() for answer in response.answer], "time": round(elapsed, 6)}
+
+
+class RateLimiter:
+    "Token bucket letting through at most `rate` queries per second, in bursts of up to a tenth of a second's worth"
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate / 10)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    async def acquire(self):
+        while True:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def resolve_one(resolver, name, qtype, summary):
+    "Resolves one name into the dict written as its JSON line, counting the outcome in the summary"
+    start = time.perf_counter()
+    try:
+        if DNSPacket.Question.get_q_num(qtype) is None:
+            raise DNSClientException("Unsupported query type: {}".format(qtype))
+        response = await resolver.query(name, qtype)
+        result = response_to_dict(name, qtype, response, time.perf_counter() - start)
+        summary.answered += 1
+    except DNSTimeoutException:
+        result = {"name": name, "type": qtype, "error": "timeout"}
+        summary.timeouts += 1
+    except DNSClientException as e:
+        result = {"name": name, "type": qtype, "error": str(e) or e.__class__.__name__}
+        summary.errors += 1
+    except Exception as e:
+        # anything else is still one line for the name, so the output always matches the input
+        result = {"name": name, "type": qtype, "error": "{}: {}".format(e.__class__.__name__, e)}
+        summary.errors += 1
+    return result
+
+
+async def resolve_and_write(resolver, name, qtype, output_file, summary):
+    output_file.write(json.dumps(await resolve_one(resolver, name, qtype, summary)) + "\n")
+
+
+async def resolve_stream(resolver, input_file, output_file, concurrency, limiter=None):
+    "Resolves names as they are read, never holding more than `concurrency` queries in flight"
+    loop = asyncio.get_running_loop()
+    summary = BulkSummary()
+    in_flight = set()
+    start = time.perf_counter()
+
+    while True:
+        lines = await loop.run_in_executor(None, read_batch, input_file)
+        if not lines:
+            break
+        for line in lines:
+            parsed = parse_line(line)
+            if parsed is None:
+                continue
+            while len(in_flight) >= concurrency:
+                _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            if limiter is not None:
+                await limiter.acquire()
+            summary.names += 1
+            in_flight.add(asyncio.ensure_future(resolve_and_write(resolver, *parsed, output_file, summary)))
+        output_file.flush()
+
+    if in_flight:
+        await asyncio.wait(in_flight)
+    output_file.flush()
+
+    summary.elapsed = time.perf_counter() - start
+    summary.retries = resolver.retransmissions
+    summary.rtt = resolver.rtt_estimator.to_dict()
+    summary.hedged = resolver.hedged
+    if len(resolver.servers) > 1:
+        summary.upstreams = {server: health.to_dict() for server, health in resolver.health.items()}
+    return summary
+
+
+def get_resolver_options(args, concurrency):
+    """AsyncResolver, or EncryptedResolver with a transport, keyword arguments for the bulk options, picklable so
+    worker processes can build their own"""
+    transport = getattr(args, "transport", "udp")
+    if transport != "udp":
+        return {"server": args.server, "port": args.p, "transport": transport, "timeout": args.t, "retries": args.r,
+                "udp_payload_size": getattr(args, "edns", DEFAULT_UDP_PAYLOAD_SIZE),
+                "connections": getattr(args, "connections", None) or -(-concurrency // QUERIES_PER_SOCKET),
+                "cafile": getattr(args, "tls_ca", None), "server_hostname": getattr(args, "tls_name", None),
+                "path": getattr(args, "doh_path", None) or DOH_PATH}
+    return {"server": args.server, "port": args.p, "timeout": args.t, "retries": args.r,
+            "udp_payload_size": getattr(args, "edns", DEFAULT_UDP_PAYLOAD_SIZE),
+            "deadline": getattr(args, "deadline", None), "hedge": getattr(args, "hedge", None),
+            "sockets": getattr(args, "sockets", None) or -(-concurrency // QUERIES_PER_SOCKET),
+            "max_socket_uses": getattr(args, "socket_uses", None)}
+
+
+def get_resolver(options, cache, capture=None):
+    resolver_class = EncryptedResolver if "transport" in options else AsyncResolver
+    return resolver_class(cache=cache, capture=capture, **options)
+
+
+def open_capture(path):
+    return CaptureWriter(path) if path else contextlib.nullcontext()
+
+
+async def run(args, input_file, output_file):
+    cache = None if getattr(args, "no_cache", False) else ResponseCache()
+    concurrency = max(1, args.concurrency)
+    rate = getattr(args, "rate", None)
+    with open_capture(getattr(args, "capture", None)) as capture:
+        async with get_resolver(get_resolver_options(args, concurrency), cache, capture) as resolver:
+            return await resolve_stream(resolver, input_file, output_file, concurrency,
+                                        RateLimiter(rate) if rate else None)
+
+
+class BulkWorker:
+    "A worker process of a WorkerPool with the names handed to it that it has not answered yet"
+
+    def __init__(self, index, context, options, result_queue):
+        self.index = index
+        self.tasks = context.Queue()
+        self.process = context.Process(target=worker_main, args=(index, options, self.tasks, result_queue),
+                                       daemon=True)
+        self.outstanding = {}   # input sequence number -> (name, qtype)
+        self.alive = True
+        self.finished = False   # sent its final stats
+        self.crashed = False
+
+        self.names = 0
+        self.answered = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.stats = {}
+
+    def to_dict(self):
+        return {"worker": self.index, "names": self.names, "answered": self.answered, "errors": self.errors,
+                "timeouts": self.timeouts, "retries": self.stats.get("retries", 0), "crashed": self.crashed}
+
+
+class WorkerPool:
+    """Resolves a name list over several processes, each running its own AsyncResolver at its slice of the global
+    rate limit. Names are handed out in batches to the least loaded worker and the result lines are merged into one
+    output stream, in input order through a bounded reorder buffer when ordered. Results are written as they arrive,
+    and the names a crashed worker still held are reported as errors while the other workers carry on"""
+
+    def __init__(self, args, workers, ordered=False, reorder_buffer=10000, progress_interval=5.0,
+                 progress_file=sys.stderr):
+        self.workers_count = max(1, workers)
+        self.concurrency = max(1, args.concurrency)
+        self.options = get_resolver_options(args, self.concurrency)
+        self.options["concurrency"] = self.concurrency
+        self.options["no_cache"] = getattr(args, "no_cache", False)
+        self.options["capture"] = getattr(args, "capture", None)    # each worker appends to its own numbered log
+        rate = getattr(args, "rate", None)
+        self.options["rate"] = rate / self.workers_count if rate else None
+        self.ordered = ordered
+        self.reorder_buffer = max(1, reorder_buffer)
+        self.window = 2 * self.concurrency  # names a worker may hold, enough to keep all its queries busy
+        self.progress_interval = progress_interval
+        self.progress_file = progress_file
+
+        self.workers = []
+        self.next_seq = 0       # sequence number of the next name read
+        self.next_write = 0     # sequence number of the next line written in ordered mode
+        self.reordered = {}     # sequence number -> line waiting for the lines before it
+        self.summary = BulkSummary()
+
+    def run(self, input_file, output_file):
+        start = time.perf_counter()
+        context = multiprocessing.get_context("spawn")
+        result_queue = context.Queue()
+        self.workers = [BulkWorker(i, context, self.options, result_queue) for i in range(self.workers_count)]
+        for worker in self.workers:
+            worker.process.start()
+        items = self.read_items(input_file)
+        exhausted = False
+        last_progress = time.monotonic()
+        try:
+            while True:
+                if not exhausted:
+                    exhausted = self.dispatch(items)
+                if exhausted and not any(worker.outstanding for worker in self.workers):
+                    break
+                if not any(worker.alive for worker in self.workers):
+                    break   # every worker crashed, the rest of the input is left unresolved
+                self.receive(result_queue, output_file)
+                if self.progress_interval and time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    self.report_progress(time.perf_counter() - start)
+            for worker in self.workers:
+                if worker.alive:
+                    worker.tasks.put(None)
+            while any(worker.alive and not worker.finished for worker in self.workers):
+                self.receive(result_queue, output_file)
+        finally:
+            for worker in self.workers:
+                worker.process.join(timeout=1)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            output_file.flush()
+
+        summary = self.summary
+        summary.elapsed = time.perf_counter() - start
+        summary.retries = sum(worker.stats.get("retries", 0) for worker in self.workers)
+        summary.hedged = sum(worker.stats.get("hedged", 0) for worker in self.workers)
+        rtts = [worker.stats["rtt"] for worker in self.workers if worker.stats.get("rtt", {}).get("srtt") is not None]
+        if rtts:
+            summary.rtt = {"srtt": sum(rtt["srtt"] for rtt in rtts) / len(rtts), "rto": max(rtt["rto"] for rtt in rtts)}
+        summary.workers = [worker.to_dict() for worker in self.workers]
+        return summary
+
+    @staticmethod
+    def read_items(input_file):
+        seq = 0
+        for line in input_file:
+            parsed = parse_line(line)
+            if parsed is not None:
+                yield (seq,) + parsed
+                seq += 1
+
+    def dispatch(self, items):
+        "Hands batches of names to the least loaded workers while they have room, returns True once input runs out"
+        while True:
+            alive = [worker for worker in self.workers if worker.alive]
+            if not alive:
+                return False
+            worker = min(alive, key=lambda worker: (len(worker.outstanding), worker.names))
+            room = min(self.window - len(worker.outstanding), READ_BATCH_SIZE)
+            if self.ordered:    # the reorder buffer bounds how far reading may run ahead of writing
+                room = min(room, self.next_write + self.reorder_buffer - self.next_seq)
+            if room <= 0:
+                return False
+            batch = list(itertools.islice(items, room))
+            if batch:
+                for seq, name, qtype in batch:
+                    worker.outstanding[seq] = (name, qtype)
+                worker.names += len(batch)
+                self.summary.names += len(batch)
+                self.next_seq += len(batch)
+                worker.tasks.put(batch)
+            if len(batch) < room:
+                return True
+
+    def receive(self, result_queue, output_file):
+        "Handles one message from the workers, checking for crashed workers when none arrives in time"
+        try:
+            self.handle(result_queue.get(timeout=0.1), output_file)
+        except queue.Empty:
+            self.check_workers(result_queue, output_file)
+
+    def handle(self, message, output_file):
+        kind, index, payload = message
+        worker = self.workers[index]
+        if kind == "done":
+            worker.stats = payload
+            worker.finished = True
+            return
+        for seq, line, outcome in payload:
+            if worker.outstanding.pop(seq, None) is None:
+                continue
+            self.count(worker, outcome)
+            self.write(seq, line, output_file)
+        output_file.flush()
+
+    def check_workers(self, result_queue, output_file):
+        exited = [worker for worker in self.workers if worker.alive and not worker.process.is_alive()]
+        if not exited:
+            return
+        # whatever a worker sent before exiting is read first, so only what it never answered is lost
+        try:
+            while True:
+                self.handle(result_queue.get(timeout=0.1), output_file)
+        except queue.Empty:
+            pass
+        for worker in exited:
+            worker.alive = False
+            if worker.finished:
+                continue
+            worker.crashed = True
+            print("Worker {} exited with code {}, the {} names it held are reported as errors".format(
+                worker.index, worker.process.exitcode, len(worker.outstanding)), file=self.progress_file)
+            for seq, (name, qtype) in sorted(worker.outstanding.items()):
+                self.count(worker, "error")
+                self.write(seq, json.dumps({"name": name, "type": qtype, "error": "worker crashed"}), output_file)
+            worker.outstanding.clear()
+        output_file.flush()
+
+    def count(self, worker, outcome):
+        if outcome == "answered":
+            worker.answered += 1
+            self.summary.answered += 1
+        elif outcome == "timeout":
+            worker.timeouts += 1
+            self.summary.timeouts += 1
+        else:
+            worker.errors += 1
+            self.summary.errors += 1
+
+    def write(self, seq, line, output_file):
+        if not self.ordered:
+            output_file.write(line + "\n")
+            return
+        self.reordered[seq] = line
+        while self.next_write in self.reordered:
+            output_file.write(self.reordered.pop(self.next_write) + "\n")
+            self.next_write += 1
+
+    def report_progress(self, elapsed):
+        done = self.summary.answered + self.summary.errors + self.summary.timeouts
+        print("Progress: {} names resolved in {:.1f} seconds ({:.1f} QPS), {} in flight".format(
+            done, elapsed, done / elapsed if elapsed > 0 else 0.0,
+            sum(len(worker.outstanding) for worker in self.workers)) +
+            "".join("\n  worker {}: {} resolved{}".format(worker.index, worker.answered + worker.errors +
+                                                          worker.timeouts, "" if worker.alive else ", stopped")
+                    for worker in self.workers), file=self.progress_file)
+
+
+def worker_main(index, options, tasks, results):
+    "Entry point of a worker process, resolving the batches it is handed until it gets None"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl-C is handled by the parent
+    asyncio.run(worker_run(index, options, tasks, results))
+
+
+async def worker_run(index, options, tasks, results):
+    loop = asyncio.get_running_loop()
+    options = dict(options)
+    concurrency = options.pop("concurrency")
+    rate = options.pop("rate")
+    limiter = RateLimiter(rate) if rate else None
+    cache = None if options.pop("no_cache") else ResponseCache()
+    capture_path = options.pop("capture")
+    summary = BulkSummary()
+    finished = []   # (seq, JSON line, outcome) not yet sent to the parent
+    in_flight = set()
+
+    async def resolve(seq, name, qtype):
+        result = await resolve_one(resolver, name, qtype, summary)
+        outcome = "answered" if "error" not in result else "timeout" if result["error"] == "timeout" else "error"
+        finished.append((seq, json.dumps(result), outcome))
+
+    async def send_finished():
+        while True:
+            await asyncio.sleep(0.05)
+            if finished:
+                results.put(("results", index, finished[:]))
+                finished.clear()
+
+    with open_capture(capture_path and "{}.{}".format(capture_path, index)) as capture:
+        async with get_resolver(options, cache, capture) as resolver:
+            sender = asyncio.ensure_future(send_finished())
+            while True:
+                batch = await loop.run_in_executor(None, tasks.get)
+                if batch is None:
+                    break
+                for seq, name, qtype in batch:
+                    while len(in_flight) >= concurrency:
+                        _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    if limiter is not None:
+                        await limiter.acquire()
+                    in_flight.add(asyncio.ensure_future(resolve(seq, name, qtype)))
+            if in_flight:
+                await asyncio.wait(in_flight)
+            sender.cancel()
+            if finished:
+                results.put(("results", index, finished))
+            results.put(("done", index, {"retries": resolver.retransmissions, "hedged": resolver.hedged,
+                                         "rtt": resolver.rtt_estimator.to_dict()}))
+
+
+def main(args, output_file=None):
+    if not validate_server(args.server):
+        return 0
+
+    output_file = sys.stdout if output_file is None else output_file
+    workers = getattr(args, "workers", None) or 1
+    ordered = getattr(args, "ordered", False)
+    with contextlib.nullcontext(sys.stdin) if args.bulk == "-" else open(args.bulk) as input_file:
+        if workers > 1 or ordered:
+            pool = WorkerPool(args, workers, ordered=ordered,
+                              reorder_buffer=getattr(args, "reorder_buffer", None) or 10000,
+                              progress_interval=getattr(args, "progress", 5.0))
+            summary = pool.run(input_file, output_file)
+        else:
+            summary = asyncio.run(run(args, input_file, output_file))
+
+    print(summary, file=sys.stderr)
+    return 1
@@ -0,0 +1,149 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import dnsBulk
+from dnsAsyncResolverTestSuite import TestResponder
+from dnsTestServer import DNSTestServer, Zone
+
+
+class TestBulkArgs():
+
+    def __init__(self, port, bulk="-", timeout=1, retries=1, concurrency=4):
+        self.server = "@127.0.0.1"
+        self.p = port
+        self.t = timeout
+        self.r = retries
+        self.bulk = bulk
+        self.concurrency = concurrency
+
+
+class TestBulkResolution(unittest.TestCase):
+
+    def run_bulk(self, responder, text, **options):
+        async def run():
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(lambda: responder, local_addr=("127.0.0.1", 0))
+            output = io.StringIO()
+            try:
+                summary = await dnsBulk.run(TestBulkArgs(transport.get_extra_info("sockname")[1], **options),
+                                            io.StringIO(text), output)
+            finally:
+                transport.close()
+            return summary, [json.loads(line) for line in output.getvalue().splitlines()]
+        return asyncio.run(run())
+
+    def test_parse_line(self):
+        self.assertEqual(dnsBulk.parse_line("mcgill.ca\n"), ("mcgill.ca", "A"))
+        self.assertEqual(dnsBulk.parse_line("mcgill.ca mx\n"), ("mcgill.ca", "MX"))
+        self.assertIsNone(dnsBulk.parse_line("  \n"))
+        self.assertIsNone(dnsBulk.parse_line("# comment\n"))
+
+    def test_streams_one_json_line_per_name(self):
+        names = ["host{}.example.com".format(i) for i in range(50)]
+        summary, results = self.run_bulk(TestResponder(), "\n".join(names) + "\nmcgill.ca NS\n\n")
+        self.assertEqual(sorted(result["name"] for result in results), sorted(names + ["mcgill.ca"]))
+        self.assertEqual(summary.names, 51)
+        self.assertEqual(summary.answered, 51)
+        for result in results:
+            self.assertEqual(result["rcode"], 0)
+            self.assertEqual(result["answers"][0]["data"], "10.0.0.{}".format(len(result["name"])))
+
+    def test_summary_counts_timeouts_and_retries(self):
+        summary, results = self.run_bulk(TestResponder(drop=100), "mcgill.ca\nexample.com\n", timeout=0.05)
+        self.assertEqual(summary.timeouts, 2)
+        self.assertEqual(summary.retries, 2)
+        self.assertEqual([result["error"] for result in results], ["timeout", "timeout"])
+
+    def test_unsupported_type_is_reported(self):
+        summary, results = self.run_bulk(TestResponder(), "mcgill.ca BOGUS\n")
+        self.assertEqual(summary.errors, 1)
+        self.assertIn("BOGUS", results[0]["error"])
+
+    def test_every_name_gets_one_line_whatever_fails(self):
+        summary, results = self.run_bulk(TestResponder(), "mcgill.ca\nbücher.example\nexample.com\n")
+        self.assertEqual((summary.names, len(results), summary.answered, summary.errors), (3, 3, 2, 1))
+
+        class BrokenResolver:
+            async def query(self, name, qtype):
+                raise RuntimeError("resolver bug")
+
+        summary = dnsBulk.BulkSummary()
+        result = asyncio.run(dnsBulk.resolve_one(BrokenResolver(), "mcgill.ca", "A", summary))
+        self.assertEqual(result, {"name": "mcgill.ca", "type": "A", "error": "RuntimeError: resolver bug"})
+        self.assertEqual(summary.errors, 1)
+
+    def test_main_reads_stdin_without_closing_it(self):
+        self.addCleanup(setattr, sys, "stdin", sys.stdin)
+        with DNSTestServer() as server, contextlib.redirect_stderr(io.StringIO()):
+            for _ in range(2):
+                sys.stdin = io.StringIO("example.com\nexample.com MX\n")
+                output = io.StringIO()
+                self.assertEqual(dnsBulk.main(TestBulkArgs(server.port), output), 1)
+                self.assertFalse(sys.stdin.closed)
+                self.assertEqual(len(output.getvalue().splitlines()), 2)
+
+    def test_rate_limiter_spaces_queries(self):
+        async def acquire(limiter, count):
+            start = time.perf_counter()
+            for _ in range(count):
+                await limiter.acquire()
+            return time.perf_counter() - start
+
+        self.assertGreaterEqual(asyncio.run(acquire(dnsBulk.RateLimiter(200, burst=1), 21)), 0.09)
+        self.assertLess(asyncio.run(acquire(dnsBulk.RateLimiter(200, burst=20), 20)), 0.05)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    NAMES = ["host{}.example.com".format(i) for i in range(60)]
+
+    def setUp(self):
+        zone = Zone.from_text("\n".join("{}. 300 A 10.0.0.{}".format(name, i) for i, name in enumerate(self.NAMES)))
+        self.server = DNSTestServer(zone, jitter=0.02, seed=1).start()
+        self.addCleanup(self.server.stop)
+
+    def run_pool(self, workers, pool_started=None, **options):
+        args = TestBulkArgs(self.server.port, timeout=2, concurrency=4)
+        args.server = "127.0.0.1"
+        pool = dnsBulk.WorkerPool(args, workers, progress_interval=0, progress_file=io.StringIO(), **options)
+        if pool_started is not None:
+            threading.Thread(target=pool_started, args=(pool,), daemon=True).start()
+        output = io.StringIO()
+        summary = pool.run(io.StringIO("\n".join(self.NAMES) + "\n"), output)
+        return summary, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_results_are_merged_in_input_order(self):
+        summary, results = self.run_pool(3, ordered=True, reorder_buffer=8)
+        self.assertEqual([result["name"] for result in results], self.NAMES)
+        self.assertEqual([result["answers"][0]["data"] for result in results],
+                         ["10.0.0.{}".format(i) for i in range(len(self.NAMES))])
+        self.assertEqual((summary.names, summary.answered), (60, 60))
+        self.assertEqual(sum(worker["names"] for worker in summary.workers), 60)
+        self.assertTrue(all(worker["names"] > 0 for worker in summary.workers))
+
+    def test_names_held_by_a_crashed_worker_are_reported(self):
+        self.server.latency = 0.1
+
+        def kill_first_worker(pool):
+            while not pool.workers or not pool.workers[0].outstanding or pool.workers[0].answered < 4:
+                time.sleep(0.01)
+            os.kill(pool.workers[0].process.pid, signal.SIGKILL)
+
+        summary, results = self.run_pool(2, pool_started=kill_first_worker)
+        self.assertEqual(sorted(result["name"] for result in results), sorted(self.NAMES))
+        crashed = [result for result in results if result.get("error") == "worker crashed"]
+        self.assertTrue(crashed)
+        self.assertEqual(summary.answered + summary.errors, 60)
+        self.assertEqual(summary.errors, len(crashed))
+        self.assertEqual([worker["crashed"] for worker in summary.workers], [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
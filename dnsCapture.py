@@ -0,0 +1,235 @@
+import argparse
+import contextlib
+import io
+import json
+import mmap
+import os
+import platform
+import socket
+import struct
+import sys
+import time
+from collections import namedtuple
+import dnsClient
+from dnsClient import DNSPacket, DNSClientException, OPT_TYPE
+
+MAGIC = b"DNSCAP01"
+# timestamp, server IPv4 address, server port, query length and response length, followed by the query and response
+RECORD_STRUCT = struct.Struct("!d4sHHH")
+DECODE_ERRORS = (IndexError, ValueError, struct.error, DNSClientException)
+
+CaptureRecord = namedtuple("CaptureRecord", ["timestamp", "server", "port", "query", "response"])
+
+
+class CaptureWriter:
+    "Appends raw query/response pairs to a length-prefixed binary capture log"
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        else:
+            with open(path, "rb") as existing:
+                if existing.read(len(MAGIC)) != MAGIC:
+                    self.file.close()
+                    raise DNSClientException("Not a capture file: {}".format(path))
+        self.records = 0
+
+    def write(self, query, response, server, port, timestamp=None):
+        self.file.write(RECORD_STRUCT.pack(time.time() if timestamp is None else timestamp,
+                                           socket.inet_aton(server.replace("@", "")), port, len(query), len(response)))
+        self.file.write(query)
+        self.file.write(response)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureReader:
+    """Memory-maps a capture log and yields its CaptureRecords, whose query and response are memoryviews into the map
+    rather than copies. A record cut short by a crash while writing ends the log"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise DNSClientException("Not a capture file: {}".format(path))
+        self.view = memoryview(self.map)
+        self.truncated = False
+
+    def __iter__(self):
+        view = self.view
+        size = len(view)
+        offset = len(MAGIC)
+        while offset < size:
+            if offset + RECORD_STRUCT.size > size:
+                self.truncated = True
+                return
+            timestamp, address, port, query_length, response_length = RECORD_STRUCT.unpack_from(view, offset)
+            offset += RECORD_STRUCT.size
+            end = offset + query_length + response_length
+            if end > size:
+                self.truncated = True
+                return
+            yield CaptureRecord(timestamp, socket.inet_ntoa(address), port, view[offset:offset + query_length],
+                                view[offset + query_length:end])
+            offset = end
+
+    def close(self):
+        # the map stays open while records handed out still reference it, and is closed when they are collected
+        try:
+            if getattr(self, "view", None) is not None:
+                self.view.release()
+            if isinstance(self.map, mmap.mmap):
+                self.map.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_records(paths):
+    "Yields the records of several capture logs in turn"
+    for path in paths:
+        with CaptureReader(path) as reader:
+            yield from reader
+
+
+def record_to_dict(record):
+    "Decodes the response of a record into the dict written by dump, with an error entry when it does not decode"
+    result = {"time": record.timestamp, "server": record.server}
+    try:
+        response = DNSPacket.unpack(record.response)
+    except DECODE_ERRORS as e:
+        result["error"] = "{}: {}".format(e.__class__.__name__, e)
+        return result
+    question = response.question
+    result.update({"id": response.header.ID, "rcode": response.header.FLAGS.RCODE,
+                   "question": None if question is None else [question.QNAME, question.QTYPE],
+                   "answers": [answer.to_dict() for answer in response.answer],
+                   "authority": [answer.to_dict() for answer in response.authority],
+                   "additional": [answer.to_dict() for answer in response.additional if answer.TYPE != OPT_TYPE]})
+    return result
+
+
+def replay(paths, repeat=3, legacy=False):
+    "Streams every response of the logs through the decoders and returns the best decode rates in records per second"
+    records = list(read_records(paths))
+    errors = sum(1 for record in records if "error" in record_to_dict(record))
+    rates = {}
+
+    def best_rate(decode):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            decode()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return len(records) / best if best else float("inf")
+
+    def unpack():
+        for record in records:
+            try:
+                DNSPacket.unpack(record.response)
+            except DECODE_ERRORS:
+                pass
+    rates["replay.unpack"] = best_rate(unpack)
+
+    if legacy:
+        # the legacy decoder checks answers against the question and header of the query that was sent
+        pairs = []
+        for record in records:
+            try:
+                query = DNSPacket.unpack(record.query)
+            except DECODE_ERRORS:
+                continue
+            pairs.append((bytes(record.response), query.question, query.header))
+
+        def get_response_information():
+            with contextlib.redirect_stdout(io.StringIO()):
+                for data, question, header in pairs:
+                    try:
+                        dnsClient.get_response_information(data, question, header)
+                    except DECODE_ERRORS:
+                        pass
+        rates["replay.get_response_information"] = best_rate(get_response_information)
+
+    return {"python": platform.python_version(), "timestamp": time.time(), "unit": "ops/s",
+            "records": len(records), "bytes": sum(len(record.response) for record in records), "errors": errors,
+            "results": {name: round(rate, 1) for name, rate in sorted(rates.items())}}
+
+
+def check(paths, expected_lines):
+    "Returns the indexes of the records whose decoding differs from the expected dump lines"
+    mismatches = []
+    for index, (record, line) in enumerate(zip(read_records(paths), expected_lines)):
+        if json.loads(json.dumps(record_to_dict(record))) != json.loads(line):
+            mismatches.append(index)
+    return mismatches
+
+
+def main(args):
+    if args.command == "dump":
+        with open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout) as output_file:
+            for record in read_records(args.capture):
+                output_file.write(json.dumps(record_to_dict(record)) + "\n")
+        return 1
+
+    if args.command == "check":
+        with open(args.expect) as expected_file:
+            expected = expected_file.read().splitlines()
+        count = sum(1 for _ in read_records(args.capture))
+        mismatches = check(args.capture, expected)
+        for index in mismatches:
+            print("Record {} decodes differently".format(index))
+        if count != len(expected):
+            print("{} records captured but {} expected".format(count, len(expected)))
+        print("{} of {} records match".format(min(count, len(expected)) - len(mismatches), count))
+        return 0 if mismatches or count != len(expected) else 1
+
+    report = replay(args.capture, args.repeat, args.legacy)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay captured DNS responses through the decoders')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay', help='Measure decoding throughput over capture logs')
+    replay_parser.add_argument('capture', nargs='+', help='Capture logs written with --capture')
+    replay_parser.add_argument('--repeat', type=int, help='Passes over the records, the best one is reported',
+                               default=3)
+    replay_parser.add_argument('--legacy', action='store_true', help='Also time get_response_information')
+    replay_parser.add_argument('-o', '--output', help='Also write the JSON report to this file, which dnsBenchmark '
+                               'compare accepts')
+    dump_parser = subparsers.add_parser('dump', help='Print every decoded response as a JSON line')
+    dump_parser.add_argument('capture', nargs='+')
+    dump_parser.add_argument('-o', '--output', help='Write the JSON lines to this file')
+    check_parser = subparsers.add_parser('check', help='Check that the responses still decode as in a dump')
+    check_parser.add_argument('capture', nargs='+')
+    check_parser.add_argument('--expect', required=True, help='JSON lines written by dump with the reference decoder')
+    sys.exit(0 if main(parser.parse_args()) else 1)
@@ -0,0 +1,104 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import dnsBulk
+import dnsCapture
+from dnsClient import DNSPacket, DNSClientException, Resolver, main
+from dnsCapture import CaptureWriter, CaptureReader, MAGIC
+from dnsBenchmark import build_corpus
+from dnsTestServer import DNSTestServer
+from dnsClientTestSuite import TestParser
+from dnsBulkTestSuite import TestBulkArgs
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "capture.bin")
+
+    def write_corpus(self):
+        corpus = build_corpus()
+        with CaptureWriter(self.path) as capture:
+            for i, (data, question, request_header) in enumerate(corpus.values()):
+                query = DNSPacket(request_header, question, None).to_bytes()
+                capture.write(query, data, "10.0.0.{}".format(i), 53, timestamp=1000.0 + i)
+        return [data for data, _, _ in corpus.values()]
+
+    def test_records_are_read_back_without_copies(self):
+        responses = self.write_corpus()
+        with CaptureWriter(self.path) as capture:   # appending keeps the single header
+            capture.write(b"\x00" * 12, b"\x01" * 12, "@8.8.8.8", 5353, timestamp=2000.0)
+        with open(self.path, "rb") as capture_file:
+            self.assertEqual(capture_file.read().count(MAGIC), 1)
+
+        with CaptureReader(self.path) as reader:
+            records = list(reader)
+            self.assertEqual([bytes(record.response) for record in records[:-1]], responses)
+            self.assertIsInstance(records[0].response, memoryview)
+            self.assertEqual((records[0].server, records[0].port, records[0].timestamp), ("10.0.0.0", 53, 1000.0))
+            self.assertEqual(records[-1][:3], (2000.0, "8.8.8.8", 5353))
+            self.assertEqual(DNSPacket.unpack(records[1].response).answer[0].RDATA.DATA, "ns1.mcgill.ca")
+            del records
+
+    def test_record_cut_short_ends_the_log(self):
+        self.write_corpus()
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as capture_file:
+            capture_file.truncate(size - 5)
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(sum(1 for _ in reader), len(build_corpus()) - 1)
+            self.assertTrue(reader.truncated)
+
+        with open(self.path, "wb") as capture_file:
+            capture_file.write(b"not a capture")
+        with self.assertRaises(DNSClientException):
+            CaptureReader(self.path)
+        with self.assertRaises(DNSClientException):
+            CaptureWriter(self.path)
+
+    def test_replay_report_and_regression_check(self):
+        self.write_corpus()
+        report = dnsCapture.replay([self.path], repeat=1, legacy=True)
+        self.assertEqual((report["records"], report["errors"]), (len(build_corpus()), 0))
+        self.assertEqual(sorted(report["results"]), ["replay.get_response_information", "replay.unpack"])
+
+        expected = [json.dumps(dnsCapture.record_to_dict(record)) for record in dnsCapture.read_records([self.path])]
+        self.assertEqual(dnsCapture.check([self.path], expected), [])
+        changed = json.loads(expected[2])
+        changed["answers"][0]["ttl"] += 1
+        expected[2] = json.dumps(changed)
+        self.assertEqual(dnsCapture.check([self.path], expected), [2])
+
+    def test_resolvers_capture_each_exchange(self):
+        with DNSTestServer() as server:
+            with CaptureWriter(self.path) as capture:
+                with Resolver("127.0.0.1", server.port, timeout=1, cache=None, capture=capture) as resolver:
+                    resolver.resolve("www.example.com")
+
+            parser = TestParser("127.0.0.1", "example.com", port=server.port, timeout=1, type="MX")
+            parser.no_cache = True
+            parser.capture = self.path
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(main(parser), 1)
+
+            args = TestBulkArgs(server.port)
+            args.server = "127.0.0.1"
+            args.capture = self.path
+            asyncio.run(dnsBulk.run(args, io.StringIO("mail.example.com\nns1.example.com\n"), io.StringIO()))
+
+        with CaptureReader(self.path) as reader:
+            records = [(DNSPacket.unpack(record.query), DNSPacket.unpack(record.response)) for record in reader]
+        names = [query.question.QNAME for query, _ in records]
+        self.assertEqual(names[:2], ["www.example.com", "example.com"])
+        self.assertEqual(sorted(names[2:]), ["mail.example.com", "ns1.example.com"])   # in completion order
+        self.assertTrue(all(query.header.ID == response.header.ID for query, response in records))
+
+
+if __name__ == '__main__':
+    unittest.main()
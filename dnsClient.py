@@ -3,33 +3,167 @@ import random
 import argparse
 import time
 import re
+import shlex
+import struct
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from dnsStats import STATS
+
+HEADER_STRUCT = struct.Struct("!HHHHHH")
+QUESTION_TAIL_STRUCT = struct.Struct("!HH")
+ID_STRUCT = struct.Struct("!H")
+RR_STRUCT = struct.Struct("!HHIH")  # TYPE, CLASS, TTL, RDLENGTH
+SOA_STRUCT = struct.Struct("!IIIII")  # SERIAL, REFRESH, RETRY, EXPIRE, MINIMUM
+
+OPT_TYPE = 0x0029
+DEFAULT_UDP_PAYLOAD_SIZE = 1232     # DNS flag day 2020 recommendation, avoids IP fragmentation
+OPT_OPTION_STRUCT = struct.Struct("!HH")
+SRV_STRUCT = struct.Struct("!HHH")  # PRIORITY, WEIGHT, PORT
+MAX_NAME_LENGTH = 255       # bytes of an uncompressed name on the wire (RFC 1035 3.1)
+MAX_POINTER_HOPS = 32       # compression pointers followed while reading one name
+DECODE_ERRORS = (IndexError, ValueError, struct.error, OSError)  # raised by reads past the end of a packet
+
+SOAData = namedtuple("SOAData", ["MNAME", "RNAME", "SERIAL", "REFRESH", "RETRY", "EXPIRE", "MINIMUM"])
+SRVData = namedtuple("SRVData", ["PRIORITY", "WEIGHT", "PORT", "TARGET"])
+CAAData = namedtuple("CAAData", ["FLAGS", "TAG", "VALUE"])
 
 class DNSClientException(Exception):
-    "Raise when any error in the DNS Client occurs"
+    "Raise when any error in the DNS Client occurs, with the QueryResult gathered so far when there is one"
+
+    def __init__(self, message="", result=None):
+        super().__init__(message)
+        self.result = result
+
+class DNSTimeoutException(DNSClientException):
+    "Raise when a query is retransmitted the maximum number of times without a response"
+    pass
+
+class DNSUnexpectedResponseException(DNSClientException):
+    "Raise when a response does not fit the query, such as a server without recursion or a wrong question count"
     pass
 
+class DNSMalformedPacketException(DNSUnexpectedResponseException):
+    """Raise when a packet cannot be decoded: truncated, read past its end, or with compression pointers that loop or
+    point forward. offset is where decoding stopped when it is known"""
+
+    def __init__(self, message="", result=None, offset=None):
+        super().__init__(message, result)
+        self.offset = offset
+
+class DNSResponseException(DNSClientException):
+    "Raise when the DNS server answers with an error RCODE"
+    RCODE = None
+
+class DNSFormatErrorException(DNSResponseException):
+    RCODE = 1
+
+class DNSServerFailureException(DNSResponseException):
+    RCODE = 2
+
+class DNSNameErrorException(DNSResponseException):
+    "Raise when the queried name does not exist (NXDOMAIN)"
+    RCODE = 3
+
+class DNSNotImplementedException(DNSResponseException):
+    RCODE = 4
+
+class DNSRefusedException(DNSResponseException):
+    RCODE = 5
+
+RCODE_EXCEPTIONS = {
+    1: (DNSFormatErrorException, "Format error: the name server was unable to interpret the query"),
+    2: (DNSServerFailureException, "Server failure: the name server was unable to process this query due to a problem with the name server"),
+    3: (DNSNameErrorException, "NOT FOUND Name error: meaningful only for responses from an authoritative name server, this code signifies that the domain name referenced in the query does not exist"),
+    4: (DNSNotImplementedException, "Not implemented: the name server does not support the requested kind of query"),
+    5: (DNSRefusedException, "Refused: the name server refuses to perform the requested operation for policy reasons"),
+}
+
 class DNSPacket:
-    def __init__(self, header, question, answer):
+    def __init__(self, header, question, answer, authority=None, additional=None):
         self.header = header
         self.question = question
         self.answer = answer
+        self.authority = authority if authority is not None else []
+        self.additional = additional if additional is not None else []
 
     def __str__(self):
         return "{} {}".format(self.header.__str__(), self.question.__str__())
 
+    def to_bytes(self):
+        buffer = bytearray()
+        self.pack_into(buffer)
+        return bytes(buffer)
+
+    def pack_into(self, buffer, offset=0):
+        records = (self.answer or []) + self.authority + self.additional
+        if all(record.TYPE == OPT_TYPE for record in records):
+            # queries are looked up as a cached template, only the ID is written per packet
+            template = QUERY_TEMPLATES.get_template(self.header, self.question, records)
+        else:
+            template = bytearray(self.header.to_bytes())
+            compression = {}
+            if self.question is not None:
+                register_name(compression, self.question.QNAME, HEADER_STRUCT.size)
+                self.question.pack_into(template, len(template))
+            for record in records:
+                record.pack_into(template, compression)
+
+        end = offset + len(template)
+        buffer[offset:end] = template
+        ID_STRUCT.pack_into(buffer, offset, self.header.ID)
+        return end
+
+    @classmethod
+    def unpack(cls, data):
+        """Decodes a whole DNS message in a single pass over a memoryview of the received bytes. Every record consumes
+        bytes of the message and every name is bounded, so the cost is linear in the message length whatever the
+        counts in the header say. Raises DNSMalformedPacketException for anything that does not decode"""
+        view = memoryview(data)
+        offset = 0
+        try:
+            header = cls.Header.unpack_from(view)
+            offset = HEADER_STRUCT.size
+
+            names = {}  # offset -> decoded name, shared by every compression pointer into the message
+            question = None
+            for _ in range(header.QDCOUNT):
+                question, offset = cls.Question.unpack_from(view, offset, names)
+
+            sections = []
+            for count in (header.ANCOUNT, header.NSCOUNT, header.ARCOUNT):
+                records = []
+                for _ in range(count):
+                    record, offset = cls.Answer.unpack_from(view, offset, names)
+                    records.append(record)
+                sections.append(records)
+        except DECODE_ERRORS as e:
+            raise DNSMalformedPacketException("Malformed packet at byte {}: {}".format(offset, e), offset=offset)
+
+        return cls(header, question, sections[0], sections[1], sections[2])
+
     @classmethod
-    def get_request_dns_packet(cls):
-        return cls(cls.Header.get_request_header(), cls.Question.get_request_question(),
-                   cls.Answer.get_request_answer())
+    def get_request_dns_packet(cls, QNAME, QTYPE, udp_payload_size=None, recursion_desired=True):
+        "Builds a query, advertising udp_payload_size through an EDNS0 OPT record when it is given"
+        additional = [cls.Answer.get_opt_record(udp_payload_size)] if udp_payload_size else []
+        flags = cls.Header.Flags.get_request_flags(0b0, int(recursion_desired))
+        header = cls.Header.get_request_header(flags, ARCOUNT=len(additional))
+        return cls(header, cls.Question.get_request_question(QNAME, QTYPE), None, additional=additional)
+
+    def get_opt_record(self):
+        for record in self.additional:
+            if record.TYPE == OPT_TYPE:
+                return record
+        return None
+
+    def get_udp_payload_size(self):
+        "Returns the UDP payload size advertised by the OPT record, 512 bytes without EDNS0"
+        opt = self.get_opt_record()
+        return 512 if opt is None else max(512, opt.CLASS)
 
     @staticmethod
     def get_q_type(qtype_num: int) -> str:
-        if qtype_num == 1:
-            return "A"
-        if qtype_num == 2:
-            return "NS"
-        if qtype_num == 15:
-            return "MX"
+        record_type = RECORD_TYPES.get(qtype_num)
+        return None if record_type is None else record_type.name
 
     class Header:
         ID = None
@@ -39,8 +173,8 @@ class DNSPacket:
         NSCOUNT = None
         ARCOUNT = None
 
-        def __init__(self, FLAGS, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT, ID = random.getrandbits(16)):
-            self.ID = ID
+        def __init__(self, FLAGS, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT, ID = None):
+            self.ID = random.getrandbits(16) if ID is None else ID  # fresh ID for every packet
             self.FLAGS = FLAGS
             self.QDCOUNT = QDCOUNT
             self.ANCOUNT = ANCOUNT
@@ -53,12 +187,29 @@ class DNSPacket:
                                                                         self.QDCOUNT, self.ANCOUNT, self.NSCOUNT,
                                                                         self.ARCOUNT), 2)), 2)
 
+        def to_bytes(self):
+            return HEADER_STRUCT.pack(self.ID, self.FLAGS.to_int(), self.QDCOUNT, self.ANCOUNT, self.NSCOUNT,
+                                      self.ARCOUNT)
+
+        def pack_into(self, buffer, offset=0):
+            end = offset + HEADER_STRUCT.size
+            if len(buffer) < end:
+                buffer.extend(bytes(end - len(buffer)))
+            HEADER_STRUCT.pack_into(buffer, offset, self.ID, self.FLAGS.to_int(), self.QDCOUNT, self.ANCOUNT,
+                                    self.NSCOUNT, self.ARCOUNT)
+            return end
+
         @classmethod
         def get_request_header(cls, FLAGS, ANCOUNT=0x0000, ARCOUNT=0x0000):
             QDCOUNT = 0x0001
             NSCOUNT = 0x0000
             return cls(FLAGS, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT)
 
+        @classmethod
+        def unpack_from(cls, data, offset=0):
+            ID, flags, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT = HEADER_STRUCT.unpack_from(data, offset)
+            return cls(cls.Flags.from_int(flags), QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT, ID)
+
         @classmethod
         def unpack(cls, incoming_response_header):
             flags = cls.Flags.unpack(incoming_response_header[2:4])
@@ -89,23 +240,30 @@ class DNSPacket:
                                                                                  self.RD, self.RA, self.Z, self.RCODE)
 
             def to_hex(self):
-                return "{:04x}".format(int(self.__str__(), 2))
+                return "{:04x}".format(self.to_int())
+
+            def to_int(self):
+                return (int(self.QR) << 15 | int(self.OPCODE) << 11 | int(self.AA) << 10 | int(self.TC) << 9 |
+                        int(self.RD) << 8 | int(self.RA) << 7 | int(self.Z) << 4 | int(self.RCODE))
 
             @classmethod
-            def get_request_flags(cls, TC):
+            def get_request_flags(cls, TC, RD=0b1):
                 QR = 0b0  # default to query
                 OPCODE = 0b0000  # standard query
                 AA = 0b0  # check in response
-                RD = 0b1
                 RA = 0b0  # check in response
                 Z = 0b000
                 RCODE = 0b0000  # check in response
                 return cls(QR, OPCODE, AA, TC, RD, RA, Z, RCODE)
 
+            @classmethod
+            def from_int(cls, flags):
+                return cls(QR=flags >> 15, OPCODE=(flags >> 11) & 0xF, AA=(flags >> 10) & 1, TC=(flags >> 9) & 1,
+                           RD=(flags >> 8) & 1, RA=(flags >> 7) & 1, Z=(flags >> 4) & 0x7, RCODE=flags & 0xF)
+
             @classmethod
             def unpack(cls, incoming_response_flags):
-                flag_bits = list("{:016b}".format(int("{:02x}{:02x}".format(incoming_response_flags[0],incoming_response_flags[1]), 16)))
-                return cls(QR=flag_bits[0], OPCODE=flag_bits[1:5], AA=flag_bits[6], TC=flag_bits[7], RD=flag_bits[8], RA=flag_bits[9], Z=flag_bits[10:13], RCODE=flag_bits[13:])
+                return cls.from_int(incoming_response_flags[0] << 8 | incoming_response_flags[1])
 
     class Question:
         QNAME = None
@@ -129,6 +287,15 @@ class DNSPacket:
             return_string += "{} {}".format("{:04x}".format(self.QCLASS)[:2], "{:04x}".format(self.QCLASS)[2:])
             return return_string
 
+        def to_bytes(self):
+            return encode_name(self.QNAME) + QUESTION_TAIL_STRUCT.pack(self.QTYPE, self.QCLASS)
+
+        def pack_into(self, buffer, offset=0):
+            encoded = self.to_bytes()
+            end = offset + len(encoded)
+            buffer[offset:end] = encoded
+            return end
+
         @classmethod
         def get_request_question(cls, QNAME, QTYPE):
             QCLASS = 0x0001
@@ -136,12 +303,13 @@ class DNSPacket:
 
         @staticmethod
         def get_q_num(qtype_string: str) -> int:
-            if qtype_string == "A":
-                return 0x0001
-            if qtype_string == "NS":
-                return 0x0002
-            if qtype_string == "MX":
-                return 0x000f
+            return QUERY_TYPES.get(qtype_string)
+
+        @classmethod
+        def unpack_from(cls, data, offset, names=None):
+            QNAME, offset = read_name(data, offset, names)
+            QTYPE, QCLASS = QUESTION_TAIL_STRUCT.unpack_from(data, offset)
+            return (cls(QNAME, QTYPE, QCLASS), offset + QUESTION_TAIL_STRUCT.size)
 
         @classmethod
         def unpack(cls, numQuestions, question):
@@ -166,7 +334,16 @@ class DNSPacket:
 
             return pointer 
 
+    class RDATA:
+        __slots__ = ("DATA", "PREFERENCE", "EXCHANGE")
+
+        def __init__(self, DATA, PREFERENCE, EXCHANGE=0):
+            self.DATA = DATA
+            self.PREFERENCE = PREFERENCE
+            self.EXCHANGE = EXCHANGE
+
     class Answer:
+        __slots__ = ("NAME", "TYPE", "CLASS", "TTL", "RDLENGTH", "RDATA")
 
         def __init__(self, NAME, TYPE, CLASS, TTL, RDLENGTH, RDATA):
             self.NAME = NAME
@@ -176,6 +353,18 @@ class DNSPacket:
             self.RDLENGTH = RDLENGTH
             self.RDATA = RDATA
 
+        def to_dict(self):
+            record_type = RECORD_TYPES.get(self.TYPE)
+            if record_type is None:
+                return {"name": self.NAME, "type": self.TYPE, "ttl": self.TTL, "data": self.RDATA.DATA.hex()}
+            return {"name": self.NAME, "type": record_type.name, "ttl": self.TTL,
+                    "data": record_type.formatter(self.RDATA)}
+
+        @classmethod
+        def get_opt_record(cls, udp_payload_size, DO=0, options=()):
+            # the OPT pseudo record reuses CLASS for the payload size and TTL for extended RCODE, version and flags
+            return cls("", OPT_TYPE, udp_payload_size, DO << 15, 0, DNSPacket.RDATA(tuple(options), None, None))
+
         @classmethod
         def get_request_answer(cls, NAME, TYPE, RDLENGTH, RDATA):
             CLASS = 0x0000  # check response
@@ -187,72 +376,59 @@ class DNSPacket:
             auth = "nonauth"
             if auth_bit == 1:
                 auth = "auth"
-            match self.TYPE:
-                case 0x0001:
-                    return f"IP \t {self.RDATA.DATA} \t {self.TTL} \t {auth}\n"
-                case 0x0002:
-                    return f"NS \t {self.RDATA.DATA} \t {self.TTL} \t {auth}\n"
-                case 0x0005:
-                    return f"CNAME \t {self.RDATA.DATA} \t {self.TTL} \t {auth}\n"
-                case 0x000f:
-                    return f"MX \t {self.RDATA.EXCHANGE} \t {self.RDATA.PREFERENCE} \t {self.TTL} \t {auth}\n"
-                case default:
-                    pass
+            if self.TYPE == OPT_TYPE:
+                return f"OPT \t UDP payload size {self.CLASS} \t EDNS version {(self.TTL >> 16) & 0xFF}\n"
+            record_type = RECORD_TYPES.get(self.TYPE)
+            if record_type is None:
+                return f"TYPE{self.TYPE} \t {self.RDATA.DATA.hex()} \t {self.TTL} \t {auth}\n"
+            return f"{record_type.label} \t {record_type.columns(self.RDATA)} \t {self.TTL} \t {auth}\n"
+
+        def pack_into(self, message, compression=None):
+            "Appends the record to a message being built from its first byte, compressing names through compression"
+            pack_name_into(message, self.NAME, compression)
+            rdlength_offset = len(message) + RR_STRUCT.size - 2
+            message += RR_STRUCT.pack(self.TYPE, self.CLASS, self.TTL, 0)
+            record_type = RECORD_TYPES.get(self.TYPE)
+            if record_type is None:
+                message += self.RDATA.DATA
+            else:
+                record_type.encoder(message, self.RDATA, compression)
+            ID_STRUCT.pack_into(message, rdlength_offset, len(message) - rdlength_offset - 2)
+            return len(message)
+
+        @classmethod
+        def unpack_from(cls, data, offset, names=None):
+            "Decodes one resource record of any section, returning it with the offset of the next record"
+            NAME, offset = read_name(data, offset, names)
+            TYPE, CLASS, TTL, RDLENGTH = RR_STRUCT.unpack_from(data, offset)
+            offset += RR_STRUCT.size
+            end = offset + RDLENGTH
+            if end > len(data):
+                raise DNSMalformedPacketException("RDATA runs past the end of the packet", offset=offset)
+            record_type = RECORD_TYPES.get(TYPE)
+            if record_type is None:
+                rdata = DNSPacket.RDATA(bytes(data[offset:end]), None, None)     # kept undecoded, RFC 3597
+            else:
+                # decoders see the message up to the end of the RDATA, so they cannot read into the next record
+                rdata = record_type.decoder(memoryview(data)[:end], offset, RDLENGTH, names)
+            return (cls(NAME, TYPE, CLASS, TTL, RDLENGTH, rdata), end)
 
         @classmethod
         def unpack(cls, data, name, pointer):
-            type = data[pointer] << 8 | data[pointer + 1]
-            pointer += 2
-            packet_class = data[pointer: pointer+2]
-            if packet_class[0] + packet_class[1] != 0x0001:
-                print_error("Expected packet class to be 0x0001 but was {} instead".format(packet_class)) 
+            "Decodes the record whose NAME ends at pointer, returning (None, next pointer) for unknown types"
+            TYPE, CLASS, TTL, RDLENGTH = RR_STRUCT.unpack_from(data, pointer)
+            if CLASS != 0x0001:
+                print_error("Expected packet class to be 0x0001 but was {} instead".format(CLASS))
                 raise DNSClientException()
-            pointer += 2    # Beginning of TTL bytes
-
-            match type:
-                case 0x0005: # CNAME
-                    ttl = getTTL(data, pointer)
-                    pointer += 4    # Beginning of the RDLength
-                    rdlength = data[pointer] << 8 | data[pointer + 1]
-                    pointer += 2    # Beginning of RData
-                    alias = get_alias(data, pointer)
-                    pointer += rdlength ## Beginning of next answer
-                    return (cls(name, type, packet_class,ttl, rdlength, cls.RDATA(alias, None, None)), pointer)
-                case 0x0001: # A
-                    ttl = getTTL(data, pointer)
-                    pointer += 4
-                    rdlength = data[pointer] << 8 | data[pointer + 1] 
-                    pointer += 2 # go to RData
-                    ip = get_ip_address(data, pointer)
-                    pointer +=4 # Beginning of next answer
-                    return (cls(name, type, packet_class,ttl, rdlength, cls.RDATA(ip, None, None)), pointer)
-                case 0x0002: # NS
-                    # print("THIS IS THE START OF THE NAME SERVER SECTION\n")
-                    ttl = getTTL(data, pointer)
-                    pointer += 4
-                    rdlength = data[pointer] << 8 | data[pointer + 1]
-                    pointer += 2
-                    alias = get_alias(data,pointer)
-                    pointer += rdlength
-                    return (cls(name, type, packet_class,ttl, rdlength, cls.RDATA(alias, None, None)), pointer)
-                case 0x000f: #MX
-                    ttl = getTTL(data, pointer)
-                    pointer += 4
-                    rdlength = data[pointer] << 8 | data[pointer + 1]
-                    pointer += 2
-                    pref = data[pointer] << 8 | data[pointer + 1]
-                    pointer += 2
-                    exchange = get_alias(data, pointer)
-                    pointer += rdlength - 2
-                    return (cls(name, type, packet_class,ttl, rdlength, cls.RDATA(None, pref,exchange)), pointer)
-                case default:
-                    return (None, pointer)
-
-        class RDATA:
-            def __init__(self, DATA, PREFERENCE, EXCHANGE=0):
-                self.DATA = DATA
-                self.PREFERENCE = PREFERENCE
-                self.EXCHANGE = EXCHANGE
+            pointer += RR_STRUCT.size
+            end = pointer + RDLENGTH
+            if end > len(data):
+                raise DNSMalformedPacketException("RDATA runs past the end of the packet", offset=pointer)
+            record_type = RECORD_TYPES.get(TYPE)
+            if record_type is None:
+                return (None, end)   # skipped by its RDLENGTH
+            rdata = record_type.decoder(memoryview(data)[:end], pointer, RDLENGTH)
+            return (cls(name, TYPE, CLASS, TTL, RDLENGTH, rdata), end)
 
     class Authority:
         @staticmethod
@@ -266,6 +442,934 @@ class DNSPacket:
             return self(incoming_additional)
 
 
+class QueryTemplateCache:
+    "Encoded query packets keyed by header fields and question, so a repeated query only needs its ID patched"
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.templates = OrderedDict()
+
+    def __len__(self):
+        return len(self.templates)
+
+    def clear(self):
+        self.templates.clear()
+
+    def get_template(self, header, question, opt_records=()):
+        key = (header.FLAGS.to_int(), header.QDCOUNT, header.ANCOUNT, header.NSCOUNT, header.ARCOUNT,
+               question.QNAME, question.QTYPE, question.QCLASS,
+               tuple((record.CLASS, record.TTL, record.RDATA.DATA) for record in opt_records))
+        template = self.templates.get(key)
+        if template is not None:
+            self.templates.move_to_end(key)
+            return template
+
+        buffer = bytearray(header.to_bytes())
+        question.pack_into(buffer, len(buffer))
+        for record in opt_records:
+            record.pack_into(buffer)
+        template = bytes(buffer)
+
+        self.templates[key] = template
+        if len(self.templates) > self.max_size:
+            self.templates.popitem(last=False)
+        return template
+
+
+QUERY_TEMPLATES = QueryTemplateCache()
+
+
+def encode_label(label, name, encoding="ascii"):
+    "Encodes one label of a name with its length prefix. read_name decodes labels as latin-1, so wire names round-trip"
+    try:
+        raw = label.encode(encoding)
+    except UnicodeEncodeError:
+        raise DNSClientException("Invalid name, labels must be {}: {}".format(encoding.upper(), name))
+    if not 0 < len(raw) <= 63:
+        raise DNSClientException("Invalid label length in domain name: {}".format(name))
+    return bytes((len(raw),)) + raw
+
+@lru_cache(maxsize=4096)
+def encode_name(name, encoding="ascii"):
+    """Encodes a domain name as a sequence of length prefixed labels terminated by the root label. Names given by the
+    user must be ASCII, names of records read off the wire are encoded back as latin-1"""
+    encoded = bytearray()
+    labels = name.rstrip(".").split(".") if name.rstrip(".") else []
+    for label in labels:
+        encoded += encode_label(label, name, encoding)
+    encoded.append(0)
+    if len(encoded) > 255:
+        raise DNSClientException("Domain name exceeds 255 bytes: {}".format(name))
+    return bytes(encoded)
+
+def read_name(data, offset, names=None):
+    """Reads a possibly compressed domain name, returning it with the offset just past it in the record. Compression
+    pointers must point before themselves and at most MAX_POINTER_HOPS are followed, so no name can loop and reading
+    one costs at most its 255 bytes"""
+    labels = []
+    label_offsets = []
+    end = None
+    length = 1      # wire length of the name read so far, counting the root label
+    hops = 0
+    size = len(data)
+    while True:
+        if offset >= size:
+            raise DNSMalformedPacketException("Name runs past the end of the packet", offset=offset)
+        label_length = data[offset]
+        if label_length & 0xC0 == 0xC0:     # 14 bit compression pointer
+            if offset + 1 >= size:
+                raise DNSMalformedPacketException("Truncated compression pointer", offset=offset)
+            target = (label_length & 0x3F) << 8 | data[offset + 1]
+            if target >= offset:
+                raise DNSMalformedPacketException("Compression pointer does not point backwards", offset=offset)
+            hops += 1
+            if hops > MAX_POINTER_HOPS:
+                raise DNSMalformedPacketException("Too many compression pointers in a name", offset=offset)
+            if end is None:
+                end = offset + 2
+            offset = target
+            if names is not None and offset in names:
+                suffix = names[offset]
+                if length + len(suffix) + 1 > MAX_NAME_LENGTH:
+                    raise DNSMalformedPacketException("Name exceeds 255 bytes", offset=offset)
+                labels.append(suffix)
+                break
+            continue
+        if label_length & 0xC0:
+            raise DNSMalformedPacketException("Unknown label type {:#x}".format(label_length & 0xC0), offset=offset)
+        if label_length == 0:
+            offset += 1
+            break
+        length += label_length + 1
+        if length > MAX_NAME_LENGTH:
+            raise DNSMalformedPacketException("Name exceeds 255 bytes", offset=offset)
+        if offset + label_length >= size:
+            raise DNSMalformedPacketException("Label runs past the end of the packet", offset=offset)
+        label_offsets.append(offset)
+        labels.append(str(data[offset + 1:offset + label_length + 1], "latin-1"))
+        offset += label_length + 1
+
+    if names is not None:
+        for i, label_offset in enumerate(label_offsets):
+            names[label_offset] = '.'.join(labels[i:])
+    return ('.'.join(labels), offset if end is None else end)
+
+def register_name(compression, name, offset):
+    "Records where each suffix of an uncompressed name starts so later names can point to it"
+    labels = name.rstrip(".").split(".") if name.rstrip(".") else []
+    for i in range(len(labels)):
+        if offset >= 0x4000:
+            return
+        compression.setdefault(".".join(labels[i:]).lower(), offset)
+        offset += len(labels[i]) + 1
+
+def pack_name_into(message, name, compression=None):
+    "Appends an encoded name, ending it with a pointer to an earlier copy of its longest known suffix"
+    if compression is None:
+        message += encode_name(name, "latin-1")
+        return
+    labels = name.rstrip(".").split(".") if name.rstrip(".") else []
+    for i in range(len(labels)):
+        pointer = compression.get(".".join(labels[i:]).lower())
+        if pointer is not None:
+            message += ID_STRUCT.pack(0xC000 | pointer)
+            return
+        if len(message) < 0x4000:
+            compression[".".join(labels[i:]).lower()] = len(message)
+        message += encode_label(labels[i], name, "latin-1")
+    message.append(0)
+
+def decode_a_rdata(data, offset, rdlength, names=None):
+    if rdlength != 4:
+        raise DNSMalformedPacketException("A record with {} bytes of RDATA".format(rdlength), offset=offset)
+    return DNSPacket.RDATA(socket.inet_ntoa(data[offset:offset + 4]), None, None)
+
+def encode_a_rdata(message, rdata, compression):
+    message += socket.inet_aton(rdata.DATA)
+
+def decode_aaaa_rdata(data, offset, rdlength, names=None):
+    if rdlength != 16:
+        raise DNSMalformedPacketException("AAAA record with {} bytes of RDATA".format(rdlength), offset=offset)
+    return DNSPacket.RDATA(socket.inet_ntop(socket.AF_INET6, bytes(data[offset:offset + 16])), None, None)
+
+def encode_aaaa_rdata(message, rdata, compression):
+    message += socket.inet_pton(socket.AF_INET6, rdata.DATA)
+
+def decode_name_rdata(data, offset, rdlength, names=None):
+    return DNSPacket.RDATA(read_name(data, offset, names)[0], None, None)
+
+def encode_name_rdata(message, rdata, compression):
+    pack_name_into(message, rdata.DATA, compression)
+
+def parse_text_rdata(text):
+    return DNSPacket.RDATA(text.split()[0].rstrip("."), None, None)
+
+def decode_mx_rdata(data, offset, rdlength, names=None):
+    preference = data[offset] << 8 | data[offset + 1]
+    return DNSPacket.RDATA(None, preference, read_name(data, offset + 2, names)[0])
+
+def encode_mx_rdata(message, rdata, compression):
+    message += ID_STRUCT.pack(rdata.PREFERENCE)
+    pack_name_into(message, rdata.EXCHANGE, compression)
+
+def parse_mx_rdata(text):
+    preference, exchange = text.split()[:2]
+    return DNSPacket.RDATA(None, int(preference), exchange.rstrip("."))
+
+def decode_soa_rdata(data, offset, rdlength, names=None):
+    mname, offset = read_name(data, offset, names)
+    rname, offset = read_name(data, offset, names)
+    return DNSPacket.RDATA(SOAData(mname, rname, *SOA_STRUCT.unpack_from(data, offset)), None, None)
+
+def encode_soa_rdata(message, rdata, compression):
+    pack_name_into(message, rdata.DATA.MNAME, compression)
+    pack_name_into(message, rdata.DATA.RNAME, compression)
+    message += SOA_STRUCT.pack(*rdata.DATA[2:])
+
+def parse_soa_rdata(text):
+    fields = text.split()
+    return DNSPacket.RDATA(SOAData(fields[0].rstrip("."), fields[1].rstrip("."), *map(int, fields[2:7])), None, None)
+
+def decode_txt_rdata(data, offset, rdlength, names=None):
+    strings = []
+    end = offset + rdlength
+    while offset < end:
+        length = data[offset]
+        if offset + 1 + length > end:
+            raise DNSMalformedPacketException("TXT string runs past its RDATA", offset=offset)
+        strings.append(bytes(data[offset + 1:offset + 1 + length]).decode("utf-8", "backslashreplace"))
+        offset += 1 + length
+    return DNSPacket.RDATA(tuple(strings), None, None)
+
+def encode_txt_rdata(message, rdata, compression):
+    for string in rdata.DATA:
+        raw = string.encode("utf-8")
+        if len(raw) > 255:
+            raise DNSClientException("TXT strings are limited to 255 bytes")
+        message.append(len(raw))
+        message += raw
+
+def parse_txt_rdata(text):
+    return DNSPacket.RDATA(tuple(shlex.split(text)), None, None)
+
+def format_txt_rdata(rdata):
+    return " ".join('"{}"'.format(string.replace("\\", "\\\\").replace('"', '\\"')) for string in rdata.DATA)
+
+def decode_srv_rdata(data, offset, rdlength, names=None):
+    priority, weight, port = SRV_STRUCT.unpack_from(data, offset)
+    return DNSPacket.RDATA(SRVData(priority, weight, port, read_name(data, offset + SRV_STRUCT.size, names)[0]),
+                           None, None)
+
+def encode_srv_rdata(message, rdata, compression):
+    message += SRV_STRUCT.pack(*rdata.DATA[:3])
+    pack_name_into(message, rdata.DATA.TARGET)     # never compressed (RFC 2782)
+
+def parse_srv_rdata(text):
+    priority, weight, port, target = text.split()[:4]
+    return DNSPacket.RDATA(SRVData(int(priority), int(weight), int(port), target.rstrip(".")), None, None)
+
+def decode_caa_rdata(data, offset, rdlength, names=None):
+    flags, tag_length = data[offset], data[offset + 1]
+    tag_end = offset + 2 + tag_length
+    if tag_end > offset + rdlength:
+        raise DNSMalformedPacketException("CAA tag runs past its RDATA", offset=offset)
+    value = bytes(data[tag_end:offset + rdlength]).decode("utf-8", "backslashreplace")
+    return DNSPacket.RDATA(CAAData(flags, bytes(data[offset + 2:tag_end]).decode("ascii"), value), None, None)
+
+def encode_caa_rdata(message, rdata, compression):
+    tag = rdata.DATA.TAG.encode("ascii")
+    message += bytes((rdata.DATA.FLAGS, len(tag))) + tag + rdata.DATA.VALUE.encode("utf-8")
+
+def parse_caa_rdata(text):
+    flags, tag, value = shlex.split(text)[:3]
+    return DNSPacket.RDATA(CAAData(int(flags), tag, value), None, None)
+
+def decode_opt_rdata(data, offset, rdlength, names=None):
+    options = []
+    end = offset + rdlength
+    while offset + OPT_OPTION_STRUCT.size <= end:
+        code, length = OPT_OPTION_STRUCT.unpack_from(data, offset)
+        offset += OPT_OPTION_STRUCT.size
+        if offset + length > end:
+            raise DNSMalformedPacketException("EDNS option runs past its RDATA", offset=offset)
+        options.append((code, bytes(data[offset:offset + length])))
+        offset += length
+    return DNSPacket.RDATA(tuple(options), None, None)
+
+def encode_opt_rdata(message, rdata, compression):
+    for code, value in rdata.DATA:
+        message += OPT_OPTION_STRUCT.pack(code, len(value)) + value
+
+def parse_opt_rdata(text):
+    raise DNSClientException("OPT records only exist on the wire")
+
+def format_data(rdata):
+    return rdata.DATA
+
+def format_fields(rdata):
+    return " ".join(str(field) for field in rdata.DATA)
+
+
+RecordType = namedtuple("RecordType", ["code", "name", "label", "decoder", "encoder", "parser", "formatter",
+                                       "columns"])
+RECORD_TYPES = {}   # type code -> RecordType, the one table every section, printer and CLI flag goes through
+QUERY_TYPES = {}    # type name -> type code, for the types that can be asked for in a question
+
+def register_record_type(code, name, decoder, encoder, parser, formatter=format_data, columns=None, label=None,
+                         query=True):
+    """Registers how a record type is decoded, encoded, parsed from zone file text and presented. formatter gives the
+    presentation format of the RDATA, columns the fields printed by the command line client (formatter by default)"""
+    record_type = RecordType(code, name, label or name, decoder, encoder, parser, formatter, columns or formatter)
+    RECORD_TYPES[code] = record_type
+    if query:
+        QUERY_TYPES[name] = code
+    return record_type
+
+register_record_type(0x0001, "A", decode_a_rdata, encode_a_rdata, parse_text_rdata, label="IP")
+register_record_type(0x0002, "NS", decode_name_rdata, encode_name_rdata, parse_text_rdata)
+register_record_type(0x0005, "CNAME", decode_name_rdata, encode_name_rdata, parse_text_rdata)
+register_record_type(0x0006, "SOA", decode_soa_rdata, encode_soa_rdata, parse_soa_rdata, format_fields)
+register_record_type(0x000c, "PTR", decode_name_rdata, encode_name_rdata, parse_text_rdata)
+register_record_type(0x000f, "MX", decode_mx_rdata, encode_mx_rdata, parse_mx_rdata,
+                     lambda rdata: "{} {}".format(rdata.PREFERENCE, rdata.EXCHANGE),
+                     lambda rdata: "{} \t {}".format(rdata.EXCHANGE, rdata.PREFERENCE))
+register_record_type(0x0010, "TXT", decode_txt_rdata, encode_txt_rdata, parse_txt_rdata, format_txt_rdata)
+register_record_type(0x001c, "AAAA", decode_aaaa_rdata, encode_aaaa_rdata, parse_text_rdata)
+register_record_type(0x0021, "SRV", decode_srv_rdata, encode_srv_rdata, parse_srv_rdata, format_fields)
+register_record_type(OPT_TYPE, "OPT", decode_opt_rdata, encode_opt_rdata, parse_opt_rdata, format_fields,
+                     query=False)   # a pseudo record carrying EDNS0, never asked for
+register_record_type(0x0101, "CAA", decode_caa_rdata, encode_caa_rdata, parse_caa_rdata,
+                     lambda rdata: '{} {} "{}"'.format(rdata.DATA.FLAGS, rdata.DATA.TAG, rdata.DATA.VALUE))
+
+class ResponseCache:
+    """Bounded LRU cache of decoded responses, expired by the minimum TTL of the answer (or SOA for negative answers).
+    With a stale_ttl, expired entries are kept that much longer so they can still be served when the upstream is
+    unreachable (RFC 8767)"""
+    STALE_ANSWER_TTL = 30   # TTL given to stale records, as recommended by RFC 8767
+
+    def __init__(self, max_entries=10000, max_bytes=None, max_ttl=86400, clock=time.monotonic, stale_ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.entries = OrderedDict()    # (name, qtype, qclass) -> (stored, expires, response, size)
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def get_key(name, qtype, qclass=0x0001):
+        return (name.rstrip(".").lower(), qtype, qclass)
+
+    @staticmethod
+    def get_ttl(response):
+        "Returns how long a response may be cached, or None if it must not be cached"
+        if response.header.FLAGS.TC:
+            return None
+        rcode = response.header.FLAGS.RCODE
+        if rcode == 0 and response.answer:
+            return min(record.TTL for record in response.answer)
+        if rcode in (0, 3):     # NODATA and NXDOMAIN are cached for the SOA minimum (RFC 2308)
+            for record in response.authority:
+                if record.TYPE == 0x0006:
+                    return min(record.TTL, record.RDATA.DATA.MINIMUM)
+        return None
+
+    @staticmethod
+    def age_records(records, age, max_ttl=None):
+        # the TTL of an OPT record holds EDNS flags and is kept as is
+        return [DNSPacket.Answer(record.NAME, record.TYPE, record.CLASS,
+                                 record.TTL if record.TYPE == OPT_TYPE else
+                                 max(0, record.TTL - age) if max_ttl is None else min(record.TTL, max_ttl),
+                                 record.RDLENGTH, record.RDATA) for record in records]
+
+    @classmethod
+    def age_response(cls, response, age, stale=False):
+        "Copies a response with its TTLs decremented by age, or capped to STALE_ANSWER_TTL when it is stale"
+        max_ttl = cls.STALE_ANSWER_TTL if stale else None
+        return DNSPacket(response.header, response.question, cls.age_records(response.answer, age, max_ttl),
+                         cls.age_records(response.authority, age, max_ttl),
+                         cls.age_records(response.additional, age, max_ttl))
+
+    def put(self, response, size=None):
+        if response.question is None:
+            return False
+        ttl = self.get_ttl(response)
+        if not ttl:
+            return False
+
+        if size is None:
+            size = HEADER_STRUCT.size + sum(RR_STRUCT.size + len(record.NAME) + record.RDLENGTH
+                                            for record in response.answer + response.authority + response.additional)
+        key = self.get_key(response.question.QNAME, response.question.QTYPE, response.question.QCLASS)
+        if key in self.entries:
+            self.remove(key)
+
+        now = self.clock()
+        self.entries[key] = (now, now + min(ttl, self.max_ttl), response, size)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+        return key in self.entries
+
+    def get_entry(self, name, qtype, qclass=0x0001):
+        "Returns (stored, expires, response) for an entry that is fresh or within the stale window, or None"
+        key = self.get_key(name, qtype, qclass)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.clock() >= entry[1] + self.stale_ttl:
+            self.remove(key)
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[:3]
+
+    def get(self, name, qtype, qclass=0x0001, allow_stale=False):
+        "Returns the cached response with its TTLs decremented by the age of the entry, or None"
+        entry = self.get_entry(name, qtype, qclass)
+        now = self.clock()
+        if entry is None or (now >= entry[1] and not allow_stale):
+            self.misses += 1
+            return None
+
+        stored, expires, response = entry
+        self.hits += 1
+        return self.age_response(response, int(now - stored), now >= expires)
+
+    def remove(self, key):
+        self.bytes -= self.entries.pop(key)[3]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+class RTTEstimator:
+    "Smoothed round trip time and its variance for one server, giving adaptive retransmission timeouts (RFC 6298)"
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+
+    def __init__(self, initial_rto=0.5, min_rto=0.05, max_rto=10.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.samples = 0
+        self.timeouts = 0
+
+    def observe(self, rtt):
+        "Adds a round trip time measured on a query that was not retransmitted (Karn's algorithm)"
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + self.K * self.rttvar))
+        self.samples += 1
+
+    def timed_out(self):
+        # the backoff is applied per query by get_timeout, so concurrent queries timing out do not compound it
+        self.timeouts += 1
+
+    def get_timeout(self, attempt, limit=None):
+        "Timeout for the given retransmission: exponential backoff of the RTO with +/-20% jitter"
+        timeout = min(self.max_rto, self.rto * (2 ** attempt)) * random.uniform(0.8, 1.2)
+        return timeout if limit is None else min(timeout, limit)
+
+    def to_dict(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto, "samples": self.samples,
+                "timeouts": self.timeouts}
+
+
+RTT_ESTIMATORS = {}     # (server, port) -> RTTEstimator, kept for the life of the process
+
+def get_rtt_estimator(server, port=53):
+    key = (server.replace("@", ""), port)
+    estimator = RTT_ESTIMATORS.get(key)
+    if estimator is None:
+        estimator = RTT_ESTIMATORS[key] = RTTEstimator()
+    return estimator
+
+
+class ServerHealth:
+    "Recent latency and error rate of one upstream, with a circuit breaker that benches it after repeated failures"
+    ERROR_DECAY = 0.2       # weight of the newest outcome in the error rate
+    MIN_SAMPLES = 5         # latencies needed before a percentile is trusted for hedging
+
+    def __init__(self, rtt_estimator, failure_threshold=2, cool_off=30.0, max_samples=100, clock=time.monotonic):
+        self.rtt_estimator = rtt_estimator
+        self.failure_threshold = failure_threshold
+        self.cool_off = cool_off
+        self.clock = clock
+        self.latencies = deque(maxlen=max_samples)
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = None  # the circuit is open, and the server skipped, until this time
+
+        self.successes = 0
+        self.failures = 0
+        self.circuit_opened = 0
+
+    def record_success(self, rtt=None):
+        if rtt is not None:
+            self.latencies.append(rtt)
+        self.error_rate *= 1 - self.ERROR_DECAY
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.successes += 1
+
+    def record_failure(self):
+        "Counts a timeout, SERVFAIL or REFUSED, opening the circuit once failure_threshold of them happen in a row"
+        self.error_rate = (1 - self.ERROR_DECAY) * self.error_rate + self.ERROR_DECAY
+        self.consecutive_failures += 1
+        self.failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            # after the cool-off a single trial query is let through, and one more failure opens it again
+            self.open_until = self.clock() + self.cool_off
+            self.circuit_opened += 1
+
+    def is_available(self):
+        return self.open_until is None or self.clock() >= self.open_until
+
+    def score(self):
+        "Expected cost of a query in seconds: the smoothed RTT plus the timeout paid for each expected failure"
+        estimator = self.rtt_estimator
+        latency = estimator.srtt if estimator.srtt is not None else estimator.rto
+        return latency + self.error_rate * estimator.rto
+
+    def get_latency_percentile(self, percentile):
+        "Returns the given percentile (0-1) of recent latencies, or None until enough of them were measured"
+        if len(self.latencies) < self.MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+    def to_dict(self):
+        return {"score": self.score(), "error_rate": self.error_rate, "available": self.is_available(),
+                "successes": self.successes, "failures": self.failures, "circuit_opened": self.circuit_opened,
+                "p50": self.get_latency_percentile(0.5), "p90": self.get_latency_percentile(0.9),
+                "rtt": self.rtt_estimator.to_dict()}
+
+
+SERVER_HEALTH = {}      # (server, port) -> ServerHealth, kept for the life of the process
+
+def get_server_health(server, port=53):
+    key = (server.replace("@", ""), port)
+    health = SERVER_HEALTH.get(key)
+    if health is None:
+        health = SERVER_HEALTH[key] = ServerHealth(get_rtt_estimator(server, port))
+    return health
+
+
+def parse_servers(servers):
+    "Returns the upstream addresses of a comma separated string, or of a list, without their @ prefix"
+    if isinstance(servers, str):
+        servers = servers.split(",")
+    return [server.strip().replace("@", "") for server in servers if server.strip()]
+
+
+def select_upstreams(servers, port=53):
+    "Orders servers from best to worst: available ones by score, then those with an open circuit as a last resort"
+    health = {server: get_server_health(server, port) for server in servers}
+    available = [server for server in servers if health[server].is_available()]
+    benched = [server for server in servers if not health[server].is_available()]
+    return (sorted(available, key=lambda server: health[server].score()) +
+            sorted(benched, key=lambda server: health[server].open_until))
+
+
+class TCPConnection:
+    "Persistent TCP connection to one server using 2 byte length framing, reused across queries (RFC 7766)"
+
+    def __init__(self, server, port=53, timeout=5):
+        self.server = server.replace("@", "")
+        self.port = port
+        self.timeout = timeout
+        self.socket = None
+        self.unclaimed = {}     # ID -> response read while waiting for another query
+        self.queries = 0
+        self.connects = 0
+
+    def connect(self):
+        self.close()
+        self.socket = socket.create_connection((self.server, self.port), timeout=self.timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connects += 1
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.unclaimed.clear()
+
+    def receive_exactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                raise ConnectionResetError("TCP connection closed by the DNS server")
+            data += chunk
+        return bytes(data)
+
+    def receive(self):
+        return self.receive_exactly(ID_STRUCT.unpack(self.receive_exactly(2))[0])
+
+    def send(self, packets):
+        self.socket.sendall(b"".join(ID_STRUCT.pack(len(packet)) + packet for packet in packets))
+
+    def query_many(self, packets):
+        "Pipelines every packet on the connection and returns the responses in the same order, however they arrive"
+        for attempt in range(2):
+            if self.socket is None:
+                self.connect()
+            try:
+                self.send(packets)
+                responses = [self.wait_for(ID_STRUCT.unpack_from(packet)[0]) for packet in packets]
+                self.queries += len(packets)
+                return responses
+            except (ConnectionError, BrokenPipeError):
+                # the server may close idle connections, so a failure on a reused connection is retried once
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def query(self, packet):
+        return self.query_many([packet])[0]
+
+    def wait_for(self, ID):
+        while ID not in self.unclaimed:
+            response = self.receive()
+            self.unclaimed[ID_STRUCT.unpack_from(response)[0]] = response
+        return self.unclaimed.pop(ID)
+
+
+TCP_CONNECTIONS = {}    # (server, port) -> TCPConnection
+
+def get_tcp_connection(server, port=53, timeout=5):
+    key = (server.replace("@", ""), port)
+    connection = TCP_CONNECTIONS.get(key)
+    if connection is None:
+        connection = TCP_CONNECTIONS[key] = TCPConnection(*key, timeout=timeout)
+    connection.timeout = timeout
+    if connection.socket is not None:
+        connection.socket.settimeout(timeout)
+    return connection
+
+
+def get_response_key(data):
+    "Returns the (ID, QNAME, QTYPE, QCLASS) a response answers, used to find the query waiting for it"
+    try:
+        header = DNSPacket.Header.unpack_from(data)
+        question, _ = DNSPacket.Question.unpack_from(data, HEADER_STRUCT.size)
+    except DECODE_ERRORS as e:
+        raise DNSMalformedPacketException("Malformed packet: {}".format(e), offset=HEADER_STRUCT.size)
+    return (header.ID, question.QNAME.rstrip(".").lower(), question.QTYPE, question.QCLASS)
+
+
+class QueryResult:
+    """Outcome of Resolver.resolve: the decoded response with its records, RCODE and AA flag, the server that answered
+    and how long it took. events lists what happened on the way as (event, server, detail) tuples, where event is
+    send, hedge, timeout, response, rcode (an error RCODE made the query move on) or tcp"""
+    __slots__ = ("name", "qtype", "response", "server", "response_time", "retries", "from_cache", "tcp", "events")
+
+    def __init__(self, name, qtype, response=None, server=None, response_time=None, retries=0, from_cache=False,
+                 tcp=False, events=None):
+        self.name = name
+        self.qtype = qtype
+        self.response = response
+        self.server = server
+        self.response_time = response_time
+        self.retries = retries
+        self.from_cache = from_cache
+        self.tcp = tcp
+        self.events = [] if events is None else events
+
+    @property
+    def rcode(self):
+        return None if self.response is None else self.response.header.FLAGS.RCODE
+
+    @property
+    def authoritative(self):
+        return None if self.response is None else bool(self.response.header.FLAGS.AA)
+
+    @property
+    def answer(self):
+        return [] if self.response is None else self.response.answer
+
+    @property
+    def authority(self):
+        return [] if self.response is None else self.response.authority
+
+    @property
+    def additional(self):
+        return [] if self.response is None else self.response.additional
+
+    def to_dict(self):
+        return {"name": self.name, "type": self.qtype, "server": self.server, "rcode": self.rcode,
+                "aa": self.authoritative, "answers": [record.to_dict() for record in self.answer],
+                "authority": [record.to_dict() for record in self.authority],
+                "additional": [record.to_dict() for record in self.additional if record.TYPE != OPT_TYPE],
+                "time": self.response_time, "retries": self.retries, "cached": self.from_cache, "tcp": self.tcp}
+
+
+class Resolver:
+    """Resolves names against one or more upstream servers on a long-lived UDP socket. resolve() returns a QueryResult
+    and raises a DNSClientException subclass instead of printing anything"""
+
+    def __init__(self, servers, port=53, timeout=5, retries=3, deadline=None,
+                 udp_payload_size=DEFAULT_UDP_PAYLOAD_SIZE, hedge=None, cache=RESPONSE_CACHE, stats=STATS,
+                 recursion_desired=True, capture=None):
+        self.servers = parse_servers(servers)
+        if not self.servers:
+            raise DNSClientException("No DNS server given")
+        self.port = port
+        self.timeout = timeout  # upper bound of each retransmission timeout, which adapts to the measured RTT
+        self.retries = retries
+        self.deadline = deadline if deadline is not None else timeout * (retries + 1)
+        self.udp_payload_size = udp_payload_size
+        self.hedge = hedge      # latency percentile after which a duplicate query goes to the next best server
+        self.cache = cache
+        self.stats = stats
+        self.recursion_desired = recursion_desired  # without it, answers from servers lacking RA are accepted
+        self.capture = capture  # CaptureWriter logging every raw query and response
+        self.socket = None
+
+        self.queries = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.truncated = 0
+        self.hedged = 0
+
+    def open(self):
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return self
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def select_upstreams(self, servers=None):
+        return select_upstreams(self.servers if servers is None else servers, self.port)
+
+    def resolve(self, name, qtype="A", servers=None):
+        "Resolves a name against the configured servers, or for this query only against `servers`"
+        if DNSPacket.Question.get_q_num(qtype) is None:
+            raise DNSClientException("Unsupported query type: {}".format(qtype))
+        timer = self.stats.start(qtype)
+        packet = DNSPacket.get_request_dns_packet(name, qtype, self.udp_payload_size, self.recursion_desired)
+        question = packet.question
+        if self.cache is not None:
+            cached = self.cache.get(question.QNAME, question.QTYPE, question.QCLASS)
+            if cached is not None:
+                return self.check_result(QueryResult(name, qtype, cached, from_cache=True),
+                                         recursion_desired=self.recursion_desired)
+
+        self.open()
+        request = packet.to_bytes()
+        key = (packet.header.ID, question.QNAME.rstrip(".").lower(), question.QTYPE, question.QCLASS)
+        result = QueryResult(name, qtype)
+        transmissions = {}  # server -> number of times the query was sent to it
+        sent = {}   # server -> time the query was last sent to it, kept so a late reply to an earlier attempt counts
+        ranked = self.select_upstreams(servers)
+        deadline = time.monotonic() + self.deadline
+        self.queries += 1
+        if timer is not None:
+            timer.mark("encode")
+
+        server = ranked[0]
+        attempt = 0
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if attempt > 0:
+                self.retransmissions += 1
+            # retries move on to the next best upstream, and a hedged duplicate goes to the one after it
+            server = ranked[attempt % len(ranked)]
+            health = get_server_health(server, self.port)
+            hedge = hedge_delay = None
+            if self.hedge is not None and len(ranked) > 1:
+                hedge = ranked[(attempt + 1) % len(ranked)]
+                hedge_delay = health.get_latency_percentile(self.hedge)
+            timeout = max(0.001, health.rtt_estimator.get_timeout(attempt, min(self.timeout, remaining)))
+
+            attempt_start = time.perf_counter()
+            self.send(request, server, sent, transmissions, result)
+            if timer is not None:
+                timer.mark("send")
+            try:
+                data, server = self.receive(request, key, sent, transmissions, timeout, hedge, hedge_delay, result)
+            except socket.timeout:
+                if timer is not None:
+                    timer.mark("retry")
+                for sent_to in [sent_to for sent_to, sent_at in sent.items() if sent_at >= attempt_start]:
+                    self.stats.count_timeout(sent_to, qtype)
+                    get_server_health(sent_to, self.port).rtt_estimator.timed_out()
+                    get_server_health(sent_to, self.port).record_failure()
+                    result.events.append(("timeout", sent_to, None))
+                continue
+
+            response_time = time.perf_counter() - sent[server]
+            # a late reply from the server of an earlier attempt completes the query but is not timed
+            timed = sent[server] >= attempt_start
+            if timer is not None:
+                timer.mark("wait")
+            if self.capture is not None:
+                self.capture.write(request, data, server, self.port)
+            health = get_server_health(server, self.port)
+            if timed and transmissions[server] == 1:
+                health.rtt_estimator.observe(response_time)
+            result.events.append(("response", server, (response_time, attempt)))
+            response = self.decode(data, result)
+            if timer is not None:
+                timer.mark("decode")
+
+            rcode = response.header.FLAGS.RCODE
+            self.stats.count_rcode(server, qtype, rcode)
+            if rcode in (2, 5):     # SERVFAIL or REFUSED
+                health.record_failure()
+                if len(ranked) > 1 and attempt < self.retries and time.monotonic() < deadline:
+                    result.events.append(("rcode", server, rcode))
+                    continue
+            else:
+                health.record_success(response_time if timed else None)
+
+            if response.header.FLAGS.TC:
+                self.truncated += 1
+                self.stats.count_truncated(server, qtype)
+                result.events.append(("tcp", server, None))
+                data = self.query_tcp(request, server, result)
+                if self.capture is not None:
+                    self.capture.write(request, data, server, self.port)
+                response = self.decode(data, result)
+                result.tcp = True
+            if timer is not None:
+                timer.finish(server)
+
+            result.response = response
+            result.server = server
+            result.response_time = response_time
+            result.retries = attempt
+            return self.check_result(result, self.cache, len(data), self.recursion_desired)
+
+        self.timeouts += 1
+        if timer is not None:
+            timer.finish(server)
+        if time.monotonic() >= deadline:
+            raise DNSTimeoutException("Query deadline exceeded after {} retries".format(attempt), result)
+        raise DNSTimeoutException("Maximum number of retries exceeded: {}".format(self.retries), result)
+
+    def send(self, request, server, sent, transmissions, result):
+        sent[server] = time.perf_counter()
+        transmissions[server] = transmissions.get(server, 0) + 1
+        result.events.append(("send", server, None))
+        try:
+            self.socket.sendto(request, (server, self.port))
+        except OSError as e:
+            raise DNSClientException("Unable to send the query to {}: {}".format(server, e), result)
+
+    def receive(self, request, key, sent, transmissions, timeout, hedge, hedge_delay, result):
+        """Waits for the answer to the query from any server it was sent to, skipping stray datagrams, and sends the
+        query to `hedge` too when nothing arrived within `hedge_delay`. Returns (data, server)"""
+        end = time.perf_counter() + timeout
+        hedge_at = None
+        if hedge is not None and hedge_delay is not None and hedge_delay < timeout:
+            hedge_at = time.perf_counter() + hedge_delay
+        buffer_size = max(512, self.udp_payload_size or 0)
+        while True:
+            now = time.perf_counter()
+            if hedge_at is not None and now >= hedge_at:
+                self.hedged += 1
+                result.events.append(("hedge", hedge, hedge_delay))
+                self.send(request, hedge, sent, transmissions, result)
+                hedge_at = None
+            wait = (end if hedge_at is None else min(end, hedge_at)) - now
+            if wait <= 0:
+                raise socket.timeout("timed out")
+            self.socket.settimeout(wait)
+            try:
+                data, addr = self.socket.recvfrom(buffer_size)
+            except socket.timeout:
+                continue
+            except OSError:
+                continue    # ICMP errors from earlier sends, the query is retried once its timeout passes
+
+            try:
+                matched = addr[0] in sent and get_response_key(data) == key
+            except (IndexError, struct.error, DNSClientException):
+                matched = False
+            if matched:
+                return (data, addr[0])
+            # late answers to earlier queries on this socket, or replies with the wrong ID or question
+            self.unmatched += 1
+            self.stats.count_id_mismatch(addr[0])
+
+    def query_tcp(self, request, server, result):
+        "Repeats a truncated query over the persistent TCP connection to the server"
+        connection = get_tcp_connection(server, self.port, self.timeout)
+        try:
+            return connection.query(request)
+        except socket.timeout:
+            connection.close()
+            self.timeouts += 1
+            raise DNSTimeoutException("No TCP response after {} seconds".format(self.timeout), result)
+        except OSError as e:
+            connection.close()
+            raise DNSClientException("TCP fallback failed: {}".format(e), result)
+
+    def decode(self, data, result):
+        try:
+            return decode_response(data, self.stats)
+        except DNSMalformedPacketException as e:
+            e.result = result
+            raise
+
+    @staticmethod
+    def check_result(result, cache=None, size=None, recursion_desired=True):
+        "Raises the exception matching an unusable response, or returns the result. Usable responses are cached"
+        response = result.response
+        if response.header.QDCOUNT != 1:
+            raise DNSUnexpectedResponseException("Unexpected response: expecting 1 question from DNS Server but "
+                                                 "received {}".format(response.header.QDCOUNT), result)
+        if recursion_desired and response.header.FLAGS.RA == 0b0:
+            raise DNSUnexpectedResponseException("Unexpected response: DNS Server does not support recursive queries",
+                                                 result)
+        if cache is not None:
+            cache.put(response, size)    # NXDOMAIN and NODATA answers are cached too (RFC 2308)
+        if response.header.FLAGS.RCODE in RCODE_EXCEPTIONS:
+            exception, message = RCODE_EXCEPTIONS[response.header.FLAGS.RCODE]
+            raise exception(message, result)
+        return result
+
+
 def seperate_string(string, spacers):
     return ' '.join(string[i:i + spacers] for i in range(0, len(string), spacers))
 
@@ -276,108 +1380,35 @@ def getTTL(data, pointer):
     return ttl
 
 def get_alias(data, pointer):
-    cname = []
-
-    while True:
-        label_length = data[pointer]
-        if (label_length == 0xC0):
-            pointer = data[pointer + 1]     # Sets the pointer to the pointed address
-            label_length = data[pointer]
-
-        labels = []
-        for i in range(pointer + 1, pointer + label_length + 1):
-            labels.append(chr(data[i]))
-        cname.append(''.join(labels))
-        
-        pointer += label_length + 1
-        if (data[pointer] == 0):
-            break
-    alias = '.'.join(cname)
-    return alias
+    return read_name(data, pointer)[0]
 
 def get_ip_address(data, pointer):
-    counter = 0
-    sections = []
-    ip = []
-    while counter < 4:
-        sections.append(data[pointer])
-        counter += 1
-        pointer += 1
-
-    for i in sections:
-        ip.append(str(i))
-
-    ip = '.'.join(ip)
-    return ip
+    if pointer + 4 > len(data):
+        raise DNSMalformedPacketException("Address runs past the end of the packet", offset=pointer)
+    return '.'.join(str(octet) for octet in data[pointer:pointer + 4])
 
 def get_additional_information(data, pointer, additionalRecordsNum):
     print(f"*** Additional Section ({additionalRecordsNum} records) ***\n")
     authorityBit = (data[2] & 32) >> 5
     aCounter = 0
 
-    auth = "nonauth"
-    if authorityBit == 1:
-        auth = "auth"
-    # Iterates through response records
+    # Iterates through response records, types without a decoder are skipped by their RDLENGTH
     while aCounter < additionalRecordsNum:
-        # Finds byte after 'NAME' field in response
-
-        while True:
-            # Checks if we hit ending byte '0' and pointer to location after accordingly
-            if (data[pointer] == 0):
-                pointer += 1
-                break;
-            
-            if ((data[pointer] & 0xC0) == 0xC0):
-                pointer += 2
-                break;
-
-            pointer += 1
-
+        try:
+            record, pointer = DNSPacket.Answer.unpack_from(data, pointer)
+        except DECODE_ERRORS as e:
+            raise DNSMalformedPacketException("Malformed packet at byte {}: {}".format(pointer, e), offset=pointer)
+        if record.TYPE in RECORD_TYPES:
+            print(record.__str__(authorityBit))
         aCounter += 1
-        
-        # Check type
-        type = data[pointer] << 8 | data[pointer + 1]
-        pointer += 4    # Beginning of TTL bytes
-        match type:
-            case 5:
-                ttl = getTTL(data, pointer)
-                pointer += 4    # Beginning of the RDLength
-                rdlength = data[pointer] << 8 | data[pointer + 1]
-                pointer += 2    # Beginning of RData
-                alias = get_alias(data, pointer)
-                pointer += rdlength ## Beginning of next answer
-                print(f"CNAME \t {alias} \t {ttl} \t {auth}\n")
-            case 1:
-                ttl = getTTL(data, pointer)
-                pointer += 6 # go straight to RData
-                ip = get_ip_address(data, pointer)
-                pointer +=4 # Beginning of next answer
-                print(f"IP \t {ip} \t {ttl} \t {auth}\n")
-            case 2:
-                ttl = getTTL(data, pointer)
-                pointer += 4
-                rdlength = data[pointer] << 8 | data[pointer + 1]
-                pointer += 2
-                alias = get_alias(data,pointer)
-                pointer += rdlength
-                print(f"NS \t {alias} \t {ttl} \t {auth}\n")
-            case 15:
-                ttl = getTTL(data, pointer)
-                pointer += 4
-                rdlength = data[pointer] << 8 | data[pointer + 1]
-                pointer += 2
-                pref = data[pointer] << 8 | data[pointer + 1]
-                pointer += 2
-                alias = get_alias(data, pointer)
-                pointer += rdlength
-                print(f"MX \t {alias} \t {pref} \t {ttl} \t {auth}\n")
     return pointer
 
 
 
 def get_response_information(data, question, request_header):
-    header = DNSPacket.Header.unpack(data[0:11])
+    if len(data) < HEADER_STRUCT.size:
+        raise DNSMalformedPacketException("Response shorter than a DNS header", offset=0)
+    header = DNSPacket.Header.unpack(data[0:HEADER_STRUCT.size])
 
     if header.FLAGS.RA == 0b0: # since we always want recursion
         print_error("Unexpected response: DNS Server does not support recursive queries")
@@ -424,123 +1455,269 @@ def get_response_information(data, question, request_header):
 
     allAnswers = []
     while aCounter < numAnswers:
-        # Finds byte after 'NAME' field in response
-
-        starting_pointer = pointer
-        
-        while True:
-            # Checks if we hit ending byte '0' and pointer to location after accordingly
-            if (data[pointer] == 0):
-                pointer += 1
-                break;
-            
-            if ((data[pointer] & 0xC0) == 0xC0): # since labels are 63 octets long
-                pointer += 2
-                break;
-
-            pointer += 1
-
+        # Reads the 'NAME' field, which leaves the pointer on the fixed part of the record
         try:
-            answer, pointer = DNSPacket.Answer.unpack(data, data[pointer-starting_pointer], pointer)
-        except DNSClientException:
-            raise DNSClientException() # persist exception
+            name, pointer = read_name(data, pointer)
+            answer, pointer = DNSPacket.Answer.unpack(data, name, pointer)
+        except DECODE_ERRORS as e:
+            raise DNSMalformedPacketException("Malformed packet at byte {}: {}".format(pointer, e), offset=pointer)
 
-        if answer == None:
-            print_error("Unexpected response: invalid DNS Packet Type Received")
-            raise DNSClientException()
-        else:
+        if answer is not None:     # unknown types are skipped
             allAnswers.append(answer)
         aCounter += 1
         
     return (allAnswers, authorityBit, pointer)
 
-def print_error(message):
-    print("ERROR \t {}".format(message))
-
-def main(args):
-    if args.server.replace("@","").count('.') != 3 or re.search("[a-zA-Z]", args.server.replace("@","")): # a.b.c.d format and regex for no alpha
-        print_error("Invalid DNS server provided. The server should only contain numbers, 3 periods (.), and @ symbol.")
+def print_cached_response(response):
+    print(f"Response served from cache for [{response.question.QNAME}]\n")
+    if response.header.FLAGS.RCODE == 3:
+        print("NOT FOUND Name error: meaningful only for responses from an authoritative name server, this code signifies that the domain name referenced in the query does not exist")
         return 0
 
-    for octet in args.server.replace("@","").split("."):
-        if int(octet) > 255:
-            print_error("Invalid DNS server provided. IPV4 octets cannot exceed 255.")
-            return 0
-
-    if args.mx:
-        requestType = "MX"
-    elif args.ns:
-        requestType = "NS"
-    else:
-        requestType = "A"
-
-    flags = DNSPacket.Header.Flags.get_request_flags(0b0)  # how to handle truncating ?
-    header = DNSPacket.Header.get_request_header(flags)
-    question = DNSPacket.Question.get_request_question(args.name, requestType)
-
-    dnsPacket = DNSPacket(header, question, answer=None)
+    print(f"*** Answers Section ({len(response.answer)} records) ***\n")
+    for answer in response.answer:
+        print(answer.__str__(response.header.FLAGS.AA))
+    if not response.answer:
+        print("NOT FOUND\n")
+    return 1
 
-    retries = 0
-    response_received = False
+def decode_response(data, stats=STATS):
+    "Decodes a response with DNSPacket.unpack, through the decode hook of the stats when one is set"
+    hook = stats.decode_hook
+    return DNSPacket.unpack(data) if hook is None else hook(DNSPacket.unpack, data)
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(args.t)
-    s.connect((args.server.replace("@",''), args.p))
+def print_error(message):
+    print("ERROR \t {}".format(message))
 
-    while not response_received:
+def udp_payload_size(text):
+    "Parses --edns: a UDP payload size that fits the 16 bit CLASS of the OPT record, 0 disabling EDNS0"
+    size = int(text)
+    if not 0 <= size <= 0xFFFF:
+        raise argparse.ArgumentTypeError("UDP payload size must be between 0 and 65535, got {}".format(size))
+    return size
 
-        print(f"DnsClient sending request for [{dnsPacket.question.QNAME}] \nServer: [{args.server.replace('@','')}] \nRequest type: [{dnsPacket.get_q_type(dnsPacket.question.QTYPE)}]\n")
+def validate_server(server):
+    if "," in server:
+        return all(validate_server(upstream) for upstream in server.split(","))
 
-        startTime = time.time()
-        s.send(bytes.fromhex(dnsPacket.__str__()))
+    if server.replace("@","").count('.') != 3 or re.search("[a-zA-Z]", server.replace("@","")): # a.b.c.d format and regex for no alpha
+        print_error("Invalid DNS server provided. The server should only contain numbers, 3 periods (.), and @ symbol.")
+        return False
 
-        try:
-            while True:
-                data = s.recv(1024)
-                endTime = time.time()
-                responseTime = endTime - startTime
+    for octet in server.replace("@","").split("."):
+        if int(octet) > 255:
+            print_error("Invalid DNS server provided. IPV4 octets cannot exceed 255.")
+            return False
+    return True
+
+def print_result_events(result):
+    "Prints the progress of a query from the events of its QueryResult"
+    if result.from_cache:
+        print(f"Response served from cache for [{result.response.question.QNAME}]\n")
+        return
+    for event, server, detail in result.events:
+        match event:
+            case "send":
+                print(f"DnsClient sending request for [{result.name}] \nServer: [{server}] \nRequest type: [{result.qtype}]\n")
+            case "hedge":
+                print(f"No answer after {detail * 1000:.1f} ms, hedging to [{server}]\n")
+            case "response":
+                print(f"Response received from [{server}] after {detail[0]} seconds ({detail[1]} retries)\n")
+            case "rcode":
+                print(f"Server [{server}] answered with RCODE {detail}, trying the next server\n")
+            case "referral":
+                print(f"Server [{server}] referred the query to zone [{detail}]\n")
+            case "tcp":
+                print("Response truncated, retrying over TCP\n")
+    if result.response is not None and result.response.header.FLAGS.RA:
+        print("DNS Server supports recursive querries. \n")
 
-                print(f"Response received after {responseTime} seconds ({retries} retries)\n")
+def print_result(result):
+    print_result_events(result)
+    if result.from_cache:
+        return print_cached_response(result.response)
 
-                if data is not None:
-                    try:
-                        answers, authorityBit, pointer = get_response_information(data, question, header)
-                    except DNSClientException:
-                        return 0
+    authorityBit = result.response.header.FLAGS.AA
+    print(f"*** Answers Section ({len(result.answer)} records) ***\n")
+    for answer in result.answer:
+        print(answer.__str__(authorityBit))
 
-                    for answer in answers:
-                        print(answer.__str__(authorityBit))
+    if result.additional:
+        print(f"*** Additional Section ({len(result.additional)} records) ***\n")
+        for record in result.additional:
+            print(record.__str__(authorityBit))
+    else:
+        print("NOT FOUND\n")
+    return 1
 
-                    additionalRecords = data[10] << 8 | data[11]
-                    if (additionalRecords > 0):
-                        get_additional_information(data, pointer, additionalRecords)
-                    else:
-                        print("NOT FOUND\n")
+def get_resolver(args, cache, capture=None):
+    "Resolver for a command line query over UDP, iterative when asked to"
+    if getattr(args, "iterative", False):
+        from dnsIterative import IterativeResolver
+        return IterativeResolver(args.server, args.p, timeout=args.t, retries=args.r,
+                                 udp_payload_size=getattr(args, "edns", DEFAULT_UDP_PAYLOAD_SIZE), cache=cache,
+                                 capture=capture)
+    return Resolver(args.server, args.p, timeout=args.t, retries=args.r, deadline=getattr(args, "deadline", None),
+                    udp_payload_size=getattr(args, "edns", DEFAULT_UDP_PAYLOAD_SIZE),
+                    hedge=getattr(args, "hedge", None), cache=cache, capture=capture)
 
-                response_received = True
-                break
-        except socket.error:
-            if retries >= args.r:
-                print_error("Maximum number of retries exceeded: {}".format(args.r))
-                return 0
+def main(args):
+    if not validate_server(args.server):
+        return 0
 
-            retries += 1
-            continue
-    return 1
+    if args.mx:
+        requestType = "MX"
+    elif args.ns:
+        requestType = "NS"
+    else:
+        requestType = (getattr(args, "type", None) or "A").upper()
+
+    cache = None if getattr(args, "no_cache", False) else RESPONSE_CACHE
+    capture = None
+    try:
+        if getattr(args, "capture", None):
+            from dnsCapture import CaptureWriter
+            capture = CaptureWriter(args.capture)
+        if getattr(args, "transport", "udp") != "udp":
+            import dnsEncrypted
+            result = dnsEncrypted.resolve(args, requestType, cache, capture)
+        else:
+            with get_resolver(args, cache, capture) as resolver:
+                result = resolver.resolve(args.name, requestType)
+    except DNSClientException as e:
+        if e.result is not None:
+            print_result_events(e.result)
+        if isinstance(e, DNSNameErrorException):
+            print(e)
+        else:
+            print_error(e)
+        return 0
+    finally:
+        if capture is not None:
+            capture.close()
+    return print_result(result)
 
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='DNS Client')
     group = parser.add_mutually_exclusive_group()
-    parser.add_argument('-t', type=int, help='Timeout, in seconds, before retransmitting an unanswered query',
-                        default=5)
+    parser.add_argument('-t', type=float, help='Maximum timeout, in seconds, before retransmitting an unanswered '
+                        'query. Shorter timeouts are used when the server is known to answer faster', default=5)
+    parser.add_argument('--deadline', type=float,
+                        help='Overall time limit, in seconds, for a query and its retries. Defaults to t * (r + 1)')
     parser.add_argument('-r', type=int,
                         help='Maximum number of times to retransmit an unanswered query before giving up', default=3)
-    parser.add_argument('-p', type=int, help='UDP port number of the DNS server', default=53)
+    parser.add_argument('-p', type=int,
+                        help='Port number of the DNS server. Defaults to 53, 853 with --transport tls and 443 with '
+                        '--transport https')
+    parser.add_argument('--transport', choices=['udp', 'tls', 'https'], default='udp',
+                        help='Send queries over UDP (falling back to TCP), DNS over TLS or DNS over HTTPS, keeping '
+                        'encrypted connections open and resuming their TLS sessions')
+    parser.add_argument('--tls-ca', metavar='FILE',
+                        help='CA certificates the DoT or DoH server certificate is checked against, instead of the '
+                        'system ones')
+    parser.add_argument('--tls-name', metavar='NAME',
+                        help='Host name the server certificate must match, and the DoH Host header. Defaults to the '
+                        'server address')
+    parser.add_argument('--doh-path', metavar='PATH', default='/dns-query', help='URL path of the DoH endpoint')
+    parser.add_argument('--connections', type=int, metavar='N',
+                        help='Encrypted connections per server that bulk queries are pipelined over. Defaults to one '
+                        'per 256 queries in flight')
     group.add_argument('-mx', action='store_true', help='Send a MX (mail server) query')  # string
     group.add_argument('-ns', action='store_true', help='Send a NS (name server) query')  # string
-    parser.add_argument('server', help='IPv4 address of the DNS server, in a.b.c.d format')  # string
-    parser.add_argument('name', help='Domain name to query for')  # string
+    group.add_argument('--type', type=str.upper, choices=sorted(QUERY_TYPES), metavar='TYPE',
+                       help='Query type: ' + ', '.join(sorted(QUERY_TYPES)))
+    parser.add_argument('--edns', type=udp_payload_size, metavar='SIZE', default=DEFAULT_UDP_PAYLOAD_SIZE,
+                        help='UDP payload size advertised with EDNS0 and used as the receive buffer, 0 disables EDNS0')
+    parser.add_argument('--no-cache', action='store_true', help='Always query the server instead of the response cache')
+    parser.add_argument('--bulk', metavar='FILE',
+                        help='Resolve every "name [type]" line of FILE (- for stdin) and print one JSON line per result')
+    parser.add_argument('--sweep', nargs='+', metavar='CIDR',
+                        help='Resolve the PTR record of every address in these IPv4 or IPv6 blocks and print one JSON '
+                        'line per address that has one')
+    parser.add_argument('--no-skip', action='store_true',
+                        help='Query every address of a --sweep block instead of skipping the ranges whose reverse '
+                        'zone does not exist')
+    parser.add_argument('--transfer', choices=['axfr', 'ixfr'], type=str.lower,
+                        help='Transfer the zone given as name over TCP, streaming each message as it arrives. AXFR '
+                        'prints the zone (or writes it to --snapshot), IXFR applies the changes since --snapshot to it')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='Zone file of "name ttl type data" lines written by --transfer axfr and kept up to date '
+                        'by --transfer ixfr')
+    parser.add_argument('--concurrency', type=int, help='Maximum number of queries in flight in bulk and sweep mode',
+                        default=100)
+    parser.add_argument('--sockets', type=int, metavar='N',
+                        help='UDP sockets, each on a random source port, that bulk and daemon queries are spread over. '
+                        'Defaults to one per 256 queries in flight in bulk mode')
+    parser.add_argument('--socket-uses', type=int, metavar='N',
+                        help='Replace a socket by one on a new random source port after it sent N queries')
+    parser.add_argument('--workers', type=int, metavar='N', default=1,
+                        help='Processes the bulk name list is sharded over, each with its own sockets and event loop')
+    parser.add_argument('--rate', type=float, metavar='QPS',
+                        help='Maximum queries per second in bulk and sweep mode, shared evenly between the workers')
+    parser.add_argument('--ordered', action='store_true',
+                        help='Write bulk results in input order instead of as they complete')
+    parser.add_argument('--reorder-buffer', type=int, metavar='N', default=10000,
+                        help='Results held back waiting for earlier names with --ordered, bounding how far reading '
+                        'runs ahead of writing')
+    parser.add_argument('--progress', type=float, metavar='SECONDS', default=5.0,
+                        help='Interval between progress reports on stderr with several workers, 0 disables them')
+    parser.add_argument('--hedge', type=float, metavar='PERCENTILE',
+                        help='Also send the query to the next best server when the chosen one has not answered within '
+                        'this percentile (0-1) of its recent latencies')
+    parser.add_argument('--iterative', action='store_true',
+                        help='Resolve without recursion, following referrals down from the server(s) given as root '
+                        'hints to the authoritative servers')
+    parser.add_argument('--daemon', type=int, metavar='PORT',
+                        help='Run a caching forwarder listening on PORT over UDP and TCP, forwarding to the server(s)')
+    parser.add_argument('--listen', metavar='ADDRESS', default='127.0.0.1',
+                        help='Address the --daemon forwarder listens on')
+    parser.add_argument('--stats', choices=['json', 'prometheus'],
+                        help='Time every query by phase and print the statistics in this format when done')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='Append every raw query and response, with its time and server, to this binary log for '
+                        'python dnsCapture.py replay. Bulk workers each write FILE.N')
+    parser.add_argument('--profile-decode', metavar='FILE',
+                        help='Profile response decoding with cProfile and write the pstats data to FILE')
+    parser.add_argument('server', help='IPv4 address of the DNS server, in a.b.c.d format. Several comma separated '
+                        'servers are ranked by recent latency and errors')  # string
+    parser.add_argument('name', nargs='?', help='Domain name to query for')  # string
+
+    args = parser.parse_args()
+    if args.p is None:
+        args.p = {'udp': 53, 'tls': 853, 'https': 443}[args.transport]
+    if args.daemon is not None and args.transport != 'udp':
+        parser.error("--transport only applies to queries and bulk mode, the forwarder's upstreams are reached over UDP")
+    if args.sweep is not None and (args.bulk is not None or args.workers > 1 or args.ordered):
+        parser.error("--sweep runs in a single process and cannot be combined with --bulk, --workers or --ordered")
+    if args.transfer is not None and args.transport != 'udp':
+        parser.error("--transfer always runs over plain TCP")
+    if args.name is None and args.bulk is None and args.sweep is None and args.daemon is None:
+        parser.error("the following arguments are required: name")
+    STATS.enabled = args.stats is not None
+    if args.profile_decode:
+        import cProfile
+        from dnsStats import cprofile_hook
+        profile = cProfile.Profile()
+        STATS.decode_hook = cprofile_hook(profile)
+
+    if args.daemon is not None:
+        import dnsForwarder
+        dnsForwarder.main(args)
+    elif args.bulk is not None:
+        import dnsBulk
+        dnsBulk.main(args)
+    elif args.sweep is not None:
+        import dnsSweep
+        dnsSweep.main(args)
+    elif args.transfer is not None:
+        import dnsTransfer
+        dnsTransfer.main(args)
+    else:
+        main(args)
 
-    main(args=parser.parse_args())
+    if args.stats is not None:
+        print(STATS.dump(args.stats))
+    if args.profile_decode:
+        profile.dump_stats(args.profile_decode)
@@ -1,6 +1,12 @@
 import unittest
+import argparse
 import time
+import struct
+import io
+import contextlib
+import dnsClient
 from dnsClient import main
+from dnsTestServer import DNSTestServer, Zone
 
 class TestParser():
     
@@ -47,6 +53,37 @@ class TestConstructDNSRequestPacket(unittest.TestCase):
         test_request_packet = dnsClient.DNSPacket(test_header, test_question, None)
         self.assertEqual(test_request_packet.__str__(), "82 7a 01 00 00 01 00 00 00 00 00 00 03 77 77 77 06 6d 63 67 69 6c 6c 02 63 61 00 00 01 00 01")
 
+    def test_request_packet_to_bytes_matches_hex_string(self):
+        test_flags = dnsClient.DNSPacket.Header.Flags(0, 0, 0, 0, 1, 0, 0, 0)
+        test_header = dnsClient.DNSPacket.Header(test_flags, 1, 0, 0, 0, 0x827a)
+        test_question = dnsClient.DNSPacket.Question("www.mcgill.ca", 1, 1)
+        test_request_packet = dnsClient.DNSPacket(test_header, test_question, None)
+        self.assertEqual(test_request_packet.to_bytes(), bytes.fromhex(test_request_packet.__str__()))
+        self.assertEqual(test_header.to_bytes() + test_question.to_bytes(), test_request_packet.to_bytes())
+
+    def test_pack_into_reuses_buffer_and_patches_id(self):
+        test_flags = dnsClient.DNSPacket.Header.Flags(0, 0, 0, 0, 1, 0, 0, 0)
+        test_question = dnsClient.DNSPacket.Question("www.mcgill.ca", 1, 1)
+        buffer = bytearray(64)
+        first = dnsClient.DNSPacket(dnsClient.DNSPacket.Header(test_flags, 1, 0, 0, 0, 0x827a), test_question, None)
+        end = first.pack_into(buffer, 4)
+        self.assertEqual(bytes(buffer[4:end]), first.to_bytes())
+
+        second = dnsClient.DNSPacket(dnsClient.DNSPacket.Header(test_flags, 1, 0, 0, 0, 0x1234), test_question, None)
+        self.assertEqual(second.pack_into(buffer, 4), end)
+        self.assertEqual(bytes(buffer[4:6]), b"\x12\x34")
+        self.assertEqual(bytes(buffer[6:end]), first.to_bytes()[2:])
+
+    def test_encode_name_rejects_long_label(self):
+        with self.assertRaises(dnsClient.DNSClientException):
+            dnsClient.encode_name("{}.com".format("a" * 64))
+        self.assertEqual(dnsClient.encode_name("mcgill.ca."), dnsClient.encode_name("mcgill.ca"))
+        self.assertEqual(dnsClient.encode_name("."), b"\x00")
+
+    def test_encode_name_rejects_non_ascii_labels(self):
+        with self.assertRaises(dnsClient.DNSClientException):
+            dnsClient.encode_name("bücher.example")
+
     def test_dns_response_to_mcgill_using_google(self):
         self.assertNotEqual(main(TestParser("8.8.8.8","mcgill.ca")), 0) # indicated an error
         self.assertEqual(main(TestParser("8.8.8.8","mcgill.ca")), 1) # exits cleanly
@@ -54,7 +91,521 @@ class TestConstructDNSRequestPacket(unittest.TestCase):
     def test_timeout_and_retry_fail(self):
         startTime = time.time()
         self.assertEqual(main(TestParser("255.255.255.255","mcgill.ca")), 0) # indicated an error
-        self.assertTrue(time.time() - startTime > 15)
+        self.assertTrue(time.time() - startTime < 20) # adaptive timeouts finish within the t * (r + 1) deadline
     
+class TestMainWithLocalServer(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+
+    def test_dns_response_using_local_server(self):
+        with DNSTestServer() as server:
+            self.assertEqual(main(TestParser("127.0.0.1", "www.example.com", port=server.port)), 1)
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port, mx=True)), 1)
+            self.assertEqual(main(TestParser("127.0.0.1", "missing.example.com", port=server.port)), 0)
+            self.assertEqual(server.udp_queries, 3)
+
+    def test_server_errors_are_reported(self):
+        with DNSTestServer(rcode=2) as server:
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port)), 0)
+        with DNSTestServer(recursion_available=False) as server:
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port)), 0)
+        with DNSTestServer(wrong_id=True) as server:
+            # the reply with the wrong ID is skipped and the real answer that follows it is used
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port)), 1)
+
+    def test_timeout_and_retry_fail_using_local_server(self):
+        with DNSTestServer(loss=1.0) as server:
+            startTime = time.time()
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port, timeout=1, retries=1)), 0)
+            self.assertTrue(time.time() - startTime < 2)
+            self.assertEqual(server.udp_queries, 2)
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+        self.server = DNSTestServer().start()
+        self.addCleanup(self.server.stop)
+
+    def resolver(self, **options):
+        resolver = dnsClient.Resolver("127.0.0.1", self.server.port, timeout=1, **options)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def test_results_are_returned_without_printing(self):
+        resolver = self.resolver(cache=None)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            result = resolver.resolve("www.example.com")
+            mx = resolver.resolve("example.com", "MX")
+        self.assertEqual(output.getvalue(), "")
+        self.assertEqual([record.RDATA.DATA for record in result.answer], ["example.com", "93.184.216.34"])
+        self.assertEqual((result.rcode, result.authoritative, result.server, result.retries), (0, True, "127.0.0.1", 0))
+        self.assertGreater(result.response_time, 0)
+        self.assertEqual([record["data"] for record in mx.to_dict()["answers"]],
+                         ["10 mail.example.com", "20 mail2.example.com"])
+
+    def test_socket_is_reused_across_queries(self):
+        resolver = self.resolver(cache=None)
+        resolver.resolve("example.com")
+        udp_socket = resolver.socket
+        resolver.resolve("example.com", "NS")
+        self.assertIs(resolver.socket, udp_socket)
+        self.assertEqual((resolver.queries, self.server.udp_queries), (2, 2))
+
+    def test_cached_answers_are_flagged(self):
+        resolver = self.resolver(cache=dnsClient.ResponseCache())
+        self.assertFalse(resolver.resolve("example.com").from_cache)
+        self.assertTrue(resolver.resolve("example.com").from_cache)
+        self.assertEqual(self.server.udp_queries, 1)
+
+    def test_errors_raise_typed_exceptions(self):
+        resolver = self.resolver(cache=None)
+        with self.assertRaises(dnsClient.DNSNameErrorException) as context:
+            resolver.resolve("missing.example.com")
+        self.assertEqual(context.exception.result.rcode, 3)
+        self.assertEqual(context.exception.result.authority[0].TYPE, 0x0006)
+
+        self.server.rcode = 5
+        with self.assertRaises(dnsClient.DNSRefusedException):
+            resolver.resolve("example.com")
+        self.server.rcode = None
+        self.server.recursion_available = False
+        with self.assertRaises(dnsClient.DNSUnexpectedResponseException):
+            resolver.resolve("example.com")
+        with self.assertRaises(dnsClient.DNSClientException):
+            resolver.resolve("example.com", "BOGUS")
+
+    def test_timeout_keeps_the_attempts(self):
+        self.server.loss = 1.0
+        resolver = self.resolver(retries=1, cache=None)
+        with self.assertRaises(dnsClient.DNSTimeoutException) as context:
+            resolver.resolve("example.com")
+        events = [event for event, _, _ in context.exception.result.events]
+        self.assertEqual(events, ["send", "timeout", "send", "timeout"])
+        self.assertEqual(resolver.timeouts, 1)
+
+    def test_stray_replies_are_skipped(self):
+        self.server.wrong_id = True
+        resolver = self.resolver(cache=None)
+        self.assertEqual(resolver.resolve("example.com").rcode, 0)
+        self.assertEqual(resolver.unmatched, 1)
+
+class TestAdaptiveRetransmission(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+
+    def test_estimator_follows_rfc_6298(self):
+        estimator = dnsClient.RTTEstimator(min_rto=0.001)
+        estimator.observe(0.1)
+        self.assertAlmostEqual(estimator.srtt, 0.1)
+        self.assertAlmostEqual(estimator.rttvar, 0.05)
+        self.assertAlmostEqual(estimator.rto, 0.3)
+        estimator.observe(0.2)
+        self.assertAlmostEqual(estimator.rttvar, 0.0625)
+        self.assertAlmostEqual(estimator.srtt, 0.1125)
+        self.assertEqual(estimator.to_dict()["samples"], 2)
+
+    def test_backoff_with_jitter_and_limits(self):
+        estimator = dnsClient.RTTEstimator(initial_rto=0.2, max_rto=1.0)
+        for attempt, expected in enumerate([0.2, 0.4, 0.8, 1.0, 1.0]):
+            timeout = estimator.get_timeout(attempt)
+            self.assertTrue(expected * 0.8 <= timeout <= expected * 1.2)
+        self.assertLessEqual(estimator.get_timeout(3, limit=0.1), 0.1)
+        estimator.timed_out()
+        self.assertAlmostEqual(estimator.rto, 0.2)
+        self.assertEqual(estimator.timeouts, 1)
+
+    def test_lost_packet_costs_a_fraction_of_the_timeout(self):
+        with DNSTestServer(latency=0.005) as server:
+            parser = TestParser("127.0.0.1", "example.com", port=server.port, timeout=5, retries=2)
+            parser.no_cache = True
+            self.assertEqual(main(parser), 1)
+            estimator = dnsClient.get_rtt_estimator("127.0.0.1", server.port)
+            self.assertEqual(estimator.samples, 1)
+            self.assertLess(estimator.rto, 0.1)
+
+            server.loss = 1.0
+            startTime = time.time()
+            self.assertEqual(main(parser), 0)
+            self.assertLess(time.time() - startTime, 1)
+            self.assertEqual(estimator.timeouts, 3)
+
+    def test_deadline_stops_retries(self):
+        with DNSTestServer(loss=1.0) as server:
+            parser = TestParser("127.0.0.1", "example.com", port=server.port, timeout=5, retries=10)
+            parser.deadline = 0.3
+            startTime = time.time()
+            self.assertEqual(main(parser), 0)
+            self.assertLess(time.time() - startTime, 1)
+            self.assertLess(server.udp_queries, 11)
+
+class TestUpstreamSelection(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+        dnsClient.SERVER_HEALTH.clear()
+        dnsClient.RTT_ESTIMATORS.clear()
+
+    def start_servers(self, primary_options, secondary_options):
+        "Starts servers on 127.0.0.1 and 127.0.0.2 sharing one port, since the port is common to all upstreams"
+        primary = DNSTestServer(**primary_options).start()
+        self.addCleanup(primary.stop)
+        secondary = DNSTestServer(host="127.0.0.2", port=primary.port, **secondary_options).start()
+        self.addCleanup(secondary.stop)
+        return (primary, secondary)
+
+    def query(self, port, timeout=1, retries=3):
+        parser = TestParser("127.0.0.1,127.0.0.2", "example.com", port=port, timeout=timeout, retries=retries)
+        parser.no_cache = True
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            return (main(parser), output.getvalue())
+
+    def test_circuit_opens_after_repeated_failures_and_closes_after_cool_off(self):
+        now = [0.0]
+        health = dnsClient.ServerHealth(dnsClient.RTTEstimator(), failure_threshold=2, cool_off=30,
+                                        clock=lambda: now[0])
+        health.record_failure()
+        self.assertTrue(health.is_available())
+        health.record_failure()
+        self.assertFalse(health.is_available())
+        now[0] = 31.0
+        self.assertTrue(health.is_available())
+        health.record_failure()   # the trial query after the cool-off failed too
+        self.assertFalse(health.is_available())
+        health.record_success(0.01)
+        self.assertTrue(health.is_available())
+        self.assertEqual(health.circuit_opened, 2)
+
+    def test_latency_percentile_needs_enough_samples(self):
+        health = dnsClient.ServerHealth(dnsClient.RTTEstimator())
+        for rtt in (0.01, 0.02, 0.03, 0.04):
+            health.record_success(rtt)
+        self.assertIsNone(health.get_latency_percentile(0.9))
+        health.record_success(0.5)
+        self.assertEqual(health.get_latency_percentile(0.5), 0.03)
+        self.assertEqual(health.get_latency_percentile(0.9), 0.5)
+
+    def test_fastest_available_server_is_selected_first(self):
+        dnsClient.get_rtt_estimator("10.0.0.1").observe(0.2)
+        dnsClient.get_rtt_estimator("10.0.0.2").observe(0.01)
+        dnsClient.get_rtt_estimator("10.0.0.3").observe(0.001)
+        for _ in range(2):
+            dnsClient.get_server_health("10.0.0.3").record_failure()
+        self.assertEqual(dnsClient.select_upstreams(["10.0.0.1", "10.0.0.2", "10.0.0.3"]),
+                         ["10.0.0.2", "10.0.0.1", "10.0.0.3"])
+
+    def test_servfail_fails_over_and_opens_the_circuit(self):
+        primary, secondary = self.start_servers({"rcode": 2}, {})
+        result, output = self.query(primary.port)
+        self.assertEqual(result, 1)
+        self.assertIn("trying the next server", output)
+        self.assertEqual((primary.udp_queries, secondary.udp_queries), (1, 1))
+
+        # the secondary now ranks first, so the failing server is no longer asked
+        for _ in range(3):
+            self.assertEqual(self.query(primary.port)[0], 1)
+        self.assertEqual(primary.udp_queries, 1)
+
+    def test_timeouts_fail_over_to_the_next_server(self):
+        primary, secondary = self.start_servers({"loss": 1.0}, {})
+        for _ in range(3):
+            self.assertEqual(self.query(primary.port, timeout=0.2)[0], 1)
+        self.assertEqual(primary.udp_queries, 1)
+        self.assertEqual(secondary.udp_queries, 3)
+        self.assertEqual(dnsClient.get_server_health("127.0.0.1", primary.port).failures, 1)
+
+    def test_hedged_query_answered_by_the_next_server(self):
+        primary, secondary = self.start_servers({}, {"latency": 0.01})
+        for _ in range(5):
+            self.assertEqual(self.query(primary.port)[0], 1)
+        primary.latency = 0.5
+
+        parser = TestParser("127.0.0.1,127.0.0.2", "example.com", port=primary.port, timeout=2, retries=0)
+        parser.no_cache = True
+        parser.hedge = 0.9
+        startTime = time.time()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(main(parser), 1)
+        self.assertLess(time.time() - startTime, 0.4)
+        self.assertIn("hedging to [127.0.0.2]", output.getvalue())
+        self.assertIn("Response received from [127.0.0.2]", output.getvalue())
+
+    def test_late_reply_after_failover_completes_the_query(self):
+        primary, secondary = self.start_servers({"latency": 0.15}, {"latency": 5})
+        with dnsClient.Resolver("127.0.0.1,127.0.0.2", primary.port, timeout=0.1, retries=3, cache=None) as resolver:
+            # the primary answers while the retry to the secondary is outstanding
+            result = resolver.resolve("example.com", "A")
+        self.assertEqual(result.response.answer[0].RDATA.DATA, "93.184.216.34")
+        self.assertEqual((result.server, result.retries, resolver.unmatched), ("127.0.0.1", 1, 0))
+        self.assertEqual((primary.udp_queries, secondary.udp_queries), (1, 1))
+        self.assertEqual(dnsClient.get_server_health("127.0.0.1", primary.port).successes, 1)
+
+class TestTCPFallback(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+
+    def tearDown(self):
+        for connection in dnsClient.TCP_CONNECTIONS.values():
+            connection.close()
+        dnsClient.TCP_CONNECTIONS.clear()
+
+    def build_query(self, name, ID):
+        flags = dnsClient.DNSPacket.Header.Flags.get_request_flags(0b0)
+        header = dnsClient.DNSPacket.Header(flags, 1, 0, 0, 0, ID)
+        question = dnsClient.DNSPacket.Question.get_request_question(name, "A")
+        return dnsClient.DNSPacket(header, question, None).to_bytes()
+
+    def test_truncated_response_is_retried_over_one_tcp_connection(self):
+        with DNSTestServer(truncate=True) as server:
+            parser = TestParser("127.0.0.1", "www.example.com", port=server.port)
+            parser.no_cache = True
+            self.assertEqual(main(parser), 1)
+            self.assertEqual(main(parser), 1)
+            self.assertEqual((server.udp_queries, server.tcp_queries, server.tcp_connections), (2, 2, 1))
+
+    def test_pipelined_answers_matched_out_of_order(self):
+        names = ["example.com", "www.example.com", "mail.example.com", "ns1.example.com", "missing.example.com"]
+        with DNSTestServer(jitter=0.05, seed=7) as server:
+            connection = dnsClient.TCPConnection(*server.address, timeout=2)
+            responses = connection.query_many([self.build_query(name, 100 + i) for i, name in enumerate(names)])
+            self.assertEqual([dnsClient.DNSPacket.unpack(response).question.QNAME for response in responses], names)
+            self.assertEqual([dnsClient.DNSPacket.unpack(response).header.ID for response in responses],
+                             [100, 101, 102, 103, 104])
+            connection.close()
+            self.assertEqual(server.tcp_connections, 1)
+
+    def test_reconnects_when_server_closed_connection(self):
+        with DNSTestServer() as server:
+            connection = dnsClient.TCPConnection(*server.address, timeout=2)
+            connection.query(self.build_query("example.com", 1))
+            connection.socket.shutdown(dnsClient.socket.SHUT_RDWR)
+            response = connection.query(self.build_query("example.com", 2))
+            self.assertEqual(dnsClient.DNSPacket.unpack(response).header.ID, 2)
+            self.assertEqual(connection.connects, 2)
+            connection.close()
+
+class TestEDNS(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+
+    def tearDown(self):
+        for connection in dnsClient.TCP_CONNECTIONS.values():
+            connection.close()
+        dnsClient.TCP_CONNECTIONS.clear()
+
+    def test_request_packet_carries_opt_record(self):
+        packet = dnsClient.DNSPacket.get_request_dns_packet("www.mcgill.ca", "A", 1232)
+        data = packet.to_bytes()
+        self.assertEqual(data[10:12], b"\x00\x01")   # ARCOUNT
+        self.assertEqual(data[-11:], bytes.fromhex("00 0029 04d0 00000000 0000"))
+        decoded = dnsClient.DNSPacket.unpack(data)
+        self.assertEqual(decoded.get_udp_payload_size(), 1232)
+        self.assertEqual(decoded.get_opt_record().RDATA.DATA, ())
+        self.assertEqual(dnsClient.DNSPacket.get_request_dns_packet("www.mcgill.ca", "A").to_bytes()[10:12], b"\x00\x00")
+
+    def test_opt_options_round_trip(self):
+        packet = dnsClient.DNSPacket.get_request_dns_packet("mcgill.ca", "A")
+        packet.additional.append(dnsClient.DNSPacket.Answer.get_opt_record(4096, DO=1, options=[(10, b"cookie12")]))
+        packet.header.ARCOUNT = 1
+        opt = dnsClient.DNSPacket.unpack(packet.to_bytes()).get_opt_record()
+        self.assertEqual((opt.CLASS, opt.TTL >> 15, opt.RDATA.DATA), (4096, 1, ((10, b"cookie12"),)))
+
+    def test_large_answer_fits_advertised_payload(self):
+        zone = Zone.from_text("\n".join("big.example.com. 60 A 10.0.{}.{}".format(i // 250, i % 250) for i in range(60)))
+        with DNSTestServer(zone) as server:
+            parser = TestParser("127.0.0.1", "big.example.com", port=server.port)
+            parser.no_cache = True
+            self.assertEqual(main(parser), 1)
+            self.assertEqual((server.udp_queries, server.tcp_queries), (1, 0))
+
+            parser.edns = 0
+            self.assertEqual(main(parser), 1)
+            self.assertEqual((server.udp_queries, server.tcp_queries), (2, 1))
+
+    def test_payload_size_must_fit_the_opt_record(self):
+        self.assertEqual((dnsClient.udp_payload_size("0"), dnsClient.udp_payload_size("65535")), (0, 65535))
+        for text in ("70000", "-1"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                dnsClient.udp_payload_size(text)
+        with self.assertRaises(ValueError):
+            dnsClient.udp_payload_size("big")
+
+    def test_legacy_additional_section_prints_opt(self):
+        packet = dnsClient.DNSPacket.get_request_dns_packet("mcgill.ca", "A", 1232)
+        data = packet.to_bytes()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            pointer = dnsClient.get_additional_information(data, len(data) - 11, 1)
+        self.assertEqual(pointer, len(data))
+        self.assertIn("UDP payload size 1232", output.getvalue())
+
+class TestDecodeDNSResponsePacket(unittest.TestCase):
+
+    def build_response(self, answers, ID=0x827a, flags=0x8180, qname="www.mcgill.ca"):
+        data = bytearray(struct.pack("!HHHHHH", ID, flags, 1, len(answers), 0, 0))
+        dnsClient.DNSPacket.Question(qname, 1, 1).pack_into(data, len(data))
+        for name, rtype, ttl, rdata in answers:
+            data += name + struct.pack("!HHIH", rtype, 1, ttl, len(rdata)) + rdata
+        return bytes(data)
+
+    def test_unpack_header_and_question(self):
+        packet = dnsClient.DNSPacket.unpack(self.build_response([]))
+        self.assertEqual(packet.header.ID, 0x827a)
+        self.assertEqual(packet.header.FLAGS.RA, 1)
+        self.assertEqual(packet.header.FLAGS.RCODE, 0)
+        self.assertEqual(packet.header.FLAGS.to_int(), 0x8180)
+        self.assertEqual(packet.question.QNAME, "www.mcgill.ca")
+        self.assertEqual(packet.answer, [])
+
+    def test_unpack_compressed_answers(self):
+        data = self.build_response([(b"\xc0\x0c", 5, 300, b"\x06mcgill\xc0\x17"),
+                                    (b"\xc0\x2b", 1, 60, bytes([132, 216, 177, 160])),
+                                    (b"\xc0\x10", 15, 60, b"\x00\x0a\x04mail\xc0\x10")])
+        packet = dnsClient.DNSPacket.unpack(data)
+        self.assertEqual([(a.NAME, a.TYPE, a.TTL) for a in packet.answer],
+                         [("www.mcgill.ca", 5, 300), ("mcgill.ca", 1, 60), ("mcgill.ca", 15, 60)])
+        self.assertEqual(packet.answer[0].RDATA.DATA, "mcgill.ca")
+        self.assertEqual(packet.answer[1].RDATA.DATA, "132.216.177.160")
+        self.assertEqual((packet.answer[2].RDATA.PREFERENCE, packet.answer[2].RDATA.EXCHANGE), (10, "mail.mcgill.ca"))
+
+    def test_unpack_pointer_above_offset_255(self):
+        long_name = ".".join(["a" * 60, "b" * 60, "c" * 60, "d" * 60, "target", "ca"])
+        cname_rdata = dnsClient.encode_name(long_name)
+        data = self.build_response([(b"\xc0\x0c", 5, 300, cname_rdata)])
+        target_offset = data.index(b"\x06target")
+        self.assertGreater(target_offset, 255)
+        data = self.build_response([(b"\xc0\x0c", 5, 300, cname_rdata),
+                                    (struct.pack("!H", 0xC000 | target_offset), 1, 60, bytes([10, 0, 0, 1]))])
+        packet = dnsClient.DNSPacket.unpack(data)
+        self.assertEqual(packet.answer[1].NAME, "target.ca")
+        second_name_offset = len(self.build_response([(b"\xc0\x0c", 5, 300, cname_rdata)]))
+        self.assertEqual(dnsClient.get_alias(data, second_name_offset), "target.ca")
+
+class TestRecordTypes(unittest.TestCase):
+
+    ZONE = """
+        example.com.             300 SOA  ns1.example.com. admin.example.com. 7 7200 900 86400 60
+        example.com.             300 AAAA 2606:2800:220:1:248:1893:25c8:1946
+        example.com.             300 TXT  "v=spf1 -all" "say \\"hi\\""
+        example.com.             300 CAA  0 issue "letsencrypt.org"
+        _sip._tcp.example.com.   300 SRV  10 60 5060 sip.example.com.
+        34.216.184.93.in-addr.arpa. 300 PTR example.com.
+    """
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+        self.server = DNSTestServer(Zone.from_text(self.ZONE)).start()
+        self.addCleanup(self.server.stop)
+
+    def resolve(self, name, qtype):
+        with dnsClient.Resolver("127.0.0.1", self.server.port, timeout=1, cache=None) as resolver:
+            return resolver.resolve(name, qtype).to_dict()["answers"]
+
+    def test_new_types_round_trip(self):
+        expected = {
+            ("example.com", "AAAA"): "2606:2800:220:1:248:1893:25c8:1946",
+            ("example.com", "TXT"): '"v=spf1 -all" "say \\"hi\\""',
+            ("example.com", "SOA"): "ns1.example.com admin.example.com 7 7200 900 86400 60",
+            ("example.com", "CAA"): '0 issue "letsencrypt.org"',
+            ("_sip._tcp.example.com", "SRV"): "10 60 5060 sip.example.com",
+            ("34.216.184.93.in-addr.arpa", "PTR"): "example.com",
+        }
+        for (name, qtype), data in expected.items():
+            self.assertEqual(self.resolve(name, qtype), [{"name": name, "type": qtype, "ttl": 300, "data": data}])
+
+    def test_registry_is_shared_by_questions_and_records(self):
+        self.assertEqual(dnsClient.DNSPacket.Question.get_q_num("AAAA"), 28)
+        self.assertEqual(dnsClient.DNSPacket.get_q_type(257), "CAA")
+        self.assertIsNone(dnsClient.DNSPacket.Question.get_q_num("OPT"))
+        self.assertIsNone(dnsClient.DNSPacket.get_q_type(0xff00))
+
+    def test_unknown_types_are_skipped_by_rdlength(self):
+        flags = dnsClient.DNSPacket.Header.Flags.get_request_flags(0b0)
+        request_header = dnsClient.DNSPacket.Header(flags, 1, 0, 0, 0, 0x827a)
+        question = dnsClient.DNSPacket.Question("example.com", 1, 1)
+        data = bytearray(struct.pack("!HHHHHH", 0x827a, 0x8180, 1, 2, 0, 1))
+        question.pack_into(data, len(data))
+        data += b"\xc0\x0c" + struct.pack("!HHIH", 0xff00, 1, 60, 3) + b"abc"
+        data += b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 60, 4) + bytes([10, 0, 0, 1])
+        data += b"\xc0\x0c" + struct.pack("!HHIH", 0xff00, 1, 60, 2) + b"xy"
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            answers, _, pointer = dnsClient.get_response_information(bytes(data), question, request_header)
+            pointer = dnsClient.get_additional_information(bytes(data), pointer, 1)
+        self.assertEqual([answer.RDATA.DATA for answer in answers], ["10.0.0.1"])
+        self.assertEqual(pointer, len(data))
+        self.assertNotIn("ERROR", output.getvalue())
+
+        packet = dnsClient.DNSPacket.unpack(bytes(data))
+        self.assertEqual(packet.answer[0].to_dict()["data"], "616263")
+        self.assertEqual(packet.to_bytes()[len(data) - 16:], bytes(data)[-16:])
+
+    def test_main_type_flag(self):
+        parser = TestParser("127.0.0.1", "_sip._tcp.example.com", port=self.server.port, type="srv")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(main(parser), 1)
+        self.assertIn("SRV \t 10 60 5060 sip.example.com \t 300 \t auth", output.getvalue())
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = dnsClient.ResponseCache(max_entries=3, clock=lambda: self.now)
+
+    def build_response(self, name, rcode=0, answer_ttls=(), soa=None, qtype=1):
+        flags = dnsClient.DNSPacket.Header.Flags.from_int(0x8180 | rcode)
+        header = dnsClient.DNSPacket.Header(flags, 1, len(answer_ttls), 1 if soa else 0, 0, 0x827a)
+        question = dnsClient.DNSPacket.Question(name, qtype, 1)
+        answers = [dnsClient.DNSPacket.Answer(name, 1, 1, ttl, 4, dnsClient.DNSPacket.RDATA("10.0.0.1", None, None))
+                   for ttl in answer_ttls]
+        authority = []
+        if soa:
+            soa_ttl, minimum = soa
+            data = dnsClient.SOAData("ns.example.com", "admin.example.com", 1, 7200, 900, 86400, minimum)
+            authority.append(dnsClient.DNSPacket.Answer("example.com", 6, 1, soa_ttl, 40,
+                                                        dnsClient.DNSPacket.RDATA(data, None, None)))
+        return dnsClient.DNSPacket(header, question, answers, authority)
+
+    def test_hit_decrements_ttl_and_expires_at_minimum_ttl(self):
+        self.assertTrue(self.cache.put(self.build_response("mcgill.ca", answer_ttls=(300, 60))))
+        self.now += 20
+        cached = self.cache.get("MCGILL.ca.", 1)
+        self.assertEqual([answer.TTL for answer in cached.answer], [280, 40])
+        self.now += 40
+        self.assertIsNone(self.cache.get("mcgill.ca", 1))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_negative_caching_uses_soa_minimum(self):
+        self.assertTrue(self.cache.put(self.build_response("missing.example.com", rcode=3, soa=(3600, 30))))
+        self.assertTrue(self.cache.put(self.build_response("example.com", soa=(10, 300), qtype=15)))
+        self.now += 15
+        self.assertEqual(self.cache.get("missing.example.com", 1).header.FLAGS.RCODE, 3)
+        self.assertIsNone(self.cache.get("example.com", 15))
+
+    def test_uncacheable_responses(self):
+        self.assertFalse(self.cache.put(self.build_response("servfail.ca", rcode=2)))
+        self.assertFalse(self.cache.put(self.build_response("nosoa.ca", rcode=3)))
+        self.assertFalse(self.cache.put(self.build_response("zero.ca", answer_ttls=(0,))))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction_by_entries_and_bytes(self):
+        for name in ("a.ca", "b.ca", "c.ca"):
+            self.cache.put(self.build_response(name, answer_ttls=(60,)))
+        self.cache.get("a.ca", 1)
+        self.cache.put(self.build_response("d.ca", answer_ttls=(60,)))
+        self.assertIsNone(self.cache.get("b.ca", 1))
+        self.assertIsNotNone(self.cache.get("a.ca", 1))
+        self.assertEqual(self.cache.evictions, 1)
+
+        cache = dnsClient.ResponseCache(max_bytes=100, clock=lambda: self.now)
+        cache.put(self.build_response("a.ca", answer_ttls=(60,)), size=60)
+        cache.put(self.build_response("b.ca", answer_ttls=(60,)), size=60)
+        self.assertEqual((len(cache), cache.bytes, cache.evictions), (1, 60, 1))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,167 @@
+import argparse
+import json
+import struct
+import sys
+from array import array
+import dnsCapture
+from dnsClient import DNSClientException, DNSMalformedPacketException, RECORD_TYPES, HEADER_STRUCT, RR_STRUCT, \
+    QUESTION_TAIL_STRUCT, DECODE_ERRORS, read_name, print_error
+
+try:
+    import numpy as np
+except ImportError:     # only the batch API needs NumPy
+    np = None
+
+IPV4_STRUCT = struct.Struct("!I")
+A_TYPE = 0x0001
+NAME_RDATA_OFFSETS = {0x0002: 0, 0x0005: 0, 0x000c: 0, 0x000f: 2}   # NS, CNAME, PTR and MX: where the name starts
+
+if np is not None:
+    # the 12 byte header of every buffer is read through this dtype in one call
+    HEADER_DTYPE = np.dtype([("id", ">u2"), ("flags", ">u2"), ("qdcount", ">u2"), ("ancount", ">u2"),
+                             ("nscount", ">u2"), ("arcount", ">u2")])
+
+
+class ResponseBatch:
+    """Many responses decoded into NumPy columns instead of one object per record. Response columns have one entry per
+    buffer, record columns one per resource record, and record_response maps each record to its buffer. Names are
+    interned: name columns hold indexes into names, -1 where there is none"""
+
+    def __init__(self, header, valid, qname, qtype, records, names):
+        self.id = header["id"].astype(np.uint16)
+        self.flags = header["flags"].astype(np.uint16)
+        self.rcode = (self.flags & 0x000F).astype(np.uint8)
+        self.qdcount = header["qdcount"].astype(np.uint16)
+        self.ancount = header["ancount"].astype(np.uint16)
+        self.nscount = header["nscount"].astype(np.uint16)
+        self.arcount = header["arcount"].astype(np.uint16)
+        self.valid = valid
+        self.qname = np.array(qname, dtype=np.int32)
+        self.qtype = np.array(qtype, dtype=np.uint16)
+        response, section, name, rtype, ttl, ipv4, target = records
+        self.record_response = np.array(response, dtype=np.uint32)
+        self.section = np.array(section, dtype=np.uint8)    # 0 answer, 1 authority, 2 additional
+        self.name = np.array(name, dtype=np.int32)
+        self.type = np.array(rtype, dtype=np.uint16)
+        self.ttl = np.array(ttl, dtype=np.uint32)
+        self.ipv4 = np.array(ipv4, dtype=np.uint32)         # the address of A records, 0 for other types
+        self.target = np.array(target, dtype=np.int32)      # the name in NS, CNAME, PTR and MX records
+        self.names = names
+
+    def __len__(self):
+        return len(self.id)
+
+    def summary(self, top=10):
+        "Aggregates outcomes, query types, answer TTLs and the most answered names without leaving NumPy"
+        answers = self.section == 0
+        ttls = self.ttl[answers]
+        rcodes = np.bincount(self.rcode[self.valid], minlength=16)
+        qtypes, qtype_counts = np.unique(self.qtype[self.valid & (self.qname >= 0)], return_counts=True)
+        name_counts = np.bincount(self.name[answers], minlength=len(self.names))
+        most_answered = np.argsort(name_counts, kind="stable")[::-1][:top]
+        return {"responses": len(self), "malformed": int(np.count_nonzero(~self.valid)), "records": len(self.ttl),
+                "rcodes": {str(rcode): int(count) for rcode, count in enumerate(rcodes) if count},
+                "qtypes": {RECORD_TYPES[code].name if code in RECORD_TYPES else str(code): int(count)
+                           for code, count in zip(qtypes.tolist(), qtype_counts.tolist())},
+                "ttl": {"min": int(ttls.min()), "p50": float(np.percentile(ttls, 50)),
+                        "p90": float(np.percentile(ttls, 90)), "max": int(ttls.max())} if ttls.size else {},
+                "top_names": [[self.names[index], int(name_counts[index])] for index in most_answered.tolist()
+                              if name_counts[index]]}
+
+
+def decode_headers(buffers):
+    "Returns the header fields of every buffer as one structured array, and which buffers hold a whole header"
+    size = HEADER_STRUCT.size
+    headers = b"".join(bytes(buffer[:size]).ljust(size, b"\x00") for buffer in buffers)
+    valid = np.fromiter((len(buffer) >= size for buffer in buffers), dtype=bool, count=len(buffers))
+    return (np.frombuffer(headers, dtype=HEADER_DTYPE), valid)
+
+
+def decode_batch(buffers):
+    """Decodes many raw responses into a ResponseBatch. Headers are decoded for all buffers at once, then records are
+    walked straight into typed columns. Responses whose header, names or record framing do not decode are marked in
+    batch.valid and contribute no records; RDATA other than A addresses and NS, CNAME, PTR and MX names is not read"""
+    if np is None:
+        raise DNSClientException("Batch decoding requires NumPy")
+    buffers = list(buffers)
+    header, valid = decode_headers(buffers)
+    qname = array("i", [-1]) * len(buffers)
+    qtype = array("H", [0]) * len(buffers)
+    records = (array("I"), array("B"), array("i"), array("H"), array("I"), array("I"), array("i"))
+    names = []
+    interned = {}
+
+    def intern(name):
+        index = interned.get(name)
+        if index is None:
+            index = interned[name] = len(names)
+            names.append(name)
+        return index
+
+    header_counts = zip(header["qdcount"].tolist(), header["ancount"].tolist(), header["nscount"].tolist(),
+                        header["arcount"].tolist())
+    for index, (buffer, counts) in enumerate(zip(buffers, header_counts)):
+        if not valid[index]:
+            continue
+        mark = len(records[0])
+        try:
+            decode_records(memoryview(buffer), index, counts, records, qname, qtype, intern)
+        except DECODE_ERRORS + (DNSMalformedPacketException,):
+            valid[index] = False
+            qname[index], qtype[index] = -1, 0
+            for column in records:
+                del column[mark:]
+    return ResponseBatch(header, valid, qname, qtype, records, names)
+
+
+def decode_records(view, index, counts, records, qname, qtype, intern):
+    "Appends the records of one response to the columns, sharing one offset -> name cache across its names"
+    response, section, name, rtype, ttl, ipv4, target = records
+    names = {}
+    offset = HEADER_STRUCT.size
+    for _ in range(counts[0]):
+        question, offset = read_name(view, offset, names)
+        qname[index] = intern(question)
+        qtype[index] = QUESTION_TAIL_STRUCT.unpack_from(view, offset)[0]
+        offset += QUESTION_TAIL_STRUCT.size
+
+    for number, count in enumerate(counts[1:]):
+        for _ in range(count):
+            owner, offset = read_name(view, offset, names)
+            TYPE, _, TTL, RDLENGTH = RR_STRUCT.unpack_from(view, offset)
+            offset += RR_STRUCT.size
+            end = offset + RDLENGTH
+            if end > len(view):
+                raise DNSMalformedPacketException("RDATA runs past the end of the packet", offset=offset)
+            address = 0
+            rdata_name = -1
+            if TYPE == A_TYPE:
+                if RDLENGTH != 4:
+                    raise DNSMalformedPacketException("A record with {} bytes of RDATA".format(RDLENGTH), offset=offset)
+                address = IPV4_STRUCT.unpack_from(view, offset)[0]
+            elif TYPE in NAME_RDATA_OFFSETS:
+                rdata_name = intern(read_name(view[:end], offset + NAME_RDATA_OFFSETS[TYPE], names)[0])
+            response.append(index)
+            section.append(number)
+            name.append(intern(owner))
+            rtype.append(TYPE)
+            ttl.append(TTL)
+            ipv4.append(address)
+            target.append(rdata_name)
+            offset = end
+
+
+def main(args):
+    if np is None:
+        print_error("Batch decoding requires NumPy")
+        return 0
+    batch = decode_batch(record.response for record in dnsCapture.read_records(args.capture))
+    print(json.dumps(batch.summary(args.top), indent=2))
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode captured DNS responses into NumPy columns and summarize them')
+    parser.add_argument('capture', nargs='+', help='Capture logs written with --capture')
+    parser.add_argument('--top', type=int, help='Most answered names to list', default=10)
+    sys.exit(0 if main(parser.parse_args()) else 1)
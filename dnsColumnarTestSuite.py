@@ -0,0 +1,94 @@
+import unittest
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import tempfile
+import dnsColumnar
+import dnsFuzzTestSuite
+from dnsClient import DNSPacket, DNSClientException
+from dnsCapture import CaptureWriter
+from dnsBenchmark import build_corpus
+
+
+@unittest.skipIf(dnsColumnar.np is None, "NumPy is not installed")
+class TestBatchDecode(unittest.TestCase):
+
+    def setUp(self):
+        self.corpus = build_corpus()
+        self.buffers = [data for data, _, _ in self.corpus.values()]
+
+    def test_columns_match_the_object_decoder(self):
+        batch = dnsColumnar.decode_batch(self.buffers)
+        self.assertEqual(len(batch), len(self.buffers))
+        self.assertTrue(batch.valid.all())
+        records = []
+        for index, data in enumerate(self.buffers):
+            response = DNSPacket.unpack(data)
+            self.assertEqual(int(batch.id[index]), response.header.ID)
+            self.assertEqual(int(batch.rcode[index]), response.header.FLAGS.RCODE)
+            self.assertEqual(int(batch.ancount[index]), len(response.answer))
+            self.assertEqual(batch.names[batch.qname[index]], response.question.QNAME)
+            self.assertEqual(int(batch.qtype[index]), response.question.QTYPE)
+            for section, answers in enumerate((response.answer, response.authority, response.additional)):
+                records.extend((index, section, answer) for answer in answers)
+
+        self.assertEqual(len(batch.ttl), len(records))
+        self.assertEqual(str(batch.ttl.dtype), "uint32")
+        self.assertEqual(str(batch.ipv4.dtype), "uint32")
+        for position, (index, section, answer) in enumerate(records):
+            self.assertEqual((int(batch.record_response[position]), int(batch.section[position])), (index, section))
+            self.assertEqual(batch.names[batch.name[position]], answer.NAME)
+            self.assertEqual((int(batch.type[position]), int(batch.ttl[position])), (answer.TYPE, answer.TTL))
+            if answer.TYPE == 0x0001:
+                self.assertEqual(socket.inet_ntoa(int(batch.ipv4[position]).to_bytes(4, "big")), answer.RDATA.DATA)
+            elif answer.TYPE in (0x0002, 0x0005):
+                self.assertEqual(batch.names[batch.target[position]], answer.RDATA.DATA)
+            elif answer.TYPE == 0x000f:
+                self.assertEqual(batch.names[batch.target[position]], answer.RDATA.EXCHANGE)
+        # names are interned once however often they appear
+        self.assertEqual(len(batch.names), len(set(batch.names)))
+
+    def test_malformed_responses_are_marked_without_records(self):
+        # only the parts that become columns are checked, RDATA such as TXT or CAA is not decoded
+        malformed = [data for name, data in dnsFuzzTestSuite.TestMalformedPackets.CORPUS.items()
+                     if not name.endswith(("_record", "_overrun", "_into_next_record"))]
+        batch = dnsColumnar.decode_batch(self.buffers[:1] + malformed + self.buffers[1:2])
+        self.assertEqual(batch.valid.tolist(), [True] + [False] * len(malformed) + [True])
+        self.assertEqual(sorted(set(batch.record_response.tolist())), [0, len(malformed) + 1])
+        self.assertTrue((batch.qname[1:-1] == -1).all())
+
+    def test_summary_aggregates_without_record_objects(self):
+        batch = dnsColumnar.decode_batch(self.buffers * 3)
+        summary = batch.summary(top=2)
+        self.assertEqual((summary["responses"], summary["malformed"]), (18, 0))
+        self.assertEqual(summary["rcodes"], {"0": 18})
+        self.assertEqual(summary["qtypes"], {"A": 9, "NS": 6, "MX": 3})
+        self.assertEqual((summary["ttl"]["min"], summary["ttl"]["max"]), (300, 300))
+        self.assertEqual(summary["top_names"][0], ["hosts.a.b.c.example.com", 120])
+
+    def test_main_summarizes_capture_logs(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "capture.bin")
+        with CaptureWriter(path) as capture:
+            for data in self.buffers:
+                capture.write(b"\x00" * 12, data, "127.0.0.1", 53)
+        args = argparse.Namespace(capture=[path], top=1)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(dnsColumnar.main(args), 1)
+        self.assertEqual(json.loads(output.getvalue())["responses"], len(self.buffers))
+
+
+@unittest.skipIf(dnsColumnar.np is not None, "NumPy is installed")
+class TestWithoutNumPy(unittest.TestCase):
+
+    def test_batch_decode_requires_numpy(self):
+        with self.assertRaises(DNSClientException):
+            dnsColumnar.decode_batch([b""])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,345 @@
+import asyncio
+import random
+import ssl
+from collections import deque
+from dnsClient import DNSPacket, DNSClientException, DNSMalformedPacketException, DNSTimeoutException, QueryResult, \
+    Resolver, ID_STRUCT, DEFAULT_UDP_PAYLOAD_SIZE, get_server_health, parse_servers, select_upstreams, decode_response
+from dnsAsyncResolver import AsyncTCPConnection
+from dnsStats import STATS
+
+TRANSPORT_PORTS = {"tls": 853, "https": 443}
+DOH_PATH = "/dns-query"
+DOH_CONTENT_TYPE = "application/dns-message"
+MAX_HTTP_HEADER_LINES = 100
+
+
+class TLSSessionContext(ssl.SSLContext):
+    """Client SSL context that remembers the last TLS session of every server and offers it again when a new
+    connection is opened, so reconnecting resumes the session instead of paying a full handshake"""
+
+    def __new__(cls, cafile=None, verify=True):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, cafile=None, verify=True):
+        super().__init__()
+        if verify:
+            if cafile is not None:
+                self.load_verify_locations(cafile)
+            else:
+                self.load_default_certs()
+        else:
+            self.check_hostname = False
+            self.verify_mode = ssl.CERT_NONE
+        self.sessions = {}  # server hostname -> ssl.SSLSession
+
+        self.handshakes = 0
+        self.resumed = 0
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        # asyncio wraps every new connection through here, which is the one place a session can be offered
+        if session is None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def remember_session(self, writer, server_hostname):
+        "Keeps the session of an established connection, once the server sent its ticket along with a response"
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is None or ssl_object.session is None:
+            return False
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        self.sessions[server_hostname] = ssl_object.session
+        return True
+
+
+class DoTConnection(AsyncTCPConnection):
+    "Persistent DNS-over-TLS connection (RFC 7858), pipelining length-prefixed queries like DNS over TCP"
+
+    def __init__(self, server, port, context, server_hostname):
+        super().__init__(server, port, context, server_hostname)
+        self.session_saved = False
+
+
+class DoHConnection:
+    """Persistent DNS-over-HTTPS connection (RFC 8484) sending wire-format messages in HTTP/1.1 keep-alive POSTs.
+    Requests are pipelined, so responses come back in the order the queries were sent"""
+
+    def __init__(self, server, port, context, server_hostname, path=DOH_PATH):
+        self.server = server
+        self.port = port
+        self.ssl = context
+        self.server_hostname = server_hostname
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.pending = deque()  # futures of the responses still to come, in request order
+        self.queries = 0
+        self.session_saved = False
+
+    @property
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing() and not self.reader_task.done()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.server, self.port, ssl=self.ssl,
+                                                                 server_hostname=self.server_hostname)
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+        return self
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+    def get_request(self, data):
+        host = self.server_hostname or self.server
+        return ("POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: {}\r\nAccept: {}\r\nContent-Length: {}\r\n\r\n"
+                .format(self.path, host, DOH_CONTENT_TYPE, DOH_CONTENT_TYPE, len(data)).encode("ascii") + data)
+
+    async def query(self, data, key, timeout):
+        # the ID of DoH queries is 0 (RFC 8484 4.1), responses are matched by their position on the connection
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.queries += 1
+        self.writer.write(self.get_request(b"\x00\x00" + data[2:]))
+        data = await asyncio.wait_for(future, timeout)   # a late response still pops its cancelled future
+        return ID_STRUCT.pack(key[0]) + data[2:]
+
+    async def read_response(self):
+        "Reads one HTTP response, returning (status, body, whether the server keeps the connection open)"
+        status_line = (await self.reader.readline()).decode("latin-1")
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        fields = status_line.split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith("HTTP/") or not fields[1].isdigit():
+            raise DNSClientException("Invalid HTTP response from the DoH server: {!r}".format(status_line))
+        headers = {}
+        for _ in range(MAX_HTTP_HEADER_LINES):
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise DNSClientException("Too many HTTP headers from the DoH server")
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        return (int(fields[1]), body, headers.get("connection", "").lower() != "close")
+
+    async def read_responses(self):
+        error = DNSClientException("DoH connection closed by the server")
+        try:
+            while True:
+                status, body, keep_alive = await self.read_response()
+                if not self.pending:
+                    continue
+                future = self.pending.popleft()
+                if not future.done():
+                    if status == 200:
+                        future.set_result(body)
+                    else:
+                        future.set_exception(DNSClientException("DoH server answered HTTP {}".format(status)))
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            error = DNSClientException("DoH connection to the DNS server failed: {}".format(e))
+        except DNSClientException as e:
+            error = e
+        finally:
+            self.writer.close()
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+
+class EncryptedResolver:
+    """Resolves names over DNS-over-TLS or DNS-over-HTTPS. A pool of up to `connections` persistent connections is
+    kept per server and queries are pipelined on the least busy one. Reconnections resume the previous TLS session.
+    query() returns the response like AsyncResolver.query, resolve() a QueryResult like Resolver.resolve"""
+
+    def __init__(self, server, port=None, transport="tls", timeout=5, retries=3, cache=None,
+                 udp_payload_size=DEFAULT_UDP_PAYLOAD_SIZE, connections=1, cafile=None, server_hostname=None,
+                 path=DOH_PATH, context=None, stats=None, capture=None):
+        if transport not in TRANSPORT_PORTS:
+            raise DNSClientException("Unsupported transport: {}".format(transport))
+        self.servers = parse_servers(server)
+        self.server = self.servers[0]
+        self.transport = transport
+        self.port = port if port is not None else TRANSPORT_PORTS[transport]
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+        self.udp_payload_size = udp_payload_size
+        self.connections = max(1, connections)
+        self.server_hostname = server_hostname  # name the certificate is checked against, the address when None
+        self.path = path
+        self.context = context if context is not None else TLSSessionContext(cafile)
+        self.stats = STATS if stats is None else stats
+        self.capture = capture  # CaptureWriter logging every raw query and response
+        self.health = {server: get_server_health(server, self.port) for server in self.servers}
+        self.pools = {}     # server -> [DoTConnection or DoHConnection]
+        self.lock = asyncio.Lock()
+
+        self.queries = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+        self.reconnections = 0
+        self.hedged = 0
+
+    @property
+    def rtt_estimator(self):
+        "RTT estimator of the currently best upstream"
+        return self.health[select_upstreams(self.servers, self.port)[0]].rtt_estimator
+
+    async def open(self):
+        return self     # connections are opened by the first queries that need them
+
+    def close(self):
+        for pool in self.pools.values():
+            for connection in pool:
+                connection.close()
+        self.pools = {}
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def get_connection(self, server):
+        "Returns the least busy open connection to a server, opening another while the pool is not full"
+        async with self.lock:
+            pool = self.pools.setdefault(server, [])
+            closed = [connection for connection in pool if not connection.is_open]
+            for connection in closed:
+                pool.remove(connection)
+                self.reconnections += 1
+            idle = [connection for connection in pool if not connection.pending]
+            if idle:
+                return idle[0]
+            if len(pool) < self.connections:
+                hostname = self.server_hostname or server
+                if self.transport == "tls":
+                    connection = DoTConnection(server, self.port, self.context, hostname)
+                else:
+                    connection = DoHConnection(server, self.port, self.context, hostname, self.path)
+                pool.append(await asyncio.wait_for(connection.open(), self.timeout))
+                return connection
+            return min(pool, key=lambda connection: len(connection.pending))
+
+    async def query(self, name, qtype="A"):
+        "Returns the response to a query, whatever its RCODE"
+        packet = DNSPacket.get_request_dns_packet(name, qtype, self.udp_payload_size)
+        question = packet.question
+        if self.cache is not None:
+            cached = self.cache.get(question.QNAME, question.QTYPE, question.QCLASS)
+            if cached is not None:
+                return cached
+        response, _ = await self.exchange(packet, qtype, QueryResult(name, qtype))
+        if self.cache is not None:
+            self.cache.put(response)
+        return response
+
+    async def resolve(self, name, qtype="A"):
+        "Resolves a name into a QueryResult, raising the DNSClientException matching an unusable response"
+        if DNSPacket.Question.get_q_num(qtype) is None:
+            raise DNSClientException("Unsupported query type: {}".format(qtype))
+        packet = DNSPacket.get_request_dns_packet(name, qtype, self.udp_payload_size)
+        question = packet.question
+        if self.cache is not None:
+            cached = self.cache.get(question.QNAME, question.QTYPE, question.QCLASS)
+            if cached is not None:
+                return Resolver.check_result(QueryResult(name, qtype, cached, from_cache=True))
+        result = QueryResult(name, qtype)
+        result.response, size = await self.exchange(packet, qtype, result)
+        return Resolver.check_result(result, self.cache, size)
+
+    async def exchange(self, packet, qtype, result):
+        """Sends a query over the encrypted transport, moving on to the next server or a new connection when one fails
+        or times out. Returns (response, size) and fills in the result"""
+        loop = asyncio.get_running_loop()
+        question = packet.question
+        timer = self.stats.start(qtype)
+        ranked = select_upstreams(self.servers, self.port)
+        self.queries += 1
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.retransmissions += 1
+            server = ranked[attempt % len(ranked)]
+            health = self.health[server]
+            packet.header.ID = random.getrandbits(16)
+            data = packet.to_bytes()
+            key = (packet.header.ID, question.QNAME.rstrip(".").lower(), question.QTYPE, question.QCLASS)
+            result.events.append(("send", server, self.transport))
+            sent = loop.time()
+            connection = None
+            try:
+                connection = await self.get_connection(server)
+                reply = await connection.query(data, key, self.timeout)
+            except asyncio.TimeoutError:
+                if connection is not None:
+                    connection.close()  # a stalled stream is replaced, resuming its TLS session
+                self.stats.count_timeout(server, qtype)
+                health.rtt_estimator.timed_out()
+                health.record_failure()
+                result.events.append(("timeout", server, None))
+                error = None
+                continue
+            except (OSError, DNSClientException) as e:
+                health.record_failure()
+                error = e
+                continue
+
+            response_time = loop.time() - sent
+            if not connection.session_saved:
+                connection.session_saved = self.context.remember_session(connection.writer, connection.server_hostname)
+            health.rtt_estimator.observe(response_time)
+            health.record_success(response_time)
+            if self.capture is not None:
+                self.capture.write(data, reply, server, self.port)
+            try:
+                response = decode_response(reply, self.stats)
+            except DNSMalformedPacketException as e:
+                e.result = result
+                raise
+            self.stats.count_rcode(server, qtype, response.header.FLAGS.RCODE)
+            if timer is not None:
+                timer.finish(server)
+            result.events.append(("response", server, (round(response_time, 6), attempt)))
+            result.server = server
+            result.response_time = response_time
+            result.retries = attempt
+            return (response, len(reply))
+
+        if timer is not None:
+            timer.finish(ranked[0])
+        if error is not None:
+            raise DNSClientException("{} query failed: {}".format(self.transport.upper(), error), result)
+        self.timeouts += 1
+        raise DNSTimeoutException("Maximum number of retries exceeded: {}".format(self.retries), result)
+
+
+def resolve(args, qtype, cache=None, capture=None):
+    "Runs one query of the command line over the transport it selected, returning the QueryResult"
+    async def run():
+        async with EncryptedResolver(args.server, args.p, args.transport, timeout=args.t, retries=args.r, cache=cache,
+                                     udp_payload_size=getattr(args, "edns", DEFAULT_UDP_PAYLOAD_SIZE),
+                                     cafile=getattr(args, "tls_ca", None),
+                                     server_hostname=getattr(args, "tls_name", None),
+                                     path=getattr(args, "doh_path", None) or DOH_PATH, capture=capture) as resolver:
+            return await resolver.resolve(args.name, qtype)
+    return asyncio.run(run())
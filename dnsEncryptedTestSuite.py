@@ -0,0 +1,114 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import json
+import ssl
+import dnsBulk
+import dnsClient
+from dnsClient import DNSClientException, DNSNameErrorException, main
+from dnsEncrypted import EncryptedResolver, TLSSessionContext
+from dnsTestServer import DNSTestServer, get_test_tls_context, TEST_CERT
+from dnsClientTestSuite import TestParser
+from dnsBulkTestSuite import TestBulkArgs
+
+
+class TestEncryptedTransports(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.SERVER_HEALTH.clear()
+        dnsClient.RTT_ESTIMATORS.clear()
+        self.server = DNSTestServer(tls=get_test_tls_context()).start()
+        self.addCleanup(self.server.stop)
+
+    def port(self, transport):
+        return self.server.tls_port if transport == "tls" else self.server.https_port
+
+    def run_resolver(self, transport, coroutine_function, **options):
+        options = dict({"timeout": 2, "retries": 1, "cafile": TEST_CERT}, **options)
+
+        async def run():
+            async with EncryptedResolver("127.0.0.1", self.port(transport), transport, **options) as resolver:
+                return await coroutine_function(resolver)
+        return asyncio.run(run())
+
+    def test_pipelined_queries_share_one_connection(self):
+        for transport in ("tls", "https"):
+            with self.subTest(transport=transport):
+                async def resolve(resolver):
+                    responses = await asyncio.gather(*(resolver.query(name) for name in ["example.com",
+                                                                                         "www.example.com"] * 10))
+                    return responses, resolver
+
+                before = self.server.tls_connections
+                responses, resolver = self.run_resolver(transport, resolve)
+                self.assertTrue(all(response.answer[-1].RDATA.DATA == "93.184.216.34" for response in responses))
+                self.assertEqual(self.server.tls_connections - before, 1)
+                self.assertEqual(resolver.queries, 20)
+        self.assertEqual(self.server.https_queries, 20)
+
+    def test_reconnections_resume_the_tls_session(self):
+        for transport in ("tls", "https"):
+            with self.subTest(transport=transport):
+                async def resolve(resolver):
+                    await resolver.resolve("example.com")
+                    for connection in resolver.pools["127.0.0.1"]:
+                        connection.close()
+                    await asyncio.sleep(0.05)
+                    return await resolver.resolve("mail.example.com"), resolver
+
+                resumed = self.server.tls_resumed
+                result, resolver = self.run_resolver(transport, resolve)
+                self.assertEqual(result.answer[0].RDATA.DATA, "10.0.0.25")
+                self.assertEqual((resolver.reconnections, resolver.context.handshakes, resolver.context.resumed),
+                                 (1, 2, 1))
+                self.assertEqual(self.server.tls_resumed - resumed, 1)
+
+    def test_connection_pool_grows_with_concurrent_queries(self):
+        self.server.latency = 0.05
+
+        async def resolve(resolver):
+            await asyncio.gather(*(resolver.query("example.com", "NS") for _ in range(12)))
+            return [connection.queries for connection in resolver.pools["127.0.0.1"]]
+
+        self.assertEqual(self.run_resolver("https", resolve, connections=3), [4, 4, 4])
+        self.assertEqual(self.server.tls_connections, 3)
+
+    def test_untrusted_certificate_is_rejected(self):
+        async def resolve(resolver):
+            return await resolver.resolve("example.com")
+
+        with self.assertRaises(DNSClientException) as context:
+            self.run_resolver("tls", resolve, context=TLSSessionContext(), retries=0)
+        self.assertIn("CERTIFICATE_VERIFY_FAILED", str(context.exception))
+        self.assertIsInstance(TLSSessionContext(verify=False), ssl.SSLContext)
+
+    def test_error_rcode_raises_like_resolver(self):
+        async def resolve(resolver):
+            return await resolver.resolve("missing.example.com")
+
+        with self.assertRaises(DNSNameErrorException) as context:
+            self.run_resolver("https", resolve)
+        self.assertEqual(context.exception.result.events[-1][0], "response")
+
+    def test_main_and_bulk_over_dns_over_tls(self):
+        parser = TestParser("127.0.0.1", "www.example.com", port=self.server.tls_port, timeout=2)
+        parser.transport = "tls"
+        parser.tls_ca = TEST_CERT
+        parser.no_cache = True
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(main(parser), 1)
+        self.assertIn("93.184.216.34", output.getvalue())
+
+        args = TestBulkArgs(self.server.https_port, timeout=2)
+        args.transport = "https"
+        args.tls_ca = TEST_CERT
+        output = io.StringIO()
+        summary = asyncio.run(dnsBulk.run(args, io.StringIO("example.com\nexample.com MX\n"), output))
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(summary.answered, 2)
+        self.assertEqual(sorted(result["type"] for result in results), ["A", "MX"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,317 @@
+import asyncio
+import struct
+import sys
+from dnsClient import DNSPacket, DNSClientException, ResponseCache, HEADER_STRUCT, ID_STRUCT, OPT_TYPE, \
+    DEFAULT_UDP_PAYLOAD_SIZE, validate_server
+from dnsAsyncResolver import AsyncResolver
+
+BIND_ATTEMPTS = 10
+
+
+class ForwarderProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.forwarder.udp_query_received(self.transport, data, addr)
+
+    def error_received(self, exc):
+        pass    # a client that went away before its answer was sent
+
+
+class DNSForwarder:
+    """Node-local caching forwarder: answers hits from a TTL cache, forwards misses upstream with identical
+    in-flight questions coalesced into one query, refreshes popular entries before they expire and serves stale
+    answers when the upstream is unreachable (RFC 8767). Everything runs on one event loop"""
+
+    def __init__(self, upstreams, upstream_port=53, host="127.0.0.1", port=53, cache=None, timeout=2, retries=2,
+                 hedge=None, max_udp_size=DEFAULT_UDP_PAYLOAD_SIZE, prefetch_ratio=0.1, prefetch_min_hits=2,
+                 stale_ttl=86400, stale_answer_timeout=1.8, sockets=1, max_socket_uses=None):
+        self.upstreams = upstreams
+        self.upstream_port = upstream_port
+        self.host = host
+        self.port = port
+        self.cache = cache if cache is not None else ResponseCache(stale_ttl=stale_ttl)
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.max_udp_size = max_udp_size
+        self.prefetch_ratio = prefetch_ratio        # refresh once less than this fraction of the TTL is left
+        self.prefetch_min_hits = prefetch_min_hits  # hits an entry needs before it is worth refreshing
+        self.stale_answer_timeout = stale_answer_timeout    # wait before a stale answer is used, RFC 8767 section 5
+        self.sockets = sockets      # size of the upstream socket pool
+        self.max_socket_uses = max_socket_uses
+
+        self.resolver = None
+        self.udp_transport = None
+        self.tcp_server = None
+        self.inflight = {}      # cache key -> task forwarding the question upstream
+        self.popularity = {}    # cache key -> hits since the entry was last refreshed
+        self.encoded = {}       # (question bytes, EDNS0) -> (response, age, stale, encoded answer) of the last hit
+
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
+        self.prefetches = 0
+        self.stale_served = 0
+        self.upstream_failures = 0
+        self.truncated = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.resolver = await AsyncResolver(self.upstreams, self.upstream_port, timeout=self.timeout,
+                                            retries=self.retries, hedge=self.hedge, sockets=self.sockets,
+                                            max_socket_uses=self.max_socket_uses).open()
+        for attempt in range(BIND_ATTEMPTS if self.port == 0 else 1):
+            self.udp_transport, _ = await loop.create_datagram_endpoint(lambda: ForwarderProtocol(self),
+                                                                        local_addr=(self.host, self.port))
+            port = self.udp_transport.get_extra_info("sockname")[1]
+            try:
+                self.tcp_server = await asyncio.start_server(self.tcp_connection_made, self.host, port)
+                break
+            except OSError:
+                self.udp_transport.close()      # the TCP side of an ephemeral UDP port can already be taken
+                if attempt == BIND_ATTEMPTS - 1 or self.port != 0:
+                    raise
+        self.port = port
+        return self
+
+    def close(self):
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+        if self.resolver is not None:
+            self.resolver.close()
+        for task in self.inflight.values():
+            task.cancel()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def serve_forever(self):
+        async with self.tcp_server:
+            await self.tcp_server.serve_forever()
+
+    def stats(self):
+        return {"queries": self.queries, "cache_hits": self.cache_hits, "cache_misses": self.cache_misses,
+                "coalesced": self.coalesced, "prefetches": self.prefetches, "stale_served": self.stale_served,
+                "upstream_failures": self.upstream_failures, "truncated": self.truncated, "cache": self.cache.stats()}
+
+    def udp_query_received(self, transport, data, addr):
+        request = self.parse_request(data)
+        if request is None:
+            return
+        if not isinstance(request, DNSPacket):
+            transport.sendto(request, addr)     # an error answer
+            return
+        limit = self.get_udp_limit(request)
+        response = self.answer_from_cache(data, request)
+        if response is not None:
+            transport.sendto(self.truncate(request, response, limit), addr)
+            return
+        task = asyncio.ensure_future(self.answer_from_upstream(data, request))
+        task.add_done_callback(lambda task: transport.sendto(self.truncate(request, self.get_answer(data, task),
+                                                                           limit), addr)
+                               if not task.cancelled() and not transport.is_closing() else None)
+
+    async def tcp_connection_made(self, reader, writer):
+        "Answers every query of a TCP connection as soon as it is ready, so pipelined answers may come out of order"
+        def send(response):
+            if not writer.is_closing():
+                writer.write(ID_STRUCT.pack(len(response)) + response)
+
+        tasks = set()
+        try:
+            while True:
+                length = ID_STRUCT.unpack(await reader.readexactly(2))[0]
+                data = await reader.readexactly(length)
+                request = self.parse_request(data)
+                if request is None:
+                    continue
+                if not isinstance(request, DNSPacket):
+                    send(request)
+                    continue
+                response = self.answer_from_cache(data, request)
+                if response is not None:
+                    send(response)
+                    continue
+                task = asyncio.ensure_future(self.answer_from_upstream(data, request))
+                task.add_done_callback(lambda task, data=data: send(self.get_answer(data, task))
+                                       if not task.cancelled() else None)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    def parse_request(self, data):
+        "Returns the decoded query, encoded FORMERR or NOTIMP answers for queries that cannot be served, or None"
+        self.queries += 1
+        try:
+            request = DNSPacket.unpack(data)
+        except (IndexError, struct.error, DNSClientException):
+            if len(data) < HEADER_STRUCT.size:
+                return None
+            return self.build_error(data, 1)
+        if request.header.FLAGS.QR:
+            return None     # responses are never answered
+        if request.question is None:
+            return self.build_error(data, 1)
+        if request.header.FLAGS.OPCODE != 0 or DNSPacket.get_q_type(request.question.QTYPE) is None:
+            return self.build_error(data, 4)
+        return request
+
+    def get_udp_limit(self, request):
+        size = request.get_udp_payload_size()
+        return 512 if size is None else max(512, min(size, self.max_udp_size))
+
+    def answer_from_cache(self, data, request):
+        "Returns the encoded answer to a request when the cache holds a fresh response, scheduling prefetches"
+        question = request.question
+        entry = self.cache.get_entry(question.QNAME, question.QTYPE, question.QCLASS)
+        now = self.cache.clock()
+        if entry is None or now >= entry[1]:
+            return None
+        stored, expires, response = entry
+        self.cache_hits += 1
+
+        key = self.cache.get_key(question.QNAME, question.QTYPE, question.QCLASS)
+        hits = self.popularity[key] = self.popularity.get(key, 0) + 1
+        if (hits >= self.prefetch_min_hits and expires - now <= (expires - stored) * self.prefetch_ratio and
+                key not in self.inflight):
+            self.prefetches += 1
+            self.popularity.pop(key, None)
+            self.forward(question)
+        if len(self.popularity) > self.cache.max_entries:
+            self.popularity.clear()
+        try:
+            return self.encode(data, request, response, int(now - stored), False)
+        except Exception:
+            return self.build_error(data, 2)    # a cached response that cannot be encoded again
+
+    async def answer_from_upstream(self, data, request):
+        question = request.question
+        self.cache_misses += 1
+        task = self.forward(question)
+        stale = self.cache.get_entry(question.QNAME, question.QTYPE, question.QCLASS)
+        try:
+            if stale is None:
+                response = await asyncio.shield(task)
+            else:
+                response = await asyncio.wait_for(asyncio.shield(task), self.stale_answer_timeout)
+            # an upstream SERVFAIL or REFUSED is no better than no answer when a stale one exists (RFC 8767)
+            if stale is None or response.header.FLAGS.RCODE not in (2, 5):
+                return self.encode(data, request, response, 0, False)
+        except Exception:
+            pass    # a slow upstream query carries on and refreshes the cache for later queries
+        if stale is not None:
+            self.stale_served += 1
+            stored, _, response = stale
+            return self.encode(data, request, response, int(self.cache.clock() - stored), True)
+        return self.build_error(data, 2)
+
+    def get_answer(self, data, task):
+        "The answer of a finished upstream task, SERVFAIL if it failed rather than no answer at all"
+        if task.exception() is not None:
+            return self.build_error(data, 2)
+        return task.result()
+
+    def forward(self, question):
+        "Returns the task resolving a question upstream, shared by every query asking it while it is in flight"
+        key = self.cache.get_key(question.QNAME, question.QTYPE, question.QCLASS)
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        task = self.inflight[key] = asyncio.ensure_future(self.query_upstream(question))
+        task.add_done_callback(lambda task: self.upstream_query_done(key, task))
+        return task
+
+    async def query_upstream(self, question):
+        response = await self.resolver.query(question.QNAME, DNSPacket.get_q_type(question.QTYPE))
+        self.cache.put(response)
+        return response
+
+    def upstream_query_done(self, key, task):
+        del self.inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.upstream_failures += 1
+
+    def encode(self, data, request, response, age, stale):
+        """Encodes the answer to a request from a cached or upstream response. The encoding is reused while the
+        response and its age in seconds stay the same, with only the ID and RD flag patched in"""
+        question_end = DNSPacket.Question.unpack_from(data, HEADER_STRUCT.size)[1]
+        edns = request.get_opt_record() is not None
+        key = (bytes(data[HEADER_STRUCT.size:question_end]), edns)
+        encoded = self.encoded.get(key)
+        if encoded is None or encoded[0] is not response or encoded[1] != age or encoded[2] != stale:
+            aged = ResponseCache.age_response(response, age, stale)
+            additional = [record for record in aged.additional if record.TYPE != OPT_TYPE]
+            if edns:
+                additional.append(DNSPacket.Answer.get_opt_record(self.max_udp_size))
+            flags = DNSPacket.Header.Flags(1, 0, 0, 0, 1, 1, 0, response.header.FLAGS.RCODE)
+            header = DNSPacket.Header(flags, 1, len(aged.answer), len(aged.authority), len(additional), 0)
+            encoded = (response, age, stale,
+                       DNSPacket(header, request.question, aged.answer, aged.authority, additional).to_bytes())
+            if len(self.encoded) >= self.cache.max_entries:
+                self.encoded.clear()
+            self.encoded[key] = encoded
+        answer = bytearray(encoded[3])
+        answer[0:2] = data[0:2]
+        answer[2] = (answer[2] & 0xFE) | (data[2] & 0x01)
+        return bytes(answer)
+
+    def truncate(self, request, response, limit):
+        "Replaces a UDP answer larger than the client accepts by an empty one with TC set, so it retries over TCP"
+        if len(response) <= limit:
+            return response
+        self.truncated += 1
+        header = DNSPacket.Header.unpack_from(response)
+        header.FLAGS.TC = 1
+        header.ANCOUNT = header.NSCOUNT = 0
+        additional = [DNSPacket.Answer.get_opt_record(self.max_udp_size)] if request.get_opt_record() else []
+        header.ARCOUNT = len(additional)
+        return DNSPacket(header, request.question, [], [], additional).to_bytes()
+
+    @staticmethod
+    def build_error(data, rcode):
+        "Encodes an answer with only the header, echoing the ID, opcode and RD of the query"
+        header = DNSPacket.Header.unpack_from(data)
+        flags = DNSPacket.Header.Flags(1, header.FLAGS.OPCODE, 0, 0, header.FLAGS.RD, 1, 0, rcode)
+        try:
+            question_end = DNSPacket.Question.unpack_from(data, HEADER_STRUCT.size)[1]
+        except (IndexError, struct.error, DNSClientException):
+            return DNSPacket.Header(flags, 0, 0, 0, 0, header.ID).to_bytes()
+        return DNSPacket.Header(flags, 1, 0, 0, 0, header.ID).to_bytes() + bytes(data[HEADER_STRUCT.size:question_end])
+
+
+async def run(args):
+    async with DNSForwarder(args.server, args.p, host=args.listen, port=args.daemon, timeout=args.t, retries=args.r,
+                            hedge=getattr(args, "hedge", None), sockets=getattr(args, "sockets", None) or 1,
+                            max_socket_uses=getattr(args, "socket_uses", None),
+                            max_udp_size=getattr(args, "edns", DEFAULT_UDP_PAYLOAD_SIZE) or 512) as forwarder:
+        print("Forwarding {}:{} to {}".format(forwarder.host, forwarder.port, ", ".join(forwarder.resolver.servers)),
+              file=sys.stderr)
+        await forwarder.serve_forever()
+
+
+def main(args):
+    if not validate_server(args.server):
+        return 0
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 1
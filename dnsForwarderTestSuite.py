@@ -0,0 +1,177 @@
+import unittest
+import asyncio
+import socket
+from dnsClient import DNSPacket, ResponseCache
+from dnsAsyncResolver import AsyncResolver
+from dnsForwarder import DNSForwarder
+from dnsTestServer import DNSTestServer, Zone
+
+
+class TestDNSForwarder(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = DNSTestServer().start()
+        self.addCleanup(self.upstream.stop)
+        self.now = [1000.0]
+        self.cache = ResponseCache(clock=lambda: self.now[0], stale_ttl=3600)
+
+    def run_forwarder(self, coroutine_function, client_options=None, **forwarder_options):
+        async def run():
+            async with DNSForwarder("127.0.0.1", self.upstream.port, port=0, cache=self.cache,
+                                    **forwarder_options) as forwarder:
+                options = dict({"timeout": 2, "retries": 0}, **(client_options or {}))
+                async with AsyncResolver("127.0.0.1", forwarder.port, **options) as client:
+                    return await coroutine_function(forwarder, client)
+        return asyncio.run(run())
+
+    def test_misses_are_forwarded_and_hits_served_from_cache(self):
+        async def resolve(forwarder, client):
+            first = await client.query("www.example.com")
+            self.now[0] += 100
+            second = await client.query("www.example.com")
+            return first, second, forwarder
+
+        first, second, forwarder = self.run_forwarder(resolve)
+        self.assertEqual([record.RDATA.DATA for record in second.answer], ["example.com", "93.184.216.34"])
+        self.assertEqual([record.TTL for record in first.answer], [300, 300])
+        self.assertEqual([record.TTL for record in second.answer], [200, 200])
+        self.assertEqual((second.header.FLAGS.AA, second.header.FLAGS.RA), (0, 1))
+        self.assertEqual(self.upstream.udp_queries, 1)
+        self.assertEqual((forwarder.cache_misses, forwarder.cache_hits), (1, 1))
+
+    def test_identical_questions_in_flight_are_coalesced(self):
+        self.upstream.latency = 0.1
+
+        async def resolve(forwarder, client):
+            responses = await asyncio.gather(*(client.query("example.com", "MX") for _ in range(20)))
+            return responses, forwarder
+
+        responses, forwarder = self.run_forwarder(resolve)
+        self.assertTrue(all(len(response.answer) == 2 for response in responses))
+        self.assertEqual(self.upstream.udp_queries, 1)
+        self.assertEqual(forwarder.coalesced, 19)
+
+    def test_popular_entries_are_prefetched_before_expiry(self):
+        async def resolve(forwarder, client):
+            await client.query("example.com")
+            self.now[0] += 280      # 20 of the 300 seconds left
+            await client.query("example.com")
+            await client.query("example.com")
+            for _ in range(50):
+                if self.upstream.udp_queries == 2 and not forwarder.inflight:
+                    break
+                await asyncio.sleep(0.01)
+            return forwarder
+
+        forwarder = self.run_forwarder(resolve)
+        self.assertEqual(forwarder.prefetches, 1)
+        self.assertEqual(self.upstream.udp_queries, 2)
+        stored, expires, _ = self.cache.get_entry("example.com", 0x0001)
+        self.assertEqual(expires - self.now[0], 300)
+
+    def test_stale_answer_served_when_upstream_is_down(self):
+        async def resolve(forwarder, client):
+            client.rtt_estimator.min_rto = 1.0     # outlasts the forwarder giving up on its upstream
+            await client.query("example.com")
+            self.now[0] += 400
+            self.upstream.loss = 1.0
+            stale = await client.query("example.com")
+            missing = await client.query("mail.example.com")
+            return stale, missing, forwarder
+
+        stale, missing, forwarder = self.run_forwarder(resolve, timeout=0.1, retries=0)
+        self.assertEqual(stale.answer[0].RDATA.DATA, "93.184.216.34")
+        self.assertEqual(stale.answer[0].TTL, ResponseCache.STALE_ANSWER_TTL)
+        self.assertEqual(missing.header.FLAGS.RCODE, 2)
+        self.assertEqual(forwarder.stale_served, 1)
+        self.assertEqual(forwarder.upstream_failures, 2)
+
+    def test_stale_answer_replaces_an_upstream_servfail(self):
+        async def resolve(forwarder, client):
+            await client.query("example.com")
+            self.now[0] += 400
+            self.upstream.rcode = 2
+            stale = await client.query("example.com")
+            failed = await client.query("mail.example.com")
+            return stale, failed, forwarder
+
+        stale, failed, forwarder = self.run_forwarder(resolve)
+        self.assertEqual((stale.header.FLAGS.RCODE, stale.answer[0].RDATA.DATA), (0, "93.184.216.34"))
+        self.assertEqual(stale.answer[0].TTL, ResponseCache.STALE_ANSWER_TTL)
+        self.assertEqual((failed.header.FLAGS.RCODE, failed.answer), (2, []))
+        self.assertEqual(forwarder.stale_served, 1)
+
+    def test_unexpected_upstream_errors_are_answered_with_servfail(self):
+        async def resolve(forwarder, client):
+            async def broken(name, qtype):
+                raise RuntimeError("resolver bug")
+            forwarder.resolver.query = broken
+            udp = await client.query("example.com")
+            packet = DNSPacket.get_request_dns_packet("example.org", "A")
+            tcp = await client.query_tcp(packet.to_bytes(), (packet.header.ID, "example.org", 0x0001, 0x0001))
+            return udp, tcp, forwarder
+
+        udp, tcp, forwarder = self.run_forwarder(resolve)
+        self.assertEqual((udp.header.FLAGS.RCODE, tcp.header.FLAGS.RCODE), (2, 2))
+        self.assertEqual(forwarder.upstream_failures, 2)
+
+    def test_cached_names_round_trip_and_unencodable_ones_get_servfail(self):
+        self.upstream.zone = Zone.from_text("www.example.com. 300 CNAME caf\xe9.example.com.")
+
+        async def resolve(forwarder, client):
+            first = await client.query("www.example.com")
+            self.now[0] += 10
+            cached = await client.query("www.example.com")
+            response = self.cache.get_entry("www.example.com", 0x0001)[2]
+            record = response.answer[0]
+            rdata = DNSPacket.RDATA("\u2603.example.com", None, None)
+            self.cache.put(DNSPacket(response.header, response.question,
+                                     [DNSPacket.Answer(record.NAME, record.TYPE, record.CLASS, 300, 0, rdata)]))
+            unencodable = await client.query("www.example.com")
+            return first, cached, unencodable, forwarder
+
+        first, cached, unencodable, forwarder = self.run_forwarder(resolve)
+        self.assertEqual(first.answer[0].RDATA.DATA, "caf\xe9.example.com")
+        self.assertEqual((cached.answer[0].RDATA.DATA, cached.answer[0].TTL), ("caf\xe9.example.com", 290))
+        self.assertEqual((unencodable.header.FLAGS.RCODE, unencodable.answer), (2, []))
+        self.assertEqual((forwarder.cache_hits, self.upstream.udp_queries), (2, 1))
+
+    def test_large_answers_are_truncated_over_udp_and_complete_over_tcp(self):
+        self.upstream.zone = Zone.from_text("\n".join("big.example.com. 60 A 10.0.{}.{}".format(i // 250, i % 250)
+                                                      for i in range(60)))
+
+        async def resolve(forwarder, client):
+            return await client.query("big.example.com"), forwarder
+
+        response, forwarder = self.run_forwarder(resolve, client_options={"udp_payload_size": 0})
+        self.assertEqual(len(response.answer), 60)
+        self.assertEqual(forwarder.truncated, 1)
+        self.assertEqual(forwarder.coalesced + forwarder.cache_hits, 1)
+
+    def test_answers_echo_id_and_question_of_each_query(self):
+        def query(port, ID, name, qtype=0x0001):
+            flags = DNSPacket.Header.Flags.get_request_flags(0b0)
+            header = DNSPacket.Header(flags, 1, 0, 0, 0, ID)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.settimeout(2)
+                s.sendto(DNSPacket(header, DNSPacket.Question(name, qtype, 0x0001), None).to_bytes(),
+                         ("127.0.0.1", port))
+                return DNSPacket.unpack(s.recv(512))
+
+        async def resolve(forwarder, client):
+            loop = asyncio.get_running_loop()
+            first = await loop.run_in_executor(None, query, forwarder.port, 0x1234, "ExAmPlE.com")
+            second = await loop.run_in_executor(None, query, forwarder.port, 0x4321, "example.COM")
+            unsupported = await loop.run_in_executor(None, query, forwarder.port, 7, "example.com", 0x00ff)
+            return first, second, unsupported
+
+        first, second, unsupported = self.run_forwarder(resolve)
+        self.assertEqual((first.header.ID, first.question.QNAME), (0x1234, "ExAmPlE.com"))
+        self.assertEqual((second.header.ID, second.question.QNAME), (0x4321, "example.COM"))
+        self.assertEqual(second.answer[0].RDATA.DATA, "93.184.216.34")
+        self.assertEqual((unsupported.header.ID, unsupported.header.FLAGS.RCODE), (7, 4))
+        self.assertEqual(self.upstream.udp_queries, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import unittest
+import contextlib
+import io
+import random
+import time
+import dnsClient
+from dnsClient import DNSPacket, DNSClientException, DNSMalformedPacketException, HEADER_STRUCT, RR_STRUCT, \
+    QUESTION_TAIL_STRUCT, MAX_POINTER_HOPS, get_response_key, get_response_information
+from dnsBenchmark import build_corpus
+
+
+def header(qdcount=1, ancount=0, nscount=0, arcount=0):
+    return HEADER_STRUCT.pack(0x1234, 0x8180, qdcount, ancount, nscount, arcount)
+
+def question(name=b"\x07example\x03com\x00"):
+    return name + QUESTION_TAIL_STRUCT.pack(0x0001, 0x0001)
+
+def answer(rtype, rdata, name=b"\xc0\x0c", rdlength=None):
+    return name + RR_STRUCT.pack(rtype, 0x0001, 300, len(rdata) if rdlength is None else rdlength) + rdata
+
+def pointer_chain(hops):
+    "A record whose name reaches the question through `hops` compression pointers, each pointing at the one before"
+    first = HEADER_STRUCT.size + len(question())     # where the RDATA holding the chain starts
+    first += len(answer(0xff00, b""))
+    chain = b"".join((0xC000 | (first + 2 * (i - 1) if i else HEADER_STRUCT.size)).to_bytes(2, "big")
+                     for i in range(hops - 1))
+    last = (0xC000 | (first + 2 * (hops - 2))).to_bytes(2, "big")
+    return header(ancount=2) + question() + answer(0xff00, chain) + answer(0x0001, b"\x0a\x00\x00\x01", name=last)
+
+
+class TestMalformedPackets(unittest.TestCase):
+
+    LABEL = b"\x3f" + b"a" * 63
+
+    CORPUS = {
+        "empty": b"",
+        "truncated_header": header()[:7],
+        "truncated_question": header() + question()[:-2],
+        "self_pointer": header() + b"\xc0\x0c" + QUESTION_TAIL_STRUCT.pack(1, 1),
+        "pointer_cycle": header() + b"\xc0\x0e\xc0\x0c" + QUESTION_TAIL_STRUCT.pack(1, 1),
+        "forward_pointer": header() + b"\x01a\xc0\x20" + QUESTION_TAIL_STRUCT.pack(1, 1) + b"\x00" * 20,
+        "truncated_pointer": header() + b"\x01a\xc0",
+        "label_past_end": header() + b"\x3fabc",
+        "reserved_label_type": header() + b"\x41abc\x00" + QUESTION_TAIL_STRUCT.pack(1, 1),
+        "name_over_255_bytes": header() + question(LABEL * 4 + b"\x00"),
+        "compressed_name_over_255_bytes": header(ancount=1) + question(LABEL * 3 + b"\x00") +
+        answer(0x0001, b"\x0a\x00\x00\x01", name=LABEL + b"\xc0\x0c"),
+        "counts_past_end": header(ancount=0xffff, nscount=0xffff, arcount=0xffff) + question(),
+        "rdlength_past_end": header(ancount=1) + question() + answer(0x0001, b"\x0a\x00\x00\x01", rdlength=100),
+        "short_a_record": header(ancount=1) + question() + answer(0x0001, b"\x0a\x00\x00"),
+        "long_aaaa_record": header(ancount=1) + question() + answer(0x001c, b"\x00" * 17),
+        "txt_string_overrun": header(ancount=1) + question() + answer(0x0010, b"\x05ab"),
+        "mx_name_into_next_record": header(ancount=2) + question() + answer(0x000f, b"\x00\x0a\x04mail") +
+        answer(0x0001, b"\x0a\x00\x00\x01"),
+        "caa_tag_overrun": header(ancount=1) + question() + answer(0x0101, b"\x00\x09issue"),
+        "opt_option_overrun": header(arcount=1) + question() + answer(0x0029, b"\x00\x0a\x00\x08abcd", name=b"\x00"),
+        "too_many_pointer_hops": pointer_chain(MAX_POINTER_HOPS + 1),
+    }
+
+    def test_corpus_raises_malformed_packet(self):
+        for name, data in self.CORPUS.items():
+            with self.subTest(packet=name):
+                with self.assertRaises(DNSMalformedPacketException) as context:
+                    DNSPacket.unpack(data)
+                self.assertIsInstance(context.exception, DNSClientException)
+                self.assertIsNotNone(context.exception.offset)
+
+    def test_pointer_hop_limit(self):
+        response = DNSPacket.unpack(pointer_chain(MAX_POINTER_HOPS))
+        self.assertEqual(response.answer[1].NAME, "example.com")
+        self.assertEqual(response.answer[1].RDATA.DATA, "10.0.0.1")
+
+    def test_response_key_and_legacy_decoder(self):
+        for name in ("truncated_header", "self_pointer", "forward_pointer", "label_past_end"):
+            with self.subTest(packet=name), self.assertRaises(DNSMalformedPacketException):
+                get_response_key(self.CORPUS[name])
+
+        request_header = DNSPacket.Header(DNSPacket.Header.Flags.get_request_flags(0b0), 1, 0, 0, 0, 0x1234)
+        for name in ("rdlength_past_end", "short_a_record", "counts_past_end", "truncated_header"):
+            with self.subTest(packet=name), contextlib.redirect_stdout(io.StringIO()):
+                with self.assertRaises(DNSMalformedPacketException):
+                    get_response_information(self.CORPUS[name], DNSPacket.Question("example.com", 1, 1),
+                                             request_header)
+        with self.assertRaises(DNSMalformedPacketException):
+            dnsClient.get_alias(b"\x03www\xc0\x00", 0)
+
+    def test_decoding_is_linear_in_packet_length(self):
+        # a 64KB body of records that each point at the question, behind counts claiming far more
+        body = answer(0x0001, b"\x0a\x00\x00\x01") * 4000
+        data = header(ancount=0xffff) + question() + body
+        start = time.perf_counter()
+        with self.assertRaises(DNSMalformedPacketException):
+            DNSPacket.unpack(data)
+        self.assertLess(time.perf_counter() - start, 1)
+
+
+class TestRandomMutations(unittest.TestCase):
+
+    MUTATIONS = 3000
+
+    def mutate(self, rng, data):
+        data = bytearray(data)
+        operation = rng.randrange(5)
+        if operation == 0:      # flip a few bits
+            for _ in range(rng.randint(1, 4)):
+                position = rng.randrange(len(data))
+                data[position] ^= 1 << rng.randrange(8)
+        elif operation == 1:    # cut the packet short
+            del data[rng.randrange(len(data)):]
+        elif operation == 2:    # insert random bytes
+            position = rng.randrange(len(data))
+            data[position:position] = bytes(rng.randrange(256) for _ in range(rng.randint(1, 8)))
+        elif operation == 3:    # plant a compression pointer anywhere
+            position = rng.randrange(HEADER_STRUCT.size, len(data) - 1)
+            data[position:position + 2] = (0xC000 | rng.randrange(len(data) + 16)).to_bytes(2, "big")
+        else:                   # rewrite a count or length field with a random value
+            position = rng.randrange(4, len(data) - 1)
+            data[position:position + 2] = rng.randrange(0x10000).to_bytes(2, "big")
+        return bytes(data)
+
+    def test_mutated_responses_decode_or_raise_malformed_packet(self):
+        rng = random.Random(21)
+        corpus = list(build_corpus().values())
+        decoded = 0
+        start = time.perf_counter()
+        for i in range(self.MUTATIONS):
+            data, question, request_header = corpus[i % len(corpus)]
+            mutated = self.mutate(rng, data)
+            try:
+                response = DNSPacket.unpack(mutated)
+            except DNSMalformedPacketException:
+                pass
+            else:
+                decoded += 1
+                for record in response.answer + response.authority + response.additional:
+                    record.to_dict()
+            try:
+                get_response_key(mutated)
+            except DNSMalformedPacketException:
+                pass
+            if i % 10 == 0:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    try:
+                        get_response_information(mutated, question, request_header)
+                    except DNSClientException:
+                        pass
+        self.assertGreater(decoded, 0)
+        self.assertLess(time.perf_counter() - start, 30)
+
+    def test_valid_responses_round_trip(self):
+        for name, (data, _, _) in build_corpus().items():
+            with self.subTest(response=name):
+                response = DNSPacket.unpack(data)
+                self.assertEqual(response.to_bytes(), data)
+                self.assertEqual(get_response_key(data)[1:], (response.question.QNAME.lower(), response.question.QTYPE,
+                                                              response.question.QCLASS))
+
+
+if __name__ == '__main__':
+    unittest.main()
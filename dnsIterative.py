@@ -0,0 +1,261 @@
+import time
+from collections import OrderedDict
+from dnsClient import DNSPacket, DNSClientException, DNSResponseException, DNSUnexpectedResponseException, \
+    QueryResult, Resolver, RESPONSE_CACHE, DEFAULT_UDP_PAYLOAD_SIZE, OPT_TYPE, parse_servers
+from dnsStats import STATS
+
+ROOT_HINTS = {
+    "a.root-servers.net": "198.41.0.4",
+    "b.root-servers.net": "170.247.170.2",
+    "c.root-servers.net": "192.33.4.12",
+    "d.root-servers.net": "199.7.91.13",
+    "e.root-servers.net": "192.203.230.10",
+    "f.root-servers.net": "192.5.5.241",
+    "g.root-servers.net": "192.112.36.4",
+    "h.root-servers.net": "198.97.190.53",
+    "i.root-servers.net": "192.36.148.17",
+    "j.root-servers.net": "192.58.128.30",
+    "k.root-servers.net": "193.0.14.129",
+    "l.root-servers.net": "199.7.83.42",
+    "m.root-servers.net": "202.12.27.33",
+}
+MAX_REFERRALS = 16      # referrals followed for one name before giving up
+MAX_CNAME_CHAIN = 8
+MAX_DEPTH = 4           # nested lookups of name server addresses that came without glue
+
+
+def normalize(name):
+    return name.rstrip(".").lower()
+
+def is_subdomain(name, zone):
+    "Whether a normalized name is the zone itself or below it, the root zone being ''"
+    return zone == "" or name == zone or name.endswith("." + zone)
+
+
+class Delegation:
+    "Name servers of a zone cut and the addresses known for them, from glue or looked up separately"
+    __slots__ = ("zone", "nameservers", "addresses", "expires")
+
+    def __init__(self, zone, nameservers, addresses, expires):
+        self.zone = zone
+        self.nameservers = nameservers
+        self.addresses = addresses  # name server -> [IPv4 address]
+        self.expires = expires
+
+    def get_servers(self):
+        return [address for nameserver in self.nameservers for address in self.addresses.get(nameserver, ())]
+
+
+class DelegationCache:
+    """Delegations by zone cut, expired by the TTL of their NS records, so lookups start at the closest enclosing
+    zone with known name servers instead of the root"""
+
+    def __init__(self, root_hints=None, max_entries=10000, max_ttl=86400, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self.delegations = OrderedDict()    # zone -> Delegation
+        self.root = self.get_root_delegation(ROOT_HINTS if root_hints is None else root_hints)
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.delegations)
+
+    @staticmethod
+    def get_root_delegation(root_hints):
+        "Root hints are a name -> address dict or, when only addresses are known, a list of them"
+        if not isinstance(root_hints, dict):
+            root_hints = {address: address for address in parse_servers(root_hints)}
+        return Delegation("", list(root_hints), {name: [address] for name, address in root_hints.items()},
+                          float("inf"))
+
+    def put(self, zone, nameservers, addresses, ttl):
+        delegation = Delegation(zone, nameservers, addresses, self.clock() + min(ttl, self.max_ttl))
+        self.delegations.pop(zone, None)
+        self.delegations[zone] = delegation
+        while len(self.delegations) > self.max_entries:
+            self.delegations.popitem(last=False)
+        return delegation
+
+    def find(self, name):
+        "Returns the unexpired delegation of the closest zone cut enclosing a name, the root when none is cached"
+        name = normalize(name)
+        labels = name.split(".") if name else []
+        now = self.clock()
+        for i in range(len(labels)):
+            zone = ".".join(labels[i:])
+            delegation = self.delegations.get(zone)
+            if delegation is None:
+                continue
+            if now >= delegation.expires:
+                del self.delegations[zone]
+                continue
+            self.delegations.move_to_end(zone)
+            self.hits += 1
+            return delegation
+        self.misses += 1
+        return self.root
+
+    def clear(self):
+        self.delegations.clear()
+
+
+class IterativeResolver:
+    """Resolves names without asking for recursion: starting from the root hints it follows referrals, using the NS
+    records of the authority section and the glue of the additional section, down to a server that answers
+    authoritatively, and restarts at the target of CNAMEs that lead out of that server's zone. resolve() returns a
+    QueryResult and raises like Resolver.resolve"""
+
+    def __init__(self, root_hints=None, port=53, timeout=5, retries=3, udp_payload_size=DEFAULT_UDP_PAYLOAD_SIZE,
+                 cache=RESPONSE_CACHE, delegations=None, stats=STATS, capture=None):
+        self.delegations = delegations if delegations is not None else DelegationCache(root_hints)
+        # authoritative servers are queried one step at a time and only final answers go to the cache
+        self.resolver = Resolver(self.delegations.root.get_servers(), port, timeout=timeout, retries=retries,
+                                 udp_payload_size=udp_payload_size, cache=None, stats=stats, recursion_desired=False,
+                                 capture=capture)
+        self.cache = cache
+
+        self.queries = 0
+        self.referrals = 0
+
+    def open(self):
+        self.resolver.open()
+        return self
+
+    def close(self):
+        self.resolver.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve(self, name, qtype="A"):
+        if DNSPacket.Question.get_q_num(qtype) is None:
+            raise DNSClientException("Unsupported query type: {}".format(qtype))
+        question = DNSPacket.Question.get_request_question(name, qtype)
+        if self.cache is not None:
+            cached = self.cache.get(question.QNAME, question.QTYPE, question.QCLASS)
+            if cached is not None:
+                return Resolver.check_result(QueryResult(name, qtype, cached, from_cache=True))
+
+        start = time.perf_counter()
+        result = QueryResult(name, qtype)
+        chain = []      # CNAME records followed so far
+        target = normalize(name)
+        seen = {target}
+        self.queries += 1
+        while True:
+            try:
+                step = self.lookup(target, qtype, result, 0)
+            except DNSResponseException as e:
+                step = e.result     # an error RCODE from the authoritative servers is the answer
+            records, target = self.follow_cnames(step.answer, target, question.QTYPE)
+            chain += records
+            if target is None:
+                break
+            if target in seen or len(chain) > MAX_CNAME_CHAIN:
+                raise DNSUnexpectedResponseException("CNAME loop or chain too long at {}".format(target), result)
+            seen.add(target)
+
+        result.response = self.build_response(question, step.response, chain)
+        result.server = step.server
+        result.response_time = time.perf_counter() - start
+        return Resolver.check_result(result, self.cache)
+
+    def lookup(self, name, qtype, result, depth):
+        "Queries the closest known zone cut and follows referrals until a server answers with authority"
+        delegation = self.delegations.find(name)
+        for _ in range(MAX_REFERRALS):
+            step = self.query(name, qtype, self.get_servers(delegation, result, depth), result)
+            referral = self.get_referral(step.response, name, delegation.zone)
+            if referral is None:
+                if step.response.header.FLAGS.AA or step.answer:
+                    return step
+                raise DNSUnexpectedResponseException("Lame delegation: {} answered for zone {} without authority or a "
+                                                     "referral".format(step.server, delegation.zone or "."), result)
+            self.referrals += 1
+            result.events.append(("referral", step.server, referral.zone))
+            delegation = referral
+        raise DNSClientException("Too many referrals resolving {}".format(name), result)
+
+    def query(self, name, qtype, servers, result):
+        "Sends one non-recursive query to the servers of a zone, adding its events and retries to the result"
+        try:
+            step = self.resolver.resolve(name, qtype, servers)
+        except DNSClientException as e:
+            if e.result is not None and e.result is not result:
+                result.events += e.result.events
+                result.retries += e.result.retries
+            raise
+        result.events += step.events
+        result.retries += step.retries
+        return step
+
+    def get_servers(self, delegation, result, depth):
+        "Returns the addresses of a zone's name servers, looking up one that came without glue when needed"
+        servers = delegation.get_servers()
+        if servers:
+            return servers
+        if depth < MAX_DEPTH:
+            for nameserver in delegation.nameservers:
+                if is_subdomain(nameserver, delegation.zone):
+                    continue    # only glue can give the address of a name server inside its own zone
+                try:
+                    step = self.lookup(nameserver, "A", result, depth + 1)
+                except DNSClientException:
+                    continue
+                addresses = [record.RDATA.DATA for record in step.answer if record.TYPE == 0x0001]
+                if addresses:
+                    delegation.addresses[nameserver] = addresses
+                    return addresses
+        raise DNSClientException("No address found for the name servers of {}".format(delegation.zone or "."),
+                                 result)
+
+    def get_referral(self, response, name, zone):
+        """Caches and returns the delegation a referral points to, or None when the response is not a referral. Only
+        cuts below the queried zone that enclose the name are followed, and only glue inside the queried zone is
+        trusted"""
+        if response.header.FLAGS.AA or response.answer or response.header.FLAGS.RCODE != 0:
+            return None
+        ns_records = [record for record in response.authority if record.TYPE == 0x0002]
+        if not ns_records:
+            return None
+        cut = normalize(ns_records[0].NAME)
+        if cut == zone or not is_subdomain(cut, zone) or not is_subdomain(name, cut):
+            return None
+        nameservers = [normalize(record.RDATA.DATA) for record in ns_records if normalize(record.NAME) == cut]
+        addresses = {}
+        for record in response.additional:
+            owner = normalize(record.NAME)
+            if record.TYPE == 0x0001 and owner in nameservers and is_subdomain(owner, zone):
+                addresses.setdefault(owner, []).append(record.RDATA.DATA)
+        return self.delegations.put(cut, nameservers, addresses, min(record.TTL for record in ns_records))
+
+    @staticmethod
+    def follow_cnames(records, name, qtype):
+        """Follows the CNAMEs of an answer starting at name. Returns (records, None) when the answer is complete, or
+        the CNAMEs followed with the name to restart at when the chain leaves the answer"""
+        chain = []
+        for _ in range(MAX_CNAME_CHAIN):
+            matching = [record for record in records if record.TYPE == qtype and normalize(record.NAME) == name]
+            if matching:
+                return (chain + matching, None)
+            cname = next((record for record in records if record.TYPE == 0x0005 and normalize(record.NAME) == name),
+                         None)
+            if cname is None or qtype == 0x0005:
+                return (chain, name if chain else None)
+            chain.append(cname)
+            name = normalize(cname.RDATA.DATA)
+        return (chain, name)
+
+    @staticmethod
+    def build_response(question, response, answers):
+        "Combines the CNAME chain and the final authoritative answer into one response, as a recursive server would"
+        flags = DNSPacket.Header.Flags(1, 0, response.header.FLAGS.AA, 0, 1, 1, 0, response.header.FLAGS.RCODE)
+        additional = [record for record in response.additional if record.TYPE != OPT_TYPE]
+        header = DNSPacket.Header(flags, 1, len(answers), len(response.authority), len(additional), response.header.ID)
+        return DNSPacket(header, question, answers, response.authority, additional)
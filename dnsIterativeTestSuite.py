@@ -0,0 +1,124 @@
+import unittest
+import io
+import contextlib
+import dnsClient
+from dnsClient import DNSPacket, DNSNameErrorException, main
+from dnsIterative import IterativeResolver, DelegationCache
+from dnsTestServer import DNSTestServer, Zone
+from dnsClientTestSuite import TestParser
+
+ROOT_ZONE = """
+.                    86400  SOA   a.root-servers.net. nstld.verisign-grs.com. 1 1800 900 604800 86400
+.                    518400 NS    a.root-servers.net.
+com.                 172800 NS    a.gtld-servers.net.
+a.gtld-servers.net.  172800 A     127.0.0.2
+"""
+
+COM_ZONE = """
+com.                 900    SOA   a.gtld-servers.net. nstld.verisign-grs.com. 1 1800 900 604800 86400
+example.com.         172800 NS    ns1.example.com.
+ns1.example.com.     172800 A     127.0.0.3
+other.com.           172800 NS    ns.example.com.      ; no glue, the address comes from example.com
+"""
+
+EXAMPLE_ZONE = """
+example.com.         3600   SOA   ns1.example.com. admin.example.com. 1 7200 900 1209600 300
+example.com.         3600   NS    ns1.example.com.
+example.com.         300    A     93.184.216.34
+www.example.com.     300    CNAME example.com.
+alias.example.com.   300    CNAME www.other.com.
+ns1.example.com.     3600   A     127.0.0.3
+ns.example.com.      3600   A     127.0.0.4
+"""
+
+OTHER_ZONE = """
+other.com.           3600   SOA   ns.example.com. admin.other.com. 1 7200 900 1209600 300
+other.com.           3600   NS    ns.example.com.
+www.other.com.       60     A     10.0.0.80
+"""
+
+
+class TestIterativeResolver(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+        dnsClient.SERVER_HEALTH.clear()
+        dnsClient.RTT_ESTIMATORS.clear()
+        # the port is common to every server a referral leads to, so each zone gets its own loopback address
+        self.root = self.start_server(ROOT_ZONE, "127.0.0.1", 0)
+        self.com = self.start_server(COM_ZONE, "127.0.0.2", self.root.port)
+        self.example = self.start_server(EXAMPLE_ZONE, "127.0.0.3", self.root.port)
+        self.other = self.start_server(OTHER_ZONE, "127.0.0.4", self.root.port)
+        self.now = [0.0]
+        self.delegations = DelegationCache(["127.0.0.1"], clock=lambda: self.now[0])
+
+    def start_server(self, zone, host, port):
+        server = DNSTestServer(Zone.from_text(zone), host=host, port=port, recursion_available=False).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def resolver(self, **options):
+        resolver = IterativeResolver(port=self.root.port, timeout=1, cache=None, delegations=self.delegations,
+                                     **options)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def test_referrals_are_followed_from_the_root(self):
+        result = self.resolver().resolve("www.example.com")
+        self.assertEqual([(record.TYPE, record.RDATA.DATA) for record in result.answer],
+                         [(5, "example.com"), (1, "93.184.216.34")])
+        self.assertEqual((result.rcode, result.authoritative, result.server), (0, True, "127.0.0.3"))
+        self.assertEqual([(server, zone) for event, server, zone in result.events if event == "referral"],
+                         [("127.0.0.1", "com"), ("127.0.0.2", "example.com")])
+        self.assertEqual((self.root.udp_queries, self.com.udp_queries, self.example.udp_queries), (1, 1, 1))
+
+    def test_cached_delegations_skip_the_upper_levels(self):
+        resolver = self.resolver()
+        resolver.resolve("www.example.com")
+        result = resolver.resolve("ns1.example.com")
+        self.assertEqual(result.answer[0].RDATA.DATA, "127.0.0.3")
+        self.assertEqual((self.root.udp_queries, self.com.udp_queries, self.example.udp_queries), (1, 1, 2))
+        self.assertEqual(sorted(self.delegations.delegations), ["com", "example.com"])
+
+        self.now[0] += 172800     # the NS records of com and example.com have expired
+        resolver.resolve("example.com")
+        self.assertEqual((self.root.udp_queries, self.com.udp_queries), (2, 2))
+
+    def test_cname_leaving_the_zone_is_chased_through_a_glueless_delegation(self):
+        resolver = self.resolver()
+        result = resolver.resolve("alias.example.com")
+        self.assertEqual([(record.NAME, record.RDATA.DATA) for record in result.answer],
+                         [("alias.example.com", "www.other.com"), ("www.other.com", "10.0.0.80")])
+        self.assertEqual(result.server, "127.0.0.4")
+        self.assertEqual(self.delegations.delegations["other.com"].addresses, {"ns.example.com": ["127.0.0.4"]})
+        self.assertEqual(resolver.referrals, 3)
+
+    def test_nxdomain_from_the_authoritative_server(self):
+        with self.assertRaises(DNSNameErrorException) as context:
+            self.resolver().resolve("missing.example.com")
+        self.assertEqual(context.exception.result.rcode, 3)
+        self.assertEqual(context.exception.result.authority[0].TYPE, 0x0006)
+
+    def test_glue_outside_the_queried_zone_is_ignored(self):
+        flags = DNSPacket.Header.Flags(1, 0, 0, 0, 0, 0, 0, 0)
+        authority = [DNSPacket.Answer("example.com", 0x0002, 1, 3600, 0, DNSPacket.RDATA("ns.evil.net", None, None))]
+        additional = [DNSPacket.Answer("ns.evil.net", 0x0001, 1, 3600, 0, DNSPacket.RDATA("10.6.6.6", None, None))]
+        response = DNSPacket(DNSPacket.Header(flags, 1, 0, 1, 1, 1),
+                             DNSPacket.Question("www.example.com", 1, 1), [], authority, additional)
+        resolver = self.resolver()
+        delegation = resolver.get_referral(response, "www.example.com", "com")
+        self.assertEqual((delegation.nameservers, delegation.addresses), (["ns.evil.net"], {}))
+        self.assertIsNone(resolver.get_referral(response, "www.example.org", "com"))   # not enclosing the name
+        self.assertIsNone(resolver.get_referral(response, "www.example.com", "example.com"))  # not below the zone
+
+    def test_main_iterative(self):
+        parser = TestParser("127.0.0.1", "www.example.com", port=self.root.port, timeout=1)
+        parser.iterative = True
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(main(parser), 1)
+        self.assertIn("referred the query to zone [example.com]", output.getvalue())
+        self.assertIn("93.184.216.34", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import bisect
+import json
+import time
+
+PHASES = ("encode", "send", "wait", "retry", "decode", "total")
+BUCKETS = tuple(0.00005 * 2 ** (i / 2) for i in range(38))  # 50 us to about 18 s, each bound sqrt(2) above the last
+
+
+class LatencyHistogram:
+    "Counts of durations in fixed exponential buckets, from which percentiles are estimated"
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)    # the last bucket holds everything above BUCKETS[-1]
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, p):
+        "Estimates the p-th percentile (0-100) by interpolating inside its bucket, None when empty"
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+                return lower + (upper - lower) * max(0.0, rank - seen) / count
+            seen += count
+        return BUCKETS[-1] * 2
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.percentile(50), "p95": self.percentile(95),
+                "p99": self.percentile(99)}
+
+
+class QueryTimer:
+    "Splits the time of one query into phases, each mark() charging the time since the previous one to a phase"
+    __slots__ = ("stats", "qtype", "start", "last", "phases")
+
+    def __init__(self, stats, qtype):
+        self.stats = stats
+        self.qtype = qtype
+        self.start = self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self, server):
+        "Records the phases against the server that answered, or the last one tried"
+        self.phases["total"] = time.perf_counter() - self.start
+        self.stats.record(server, self.qtype, self.phases)
+
+
+class QueryStats:
+    """Phase timings per server and query type, with counters for timeouts, response codes, ID mismatches and
+    truncated answers. Disabled it only costs the enabled check made before timing a query"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.decode_hook = None     # hook(decode, data) wrapping every response decode, e.g. a profiler
+        self.clear()
+
+    def clear(self):
+        self.histograms = {}    # (phase, server, qtype) -> LatencyHistogram
+        self.queries = {}       # (server, qtype) -> count
+        self.timeouts = {}      # (server, qtype) -> count of attempts without an answer
+        self.rcodes = {}        # (server, qtype, rcode) -> count
+        self.truncated = {}     # (server, qtype) -> count
+        self.id_mismatches = {}  # server -> count of replies that did not match a query
+
+    def start(self, qtype):
+        "Returns a QueryTimer, or None while stats are disabled"
+        return QueryTimer(self, qtype) if self.enabled else None
+
+    def record(self, server, qtype, phases):
+        for phase, seconds in phases.items():
+            key = (phase, server, qtype)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.observe(seconds)
+        self.increment(self.queries, (server, qtype))
+
+    def count_rcode(self, server, qtype, rcode):
+        if self.enabled:
+            self.increment(self.rcodes, (server, qtype, rcode))
+
+    def count_timeout(self, server, qtype):
+        if self.enabled:
+            self.increment(self.timeouts, (server, qtype))
+
+    def count_truncated(self, server, qtype):
+        if self.enabled:
+            self.increment(self.truncated, (server, qtype))
+
+    def count_id_mismatch(self, server):
+        if self.enabled:
+            self.increment(self.id_mismatches, server)
+
+    @staticmethod
+    def increment(counters, key):
+        counters[key] = counters.get(key, 0) + 1
+
+    def get_histogram(self, phase, server=None, qtype=None):
+        "Merges the histograms of a phase over every server and/or query type left as None"
+        merged = LatencyHistogram()
+        for (histogram_phase, histogram_server, histogram_qtype), histogram in self.histograms.items():
+            if histogram_phase == phase and server in (None, histogram_server) and qtype in (None, histogram_qtype):
+                merged.merge(histogram)
+        return merged
+
+    def to_dict(self):
+        servers = sorted({server for _, server, _ in self.histograms})
+        qtypes = sorted({qtype for _, _, qtype in self.histograms})
+        return {
+            "phases": {phase: self.get_histogram(phase).to_dict() for phase in PHASES},
+            "servers": {server: {phase: self.get_histogram(phase, server=server).to_dict() for phase in PHASES}
+                        for server in servers},
+            "qtypes": {qtype: {phase: self.get_histogram(phase, qtype=qtype).to_dict() for phase in PHASES}
+                       for qtype in qtypes},
+            "queries": [{"server": s, "qtype": t, "count": n} for (s, t), n in sorted(self.queries.items())],
+            "timeouts": [{"server": s, "qtype": t, "count": n} for (s, t), n in sorted(self.timeouts.items())],
+            "rcodes": [{"server": s, "qtype": t, "rcode": r, "count": n}
+                       for (s, t, r), n in sorted(self.rcodes.items())],
+            "truncated": [{"server": s, "qtype": t, "count": n} for (s, t), n in sorted(self.truncated.items())],
+            "id_mismatches": [{"server": s, "count": n} for s, n in sorted(self.id_mismatches.items())],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        "Returns the stats in the Prometheus text exposition format"
+        lines = ["# HELP dns_query_phase_seconds Time spent in each phase of a query",
+                 "# TYPE dns_query_phase_seconds histogram"]
+        for (phase, server, qtype), histogram in sorted(self.histograms.items()):
+            labels = 'phase="{}",server="{}",qtype="{}"'.format(phase, server, qtype)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append('dns_query_phase_seconds_bucket{{{},le="{:.6g}"}} {}'.format(labels, bound, cumulative))
+            lines.append('dns_query_phase_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, histogram.count))
+            lines.append("dns_query_phase_seconds_sum{{{}}} {:.9f}".format(labels, histogram.sum))
+            lines.append("dns_query_phase_seconds_count{{{}}} {}".format(labels, histogram.count))
+
+        for name, help_text, counters in (("dns_queries_total", "Queries completed", self.queries),
+                                          ("dns_timeouts_total", "Attempts that timed out", self.timeouts),
+                                          ("dns_truncated_total", "Truncated UDP answers", self.truncated)):
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} counter".format(name)]
+            lines += ['{}{{server="{}",qtype="{}"}} {}'.format(name, server, qtype, count)
+                      for (server, qtype), count in sorted(counters.items())]
+
+        lines += ["# HELP dns_responses_total Responses by RCODE", "# TYPE dns_responses_total counter"]
+        lines += ['dns_responses_total{{server="{}",qtype="{}",rcode="{}"}} {}'.format(server, qtype, rcode, count)
+                  for (server, qtype, rcode), count in sorted(self.rcodes.items())]
+        lines += ["# HELP dns_id_mismatches_total Replies matching no query", "# TYPE dns_id_mismatches_total counter"]
+        lines += ['dns_id_mismatches_total{{server="{}"}} {}'.format(server, count)
+                  for server, count in sorted(self.id_mismatches.items())]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, format="json"):
+        return self.to_prometheus() if format == "prometheus" else self.to_json()
+
+
+def cprofile_hook(profile):
+    "Returns a decode hook that runs every decode under a cProfile.Profile"
+    def hook(decode, data):
+        return profile.runcall(decode, data)
+    return hook
+
+
+STATS = QueryStats()
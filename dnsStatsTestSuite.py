@@ -0,0 +1,115 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import json
+import dnsClient
+from dnsClient import main
+from dnsStats import STATS, LatencyHistogram, QueryStats
+from dnsAsyncResolver import AsyncResolver
+from dnsTestServer import DNSTestServer
+from dnsClientTestSuite import TestParser
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles_fall_in_the_right_bucket(self):
+        histogram = LatencyHistogram()
+        for _ in range(90):
+            histogram.observe(0.001)
+        for _ in range(10):
+            histogram.observe(0.1)
+        self.assertEqual(histogram.count, 100)
+        self.assertTrue(0.0007 <= histogram.percentile(50) <= 0.001)
+        self.assertTrue(0.07 <= histogram.percentile(95) <= 0.1)
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_exports(self):
+        stats = QueryStats(enabled=True)
+        timer = stats.start("A")
+        timer.mark("encode")
+        timer.mark("wait")
+        timer.finish("10.0.0.1")
+        stats.count_rcode("10.0.0.1", "A", 3)
+        stats.count_id_mismatch("10.0.0.1")
+
+        text = stats.to_prometheus()
+        self.assertIn('dns_query_phase_seconds_count{phase="wait",server="10.0.0.1",qtype="A"} 1', text)
+        self.assertIn('dns_query_phase_seconds_bucket{phase="wait",server="10.0.0.1",qtype="A",le="+Inf"} 1', text)
+        self.assertIn('dns_responses_total{server="10.0.0.1",qtype="A",rcode="3"} 1', text)
+        self.assertIn('dns_id_mismatches_total{server="10.0.0.1"} 1', text)
+
+        exported = json.loads(stats.to_json())
+        self.assertEqual(exported["servers"]["10.0.0.1"]["total"]["count"], 1)
+        self.assertEqual(exported["qtypes"]["A"]["encode"]["count"], 1)
+        self.assertEqual(exported["queries"], [{"server": "10.0.0.1", "qtype": "A", "count": 1}])
+
+    def test_disabled_stats_record_nothing(self):
+        stats = QueryStats()
+        self.assertIsNone(stats.start("A"))
+        stats.count_timeout("10.0.0.1", "A")
+        self.assertEqual(stats.to_dict()["timeouts"], [])
+
+
+class TestQueryInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        dnsClient.RESPONSE_CACHE.clear()
+        STATS.clear()
+        STATS.enabled = True
+
+    def tearDown(self):
+        STATS.enabled = False
+        STATS.decode_hook = None
+        STATS.clear()
+
+    def test_main_records_every_phase(self):
+        decoded = []
+
+        def hook(decode, data):
+            decoded.append(len(data))
+            return decode(data)
+
+        STATS.decode_hook = hook
+        with DNSTestServer() as server, contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port)), 1)
+        for phase in ("encode", "send", "wait", "decode", "total"):
+            self.assertEqual(STATS.get_histogram(phase, server="127.0.0.1", qtype="A").count, 1)
+        self.assertEqual(STATS.rcodes, {("127.0.0.1", "A", 0): 1})
+        self.assertEqual(len(decoded), 1)
+
+    def test_main_counts_timeouts_and_id_mismatches(self):
+        with DNSTestServer(loss=1.0) as server, contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(main(TestParser("127.0.0.1", "example.com", port=server.port, timeout=0.1, retries=1)),
+                             0)
+        self.assertEqual(STATS.timeouts, {("127.0.0.1", "A"): 2})
+        self.assertEqual(STATS.get_histogram("retry").count, 1)
+
+        with DNSTestServer(wrong_id=True) as server, contextlib.redirect_stdout(io.StringIO()):
+            main(TestParser("127.0.0.1", "example.com", port=server.port))
+        self.assertEqual(STATS.id_mismatches, {"127.0.0.1": 1})
+
+    def test_async_resolver_records_truncation(self):
+        with DNSTestServer(truncate=True) as server:
+            async def resolve():
+                async with AsyncResolver("127.0.0.1", server.port, timeout=1) as resolver:
+                    return await resolver.query("example.com", "MX")
+            response = asyncio.run(resolve())
+        self.assertEqual(len(response.answer), 2)
+        self.assertEqual(STATS.truncated, {("127.0.0.1", "MX"): 1})
+        self.assertEqual(STATS.get_histogram("decode", qtype="MX").count, 1)
+        self.assertEqual(STATS.queries, {("127.0.0.1", "MX"): 1})
+
+    def test_async_resolver_records_a_spent_deadline_as_a_timeout(self):
+        with DNSTestServer() as server:
+            async def resolve():
+                async with AsyncResolver("127.0.0.1", server.port, timeout=1, deadline=0) as resolver:
+                    return await resolver.query("example.com", "A")
+            with self.assertRaises(dnsClient.DNSTimeoutException):
+                asyncio.run(resolve())
+        self.assertEqual(server.udp_queries, 0)
+        self.assertEqual(STATS.get_histogram("total", server="127.0.0.1", qtype="A").count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
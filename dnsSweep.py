@@ -0,0 +1,170 @@
+import asyncio
+import ipaddress
+import json
+import sys
+import time
+from dnsClient import DNSClientException, DNSTimeoutException, ResponseCache, validate_server, print_error
+from dnsBulk import BulkSummary, RateLimiter, get_resolver_options, get_resolver, open_capture
+
+PTR_TYPE = 0x000c
+NOERROR = 0
+NXDOMAIN = 3
+LABEL_BITS = {4: 8, 6: 4}   # address bits per reverse zone label: an octet in in-addr.arpa, a nibble in ip6.arpa
+
+
+class SweepSummary(BulkSummary):
+
+    def __init__(self):
+        super().__init__()
+        self.addresses = 0      # addresses covered by the ranges, queried or skipped
+        self.found = 0          # addresses with a PTR record
+        self.probes = 0
+        self.skipped = 0        # addresses inside reverse zones that answered NXDOMAIN
+
+    def __str__(self):
+        return (super().__str__() + f"\n  {self.addresses} addresses: {self.found} with PTR records, "
+                f"{self.skipped} skipped in empty ranges after {self.probes} probes")
+
+
+def parse_networks(texts):
+    "Parses IPv4 and IPv6 CIDR blocks, a bare address being a block of one. Raises ValueError for anything else"
+    return [ipaddress.ip_network(text.strip(), strict=False) for text in texts]
+
+
+def reverse_zone(network):
+    "Returns the in-addr.arpa or ip6.arpa name covering exactly a network whose prefix ends on a label boundary"
+    labels = network.network_address.reverse_pointer.split(".")
+    return ".".join(labels[(network.max_prefixlen - network.prefixlen) // LABEL_BITS[network.version]:])
+
+
+def child_networks(network):
+    "Lazily splits a network at the next label boundary, down to single addresses"
+    bits = LABEL_BITS[network.version]
+    return network.subnets(new_prefix=min(network.max_prefixlen, (network.prefixlen // bits + 1) * bits))
+
+
+def can_probe(network):
+    "Whether a network is a whole reverse zone below the root of in-addr.arpa or ip6.arpa"
+    return 0 < network.prefixlen < network.max_prefixlen and network.prefixlen % LABEL_BITS[network.version] == 0
+
+
+async def probe(resolver, network, summary):
+    """Asks for the reverse zone of a network, returning (network, RCODE, error). The error describes a timeout or an
+    RCODE other than NOERROR and NXDOMAIN, after which the range is swept rather than skipped on a guess"""
+    summary.probes += 1
+    try:
+        response = await resolver.query(reverse_zone(network), "PTR")
+    except DNSTimeoutException:
+        summary.timeouts += 1
+        return (network, None, "timeout")
+    except DNSClientException as e:
+        summary.errors += 1
+        return (network, None, str(e) or e.__class__.__name__)
+    rcode = response.header.FLAGS.RCODE
+    if rcode not in (NOERROR, NXDOMAIN):
+        summary.errors += 1
+        return (network, rcode, "rcode {}".format(rcode))
+    return (network, rcode, None)
+
+
+async def resolve_address(resolver, address, summary):
+    "Resolves the PTR records of one address into the dict written as its JSON line, or None when it has none"
+    summary.names += 1
+    start = time.perf_counter()
+    try:
+        response = await resolver.query(address.reverse_pointer, "PTR")
+    except DNSTimeoutException:
+        summary.timeouts += 1
+        return {"address": str(address), "error": "timeout"}
+    except DNSClientException as e:
+        summary.errors += 1
+        return {"address": str(address), "error": str(e) or e.__class__.__name__}
+    rcode = response.header.FLAGS.RCODE
+    if rcode not in (NOERROR, NXDOMAIN):
+        summary.errors += 1     # SERVFAIL, REFUSED and the like say nothing about the address
+        return {"address": str(address), "error": "rcode {}".format(rcode)}
+    summary.answered += 1
+    names = [answer.RDATA.DATA for answer in response.answer if answer.TYPE == PTR_TYPE]
+    if not names:
+        return None     # NXDOMAIN or NODATA, only counted
+    summary.found += 1
+    return {"address": str(address), "ptr": names, "ttl": min(answer.TTL for answer in response.answer),
+            "time": round(time.perf_counter() - start, 6)}
+
+
+async def sweep(resolver, networks, output_file, concurrency, limiter=None, skip_empty=True):
+    """Resolves the PTR records of every address in the networks, never holding more than `concurrency` queries in
+    flight. Ranges are walked depth first one reverse zone label at a time and addresses generated as they are
+    needed. With skip_empty, each whole reverse zone is asked for first and its range skipped when it answers NXDOMAIN,
+    as nothing can exist below a name that does not exist (RFC 8020)"""
+    summary = SweepSummary()
+    summary.addresses = sum(network.num_addresses for network in networks)
+    pending = [iter(networks)]  # stack of lazy iterators over the networks still to walk
+    in_flight = set()
+    start = time.perf_counter()
+
+    async def submit(coroutine):
+        if limiter is not None:
+            await limiter.acquire()
+        in_flight.add(asyncio.ensure_future(coroutine))
+
+    def write(result):
+        if result is not None:
+            output_file.write(json.dumps(result) + "\n")
+
+    while pending or in_flight:
+        while pending and len(in_flight) < concurrency:
+            network = next(pending[-1], None)
+            if network is None:
+                pending.pop()
+            elif network.num_addresses == 1:
+                await submit(resolve_address(resolver, network.network_address, summary))
+            elif skip_empty and can_probe(network):
+                await submit(probe(resolver, network, summary))
+            else:
+                pending.append(child_networks(network))
+        if not in_flight:
+            continue
+        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            result = task.result()
+            if isinstance(result, tuple):
+                network, rcode, error = result
+                if rcode == NXDOMAIN:
+                    summary.skipped += network.num_addresses
+                    write({"network": str(network), "rcode": NXDOMAIN})
+                else:
+                    if error is not None:
+                        write({"network": str(network), "error": error})
+                    pending.append(child_networks(network))
+            else:
+                write(result)
+        output_file.flush()
+
+    summary.elapsed = time.perf_counter() - start
+    summary.retries = resolver.retransmissions
+    summary.rtt = resolver.rtt_estimator.to_dict()
+    return summary
+
+
+async def run(args, networks, output_file):
+    cache = None if getattr(args, "no_cache", False) else ResponseCache()
+    concurrency = max(1, args.concurrency)
+    rate = getattr(args, "rate", None)
+    with open_capture(getattr(args, "capture", None)) as capture:
+        async with get_resolver(get_resolver_options(args, concurrency), cache, capture) as resolver:
+            return await sweep(resolver, networks, output_file, concurrency, RateLimiter(rate) if rate else None,
+                               skip_empty=not getattr(args, "no_skip", False))
+
+
+def main(args, output_file=None):
+    if not validate_server(args.server):
+        return 0
+    try:
+        networks = parse_networks(args.sweep)
+    except ValueError as e:
+        print_error("Invalid CIDR block: {}".format(e))
+        return 0
+    summary = asyncio.run(run(args, networks, sys.stdout if output_file is None else output_file))
+    print(summary, file=sys.stderr)
+    return 1
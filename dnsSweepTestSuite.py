@@ -0,0 +1,101 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import ipaddress
+import json
+import dnsSweep
+from dnsTestServer import DNSTestServer, Zone
+from dnsBulkTestSuite import TestBulkArgs
+
+REVERSE_ZONE = """
+5.1.0.10.in-addr.arpa.  300  PTR  host5.example.com.
+6.1.0.10.in-addr.arpa.  600  PTR  host6.example.com.
+6.1.0.10.in-addr.arpa.  600  PTR  alias6.example.com.
+7.3.0.10.in-addr.arpa.  300  PTR  host7.example.com.
+5.a.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa.  300  PTR  v6.example.com.
+"""
+
+
+class TestReverseNames(unittest.TestCase):
+
+    def test_reverse_zones_on_label_boundaries(self):
+        self.assertEqual(dnsSweep.reverse_zone(ipaddress.ip_network("10.0.1.0/24")), "1.0.10.in-addr.arpa")
+        self.assertEqual(dnsSweep.reverse_zone(ipaddress.ip_network("10.0.0.0/8")), "10.in-addr.arpa")
+        self.assertEqual(dnsSweep.reverse_zone(ipaddress.ip_network("2001:db8::/32")), "8.b.d.0.1.0.0.2.ip6.arpa")
+        self.assertTrue(dnsSweep.can_probe(ipaddress.ip_network("2001:db8::/36")))
+        self.assertFalse(dnsSweep.can_probe(ipaddress.ip_network("10.0.0.0/22")))
+
+    def test_ranges_split_at_the_next_label(self):
+        children = dnsSweep.child_networks(ipaddress.ip_network("10.0.0.0/22"))
+        self.assertEqual([str(child) for child in children], ["10.0.{}.0/24".format(i) for i in range(4)])
+        children = list(dnsSweep.child_networks(ipaddress.ip_network("2001:db8::/126")))
+        self.assertEqual([child.num_addresses for child in children], [1] * 4)
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.server = DNSTestServer(Zone.from_text(REVERSE_ZONE)).start()
+        self.addCleanup(self.server.stop)
+
+    def run_sweep(self, networks, skip_empty=True):
+        async def run():
+            args = TestBulkArgs(self.server.port, timeout=2, concurrency=32)
+            args.server = "127.0.0.1"
+            async with dnsSweep.get_resolver(dnsSweep.get_resolver_options(args, 32), None) as resolver:
+                output = io.StringIO()
+                summary = await dnsSweep.sweep(resolver, dnsSweep.parse_networks(networks), output, 32,
+                                               skip_empty=skip_empty)
+            return summary, [json.loads(line) for line in output.getvalue().splitlines()]
+        return asyncio.run(run())
+
+    def test_empty_reverse_zones_are_skipped(self):
+        summary, results = self.run_sweep(["10.0.0.0/22"])
+        found = {result["address"]: result["ptr"] for result in results if "address" in result}
+        self.assertEqual(found, {"10.0.1.5": ["host5.example.com"], "10.0.1.6": ["host6.example.com",
+                                                                                 "alias6.example.com"],
+                                 "10.0.3.7": ["host7.example.com"]})
+        self.assertEqual(sorted(result["network"] for result in results if "network" in result),
+                         ["10.0.0.0/24", "10.0.2.0/24"])
+        self.assertEqual((summary.addresses, summary.probes, summary.names, summary.skipped), (1024, 4, 512, 512))
+        self.assertEqual(self.server.udp_queries, 4 + 512)
+
+        summary, results = self.run_sweep(["10.0.0.0/22"], skip_empty=False)
+        self.assertEqual((summary.probes, summary.names, summary.found), (0, 1024, 3))
+
+    def test_ipv6_ranges_are_pruned_nibble_by_nibble(self):
+        summary, results = self.run_sweep(["2001:db8::/116", "10.0.3.7"])
+        self.assertEqual(sorted(result["ptr"] for result in results if "address" in result),
+                         [["host7.example.com"], ["v6.example.com"]])
+        # the /116 and its sixteen /120 and /124 zones are asked for, then the sixteen addresses of 2001:db8::a0/124
+        self.assertEqual((summary.probes, summary.names, summary.skipped), (33, 17, 4096 - 16))
+
+    def test_failing_reverse_server_is_reported_not_skipped(self):
+        self.server.rcode = 2
+        summary, results = self.run_sweep(["2001:db8::/124"])
+        self.assertEqual(results[0], {"network": "2001:db8::/124", "error": "rcode 2"})
+        self.assertEqual(sorted(result["address"] for result in results[1:]),
+                         sorted(str(address) for address in ipaddress.ip_network("2001:db8::/124")))
+        self.assertEqual({result["error"] for result in results[1:]}, {"rcode 2"})
+        self.assertEqual((summary.probes, summary.names, summary.answered, summary.errors, summary.skipped),
+                         (1, 16, 0, 17, 0))
+
+    def test_main_streams_one_line_per_address_with_a_name(self):
+        args = TestBulkArgs(self.server.port)
+        args.sweep = ["10.0.1.0/29"]
+        args.rate = 1000
+        output = io.StringIO()
+        with contextlib.redirect_stderr(io.StringIO()) as summary:
+            self.assertEqual(dnsSweep.main(args, output), 1)
+        self.assertEqual(sorted(json.loads(line)["address"] for line in output.getvalue().splitlines()),
+                         ["10.0.1.5", "10.0.1.6"])
+        self.assertIn("8 addresses: 2 with PTR records", summary.getvalue())
+
+        args.sweep = ["10.0.1.0/33"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(dnsSweep.main(args, output), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,481 @@
+import argparse
+import asyncio
+import base64
+import os
+import random
+import ssl
+import struct
+import threading
+import time
+from dnsClient import DNSPacket, DNSClientException, HEADER_STRUCT, RECORD_TYPES
+from dnsTransfer import AXFR_TYPE, IXFR_TYPE, SOA_TYPE
+
+# self-signed certificate and key for localhost and 127.0.0.1, made with
+# openssl req -x509 -newkey rsa:2048 -nodes -days 36500 -subj /CN=localhost \
+#     -addext subjectAltName=DNS:localhost,IP:127.0.0.1 -keyout key.pem -out cert.pem && cat key.pem cert.pem
+TEST_CERT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dnsTestCert.pem")
+
+EXAMPLE_ZONE = """
+example.com.        3600 SOA   ns1.example.com. admin.example.com. 2024010101 7200 900 1209600 300
+example.com.        3600 NS    ns1.example.com.
+example.com.        3600 NS    ns2.example.com.
+example.com.        300  A     93.184.216.34
+example.com.        300  MX    10 mail.example.com.
+example.com.        300  MX    20 mail2.example.com.
+www.example.com.    300  CNAME example.com.
+ns1.example.com.    3600 A     10.0.0.53
+ns2.example.com.    3600 A     10.0.1.53
+mail.example.com.   300  A     10.0.0.25
+mail2.example.com.  300  A     10.0.1.25
+"""
+
+
+class Zone:
+    "Records served by the test server, read from lines of 'name ttl type data'"
+
+    def __init__(self):
+        self.records = {}   # (name, type) -> [Answer]
+        self.names = set()
+        self.soa = None
+        self.parents = set()    # empty non-terminals: names with records below them, which exist (RFC 8020)
+        self.journal = []       # (old SOA, new SOA, deleted, added) of every update, for IXFR
+
+    @classmethod
+    def from_text(cls, text):
+        zone = cls()
+        for line in text.splitlines():
+            line = line.split(";")[0].strip()
+            if line:
+                zone.add(*line.split(None, 3))
+        return zone
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as zone_file:
+            return cls.from_text(zone_file.read())
+
+    def add(self, name, ttl, rtype, data):
+        name = name.rstrip(".").lower()
+        rtype = rtype.upper()
+        record_type = RECORD_TYPES.get(DNSPacket.Question.get_q_num(rtype))
+        if record_type is None:
+            raise DNSClientException("Unsupported record type in zone: {}".format(rtype))
+        TYPE = record_type.code
+        rdata = record_type.parser(data)
+
+        record = DNSPacket.Answer(name, TYPE, 0x0001, int(ttl), 0, rdata)
+        self.records.setdefault((name, TYPE), []).append(record)
+        self.names.add(name)
+        labels = name.split(".")
+        self.parents.update(".".join(labels[i:]) for i in range(1, len(labels)))
+        if TYPE == 0x0006 and self.soa is None:
+            self.soa = record
+        return record
+
+    def remove(self, name, ttl, rtype, data):
+        "Removes the record a 'name ttl type data' line describes, whatever its TTL, and returns it"
+        name = name.rstrip(".").lower()
+        TYPE = DNSPacket.Question.get_q_num(rtype.upper())
+        record_type = RECORD_TYPES[TYPE]
+        formatted = record_type.formatter(record_type.parser(data))
+        records = self.records.get((name, TYPE), [])
+        for record in records:
+            if record_type.formatter(record.RDATA) == formatted:
+                records.remove(record)
+                if not records:
+                    del self.records[(name, TYPE)]
+                    if not any(key[0] == name for key in self.records):
+                        self.names.discard(name)
+                return record
+        raise DNSClientException("No such record in zone: {} {} {}".format(name, rtype, data))
+
+    def update(self, added=(), deleted=()):
+        "Applies a change given as 'name ttl type data' lines and bumps the SOA serial, keeping the change for IXFR"
+        removed = [self.remove(*line.split(None, 3)) for line in deleted]
+        inserted = [self.add(*line.split(None, 3)) for line in added]
+        old = self.soa
+        self.soa = DNSPacket.Answer(old.NAME, SOA_TYPE, old.CLASS, old.TTL, 0,
+                                    DNSPacket.RDATA(old.RDATA.DATA._replace(SERIAL=old.RDATA.DATA.SERIAL + 1),
+                                                    None, None))
+        self.records[(old.NAME, SOA_TYPE)] = [self.soa]
+        self.journal.append((old, self.soa, removed, inserted))
+        return self.soa.RDATA.DATA.SERIAL
+
+    def transfer(self, serial=None):
+        """Returns the records answering a zone transfer: the whole zone between two copies of its SOA, or for an IXFR
+        from a serial in the journal the SOA-separated deletions and additions of every update since (RFC 1995)"""
+        if serial is not None:
+            if serial == self.soa.RDATA.DATA.SERIAL:
+                return [self.soa]
+            for i, (old, _, _, _) in enumerate(self.journal):
+                if old.RDATA.DATA.SERIAL == serial:
+                    records = [self.soa]
+                    for old, new, removed, inserted in self.journal[i:]:
+                        records += [old] + removed + [new] + inserted
+                    return records + [self.soa]
+        return ([self.soa] + [record for (name, TYPE), records in self.records.items()
+                              if TYPE != SOA_TYPE or name != self.soa.NAME for record in records] + [self.soa])
+
+    def lookup(self, name, qtype):
+        "Returns (rcode, answers, authority) for a question, following CNAMEs inside the zone"
+        name = name.rstrip(".").lower()
+        answers = []
+        for _ in range(8):
+            records = self.records.get((name, qtype))
+            if records:
+                return (0, answers + records, [])
+            cname = self.records.get((name, 0x0005))
+            if cname is None or qtype == 0x0005:
+                break
+            answers += cname
+            name = cname[0].RDATA.DATA
+        authority = [self.soa] if self.soa is not None else []
+        if answers or name in self.names or name in self.parents:
+            return (0, answers, authority)
+        return (3, answers, authority)
+
+    def find_delegation(self, name):
+        """Returns (NS records, glue) when a name lies at or below a zone cut inside this zone, the NS records of the
+        closest cut and the A records of its name servers found in the zone, or None"""
+        name = name.rstrip(".").lower()
+        origin = self.soa.NAME if self.soa is not None else None
+        labels = name.split(".") if name else []
+        for i in range(len(labels)):
+            cut = ".".join(labels[i:])
+            if cut == origin:
+                break
+            nameservers = self.records.get((cut, 0x0002))
+            if nameservers:
+                glue = [record for nameserver in nameservers
+                        for record in self.records.get((nameserver.RDATA.DATA.lower(), 0x0001), [])]
+                return (nameservers, glue)
+        return None
+
+
+def synthetic_zone(hosts, origin="synthetic.example"):
+    "A zone with an SOA, two NS records and `hosts` A records, large enough to exercise zone transfers"
+    lines = ["{0}. 3600 SOA ns1.{0}. admin.{0}. 1 7200 900 1209600 300".format(origin),
+             "{0}. 3600 NS ns1.{0}.".format(origin), "{0}. 3600 NS ns2.{0}.".format(origin)]
+    lines += ["host{}.{}. 300 A 10.{}.{}.{}".format(i, origin, i >> 16 & 255, i >> 8 & 255, i & 255)
+              for i in range(hosts)]
+    return Zone.from_text("\n".join(lines))
+
+
+def get_test_tls_context(certfile=TEST_CERT):
+    "Server SSL context for the DoT and DoH listeners of the test server"
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile)
+    return context
+
+
+class DNSTestProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.udp_query_received(self.transport, data, addr)
+
+
+class DNSTestServer:
+    """Serves a Zone on localhost over UDP and TCP from a background event loop, with injectable faults. Given a server
+    SSL context it also serves DNS over TLS and DNS over HTTPS (HTTP/1.1) on ephemeral ports"""
+
+    def __init__(self, zone=None, host="127.0.0.1", port=0, latency=0.0, loss=0.0, truncate=False, wrong_id=False,
+                 rcode=None, max_udp_size=4096, authoritative=True, recursion_available=True, seed=None, jitter=0.0,
+                 edns=True, tls=None, transfer_records=100, transfer_cutoff=None):
+        self.zone = zone if zone is not None else Zone.from_text(EXAMPLE_ZONE)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.truncate = truncate
+        self.wrong_id = wrong_id
+        self.rcode = rcode
+        self.max_udp_size = max_udp_size    # largest EDNS0 payload the server accepts, 512 bytes without EDNS0
+        self.edns = edns
+        self.authoritative = authoritative
+        self.recursion_available = recursion_available
+        self.random = random.Random(seed)
+        self.tls = tls
+        self.tls_port = None
+        self.https_port = None
+        self.transfer_records = transfer_records    # records per message of a zone transfer
+        self.transfer_cutoff = transfer_cutoff      # messages of a zone transfer sent before the connection is dropped
+
+        self.udp_queries = 0
+        self.tcp_queries = 0
+        self.tcp_connections = 0
+        self.tls_connections = 0
+        self.tls_resumed = 0
+        self.https_queries = 0
+        self.transfers = 0
+        self.loop = None
+        self.thread = None
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def start(self):
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+        if self.loop is None:
+            raise DNSClientException("Unable to start the test server on {}:{}".format(self.host, self.port))
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self, started):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            udp_transport, stream_servers = loop.run_until_complete(self.bind(loop))
+        except OSError:
+            started.set()
+            loop.close()
+            return
+
+        self.loop = loop
+        started.set()
+        try:
+            loop.run_forever()
+        finally:
+            udp_transport.close()
+            for stream_server in stream_servers:
+                stream_server.close()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    async def bind(self, loop):
+        # an ephemeral UDP port is reused for TCP, retrying if that TCP port happens to be taken
+        for _ in range(16):
+            udp_transport, _ = await loop.create_datagram_endpoint(lambda: DNSTestProtocol(self),
+                                                                   local_addr=(self.host, self.port))
+            port = udp_transport.get_extra_info("sockname")[1]
+            try:
+                tcp_server = await asyncio.start_server(self.tcp_connection_made, self.host, port)
+            except OSError:
+                udp_transport.close()
+                if self.port:
+                    raise
+                continue
+            self.port = port
+            stream_servers = [tcp_server]
+            if self.tls is not None:
+                dot_server = await asyncio.start_server(self.tls_connection_made, self.host, 0, ssl=self.tls)
+                https_server = await asyncio.start_server(self.https_connection_made, self.host, 0, ssl=self.tls)
+                stream_servers += [dot_server, https_server]
+                self.tls_port = dot_server.sockets[0].getsockname()[1]
+                self.https_port = https_server.sockets[0].getsockname()[1]
+            return (udp_transport, stream_servers)
+        raise OSError("No free port for both UDP and TCP")
+
+    def build_response(self, data, tcp=False):
+        "Returns the response to a query, or None when it cannot be decoded"
+        try:
+            request = DNSPacket.unpack(data)
+        except (IndexError, struct.error, DNSClientException):
+            return None
+        question = request.question
+        if question is None:
+            return None
+
+        authoritative = self.authoritative
+        delegation = self.zone.find_delegation(question.QNAME) if self.rcode is None else None
+        glue = []
+        if self.rcode is not None:
+            rcode, answers, authority = self.rcode, [], []
+        elif delegation is not None:
+            rcode, answers, (authority, glue) = 0, [], delegation
+            authoritative = False   # a referral to the servers of a child zone
+        else:
+            rcode, answers, authority = self.zone.lookup(question.QNAME, question.QTYPE)
+
+        udp_limit = 512
+        additional = list(glue)
+        if self.edns and request.get_opt_record() is not None:
+            udp_limit = min(request.get_udp_payload_size(), self.max_udp_size)
+            additional.append(DNSPacket.Answer.get_opt_record(self.max_udp_size))
+
+        flags = DNSPacket.Header.Flags(1, 0, int(authoritative), 0, request.header.FLAGS.RD,
+                                       int(self.recursion_available), 0, rcode)
+        header = DNSPacket.Header(flags, 1, len(answers), len(authority), len(additional), request.header.ID)
+        response = DNSPacket(header, question, answers, authority, additional).to_bytes()
+
+        if not tcp and (self.truncate or len(response) > udp_limit):
+            flags.TC = 1
+            header.ANCOUNT = header.NSCOUNT = 0
+            additional = additional[len(glue):]
+            header.ARCOUNT = len(additional)
+            response = DNSPacket(header, question, [], [], additional).to_bytes()
+        return response
+
+    def build_transfer(self, data):
+        "Returns the messages answering an AXFR or IXFR query, or None for any other query"
+        try:
+            request = DNSPacket.unpack(data)
+        except DNSClientException:
+            return None
+        question = request.question
+        if question is None or question.QTYPE not in (AXFR_TYPE, IXFR_TYPE):
+            return None
+        self.transfers += 1
+
+        flags = DNSPacket.Header.Flags(1, 0, 1, 0, 0, 0, 0, 0)
+        if self.zone.soa is None or question.QNAME.rstrip(".").lower() != self.zone.soa.NAME:
+            flags.RCODE = 5     # refused, not a zone this server holds
+            return [DNSPacket(DNSPacket.Header(flags, 1, 0, 0, 0, request.header.ID), question, []).to_bytes()]
+        serial = None
+        if question.QTYPE == IXFR_TYPE and request.authority and request.authority[0].TYPE == SOA_TYPE:
+            serial = request.authority[0].RDATA.DATA.SERIAL
+        records = self.zone.transfer(serial)
+        messages = []
+        for i in range(0, len(records), self.transfer_records):
+            chunk = records[i:i + self.transfer_records]
+            header = DNSPacket.Header(flags, 1, len(chunk), 0, 0, request.header.ID)
+            messages.append(DNSPacket(header, question, chunk).to_bytes())
+        return messages
+
+    def send_later(self, send, response):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+        if delay > 0:
+            self.loop.call_later(delay, send, response)
+        else:
+            send(response)
+
+    def udp_query_received(self, transport, data, addr):
+        self.udp_queries += 1
+        if self.loss > 0 and self.random.random() < self.loss:
+            return
+        response = self.build_response(data)
+        if response is None:
+            return
+        if self.wrong_id:
+            transport.sendto(struct.pack("!H", (response[0] << 8 | response[1]) ^ 0xFFFF) + response[2:], addr)
+        self.send_later(lambda message: transport.sendto(message, addr), response)
+
+    def count_tls_connection(self, writer):
+        self.tls_connections += 1
+        if writer.get_extra_info("ssl_object").session_reused:
+            self.tls_resumed += 1
+
+    async def tls_connection_made(self, reader, writer):
+        self.count_tls_connection(writer)
+        await self.tcp_connection_made(reader, writer, tls=True)
+
+    async def tcp_connection_made(self, reader, writer, tls=False):
+        if not tls:
+            self.tcp_connections += 1
+
+        def send(message):
+            if not writer.is_closing():
+                writer.write(struct.pack("!H", len(message)) + message)
+
+        def send_all(messages):
+            for count, message in enumerate(messages):
+                if count == self.transfer_cutoff:
+                    writer.close()
+                    return
+                send(message)
+
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                data = await reader.readexactly(length)
+                self.tcp_queries += 1
+                messages = self.build_transfer(data)
+                if messages is not None:
+                    self.send_later(send_all, messages)
+                    continue
+                response = self.build_response(data, tcp=True)
+                if response is not None and len(response) >= HEADER_STRUCT.size:
+                    self.send_later(send, response)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def https_connection_made(self, reader, writer):
+        "Answers DoH POSTs and GETs in order on a keep-alive HTTP/1.1 connection, so pipelined requests work"
+        self.count_tls_connection(writer)
+        try:
+            while True:
+                request_line = (await reader.readline()).decode("latin-1").split()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method, target = request_line[0], request_line[1]
+                path, _, query = target.partition("?")
+                if method == "GET" and query.startswith("dns="):
+                    body = base64.urlsafe_b64decode(query[4:] + "=" * (-len(query[4:]) % 4))
+                self.https_queries += 1
+                response = self.build_response(body, tcp=True) if path == "/dns-query" else None
+                delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+                if delay > 0:
+                    await asyncio.sleep(delay)  # responses keep their order on the connection
+                if response is None:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+                else:
+                    writer.write("HTTP/1.1 200 OK\r\nContent-Type: application/dns-message\r\n"
+                                 "Content-Length: {}\r\n\r\n".format(len(response)).encode("ascii") + response)
+        except (asyncio.IncompleteReadError, OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in DNS server')
+    parser.add_argument('--zone', help='Zone file of "name ttl type data" lines, defaults to example.com')
+    parser.add_argument('--synthetic', type=int, metavar='HOSTS',
+                        help='Serve synthetic.example with this many A records instead, for zone transfers')
+    parser.add_argument('-p', type=int, help='UDP and TCP port to listen on, 0 for an ephemeral port', default=5353)
+    parser.add_argument('--latency', type=float, help='Seconds to wait before every reply', default=0.0)
+    parser.add_argument('--jitter', type=float, help='Maximum random seconds added to the latency', default=0.0)
+    parser.add_argument('--loss', type=float, help='Probability of dropping a UDP query', default=0.0)
+    parser.add_argument('--truncate', action='store_true', help='Set TC on every UDP reply')
+    parser.add_argument('--wrong-id', action='store_true', help='Send a reply with a mismatched ID before each reply')
+    parser.add_argument('--rcode', type=int, help='Answer every query with this RCODE')
+    parser.add_argument('--tls', metavar='CERT', nargs='?', const=TEST_CERT,
+                        help='Also serve DNS over TLS and DNS over HTTPS with this PEM certificate and key, the '
+                        'self-signed test certificate by default')
+    args = parser.parse_args()
+
+    zone = Zone.from_file(args.zone) if args.zone else synthetic_zone(args.synthetic) if args.synthetic else None
+    with DNSTestServer(zone, port=args.p, latency=args.latency, jitter=args.jitter, loss=args.loss,
+                       truncate=args.truncate, wrong_id=args.wrong_id, rcode=args.rcode,
+                       tls=get_test_tls_context(args.tls) if args.tls else None) as server:
+        print("Serving on {}:{}".format(*server.address))
+        if server.tls is not None:
+            print("DNS over TLS on port {}, DNS over HTTPS on port {}".format(server.tls_port, server.https_port))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,122 @@
+import unittest
+import asyncio
+import socket
+import struct
+import dnsClient
+from dnsClient import DNSPacket
+from dnsAsyncResolver import AsyncResolver
+from dnsTestServer import DNSTestServer, Zone
+
+
+class TestZone(unittest.TestCase):
+
+    def setUp(self):
+        self.zone = Zone.from_text("""
+            example.com.      300 SOA ns1.example.com. admin.example.com. 1 7200 900 86400 60
+            example.com.      300 A   10.0.0.1   ; apex
+            www.example.com.  300 CNAME example.com.
+            example.com.      300 MX  10 mail.example.com.
+        """)
+
+    def test_lookup_follows_cname(self):
+        rcode, answers, authority = self.zone.lookup("WWW.example.com.", 1)
+        self.assertEqual(rcode, 0)
+        self.assertEqual([(answer.TYPE, answer.RDATA.DATA) for answer in answers], [(5, "example.com"), (1, "10.0.0.1")])
+
+    def test_lookup_nxdomain_and_nodata(self):
+        self.assertEqual(self.zone.lookup("missing.example.com", 1)[0], 3)
+        rcode, answers, authority = self.zone.lookup("example.com", 2)
+        self.assertEqual((rcode, answers), (0, []))
+        self.assertEqual(authority[0].RDATA.DATA.MINIMUM, 60)
+
+    def test_find_delegation_below_the_apex(self):
+        self.zone.add("sub.example.com.", 300, "NS", "ns.sub.example.com.")
+        self.zone.add("ns.sub.example.com.", 300, "A", "10.0.0.53")
+        nameservers, glue = self.zone.find_delegation("www.SUB.example.com")
+        self.assertEqual([record.RDATA.DATA for record in nameservers], ["ns.sub.example.com"])
+        self.assertEqual([record.RDATA.DATA for record in glue], ["10.0.0.53"])
+        self.assertIsNone(self.zone.find_delegation("www.example.com"))
+
+
+class TestDNSTestServer(unittest.TestCase):
+
+    def query(self, server, name, qtype="A"):
+        async def run():
+            async with AsyncResolver(*server.address, timeout=1, retries=0) as resolver:
+                return await resolver.query(name, qtype), resolver
+        return asyncio.run(run())
+
+    def test_udp_response_round_trips_through_encoder(self):
+        with DNSTestServer() as server:
+            response, _ = self.query(server, "example.com", "MX")
+        self.assertEqual(response.header.FLAGS.QR, 1)
+        self.assertEqual(response.header.FLAGS.AA, 1)
+        self.assertEqual([(answer.RDATA.PREFERENCE, answer.RDATA.EXCHANGE) for answer in response.answer],
+                         [(10, "mail.example.com"), (20, "mail2.example.com")])
+
+    def test_tcp_queries_are_length_framed(self):
+        with DNSTestServer() as server:
+            flags = DNSPacket.Header.Flags.get_request_flags(0b0)
+            with socket.create_connection(server.address, timeout=2) as s:
+                for name in ("example.com", "www.example.com"):
+                    query = DNSPacket(DNSPacket.Header.get_request_header(flags),
+                                      DNSPacket.Question.get_request_question(name, "A"), None).to_bytes()
+                    s.sendall(struct.pack("!H", len(query)) + query)
+                    length = struct.unpack("!H", s.recv(2))[0]
+                    data = b""
+                    while len(data) < length:
+                        data += s.recv(length - len(data))
+                    self.assertEqual(DNSPacket.unpack(data).answer[-1].RDATA.DATA, "93.184.216.34")
+            self.assertEqual(server.tcp_queries, 2)
+
+    def test_truncation_and_rcode_injection(self):
+        with DNSTestServer(truncate=True) as server:
+            response, resolver = self.query(server, "example.com")
+            self.assertEqual((server.udp_queries, server.tcp_queries), (1, 1))
+        self.assertEqual((resolver.truncated, response.header.FLAGS.TC, len(response.answer)), (1, 0, 1))
+        with DNSTestServer(rcode=5) as server:
+            response, _ = self.query(server, "example.com")
+        self.assertEqual(response.header.FLAGS.RCODE, 5)
+
+    def test_wrong_id_and_loss(self):
+        with DNSTestServer(wrong_id=True) as server:
+            response, resolver = self.query(server, "example.com")
+        self.assertEqual(resolver.unmatched, 1)
+        self.assertEqual(response.answer[0].RDATA.DATA, "93.184.216.34")
+        with DNSTestServer(loss=1.0) as server:
+            with self.assertRaises(dnsClient.DNSTimeoutException):
+                self.query(server, "example.com")
+            self.assertEqual(server.udp_queries, 1)
+
+    def test_truncated_answers_fall_back_to_one_pipelined_tcp_connection(self):
+        names = ["example.com", "www.example.com", "mail.example.com", "ns1.example.com"] * 5
+
+        async def run(server):
+            async with AsyncResolver(*server.address, timeout=2, retries=0) as resolver:
+                return await asyncio.gather(*(resolver.query(name) for name in names)), resolver
+
+        with DNSTestServer(truncate=True, jitter=0.02, seed=3) as server:
+            responses, resolver = asyncio.run(run(server))
+            self.assertEqual(server.tcp_connections, 1)
+            self.assertEqual(server.tcp_queries, len(names))
+        self.assertEqual(resolver.truncated, len(names))
+        for name, response in zip(names, responses):
+            self.assertEqual(response.header.FLAGS.TC, 0)
+            self.assertEqual(response.question.QNAME, name)
+            self.assertTrue(response.answer)
+
+    def test_latency_is_applied(self):
+        with DNSTestServer(latency=0.2) as server:
+            loop_time = asyncio.run(self.timed_query(server))
+        self.assertGreaterEqual(loop_time, 0.2)
+
+    async def timed_query(self, server):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        async with AsyncResolver(*server.address, timeout=1, retries=0) as resolver:
+            await resolver.query("example.com")
+        return loop.time() - start
+
+
+if __name__ == '__main__':
+    unittest.main()
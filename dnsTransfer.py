@@ -0,0 +1,268 @@
+import os
+import socket
+import sys
+import tempfile
+import time
+from dnsClient import DNSPacket, DNSClientException, DNSUnexpectedResponseException, DNSTimeoutException, \
+    TCPConnection, RECORD_TYPES, RCODE_EXCEPTIONS, SOAData, validate_server, print_error
+
+AXFR_TYPE = 252
+IXFR_TYPE = 251
+SOA_TYPE = 0x0006
+
+
+def serial_newer(serial, other):
+    "Whether serial comes after other in 32 bit serial number arithmetic (RFC 1982)"
+    return serial != other and (serial - other) % 2 ** 32 < 2 ** 31
+
+
+class ZoneTransfer:
+    """One AXFR or IXFR of a zone over its own TCP connection. Iterating decodes each length-prefixed message as it
+    arrives and yields ("add" or "delete", Answer) pairs, so a zone of any size is never held in memory. An AXFR, or
+    an IXFR the server answers with the whole zone, only adds and has incremental set to False once iteration starts.
+    The leading and trailing SOA records are consumed; the new one is in soa"""
+
+    def __init__(self, server, zone, port=53, timeout=5, serial=None, soa=None):
+        self.server = server.replace("@", "")
+        self.zone = zone.rstrip(".")
+        self.port = port
+        self.timeout = timeout
+        self.qtype = AXFR_TYPE if serial is None else IXFR_TYPE
+        self.serial = serial    # the version the client holds, for IXFR
+        self.client_soa = soa
+        self.soa = None
+        self.incremental = False
+        self.up_to_date = False
+        self.messages = 0
+        self.records = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def build_query(self):
+        flags = DNSPacket.Header.Flags.get_request_flags(0b0, RD=0b0)
+        authority = []
+        if self.qtype == IXFR_TYPE:
+            # only the serial of the client's SOA is looked at by the server (RFC 1995)
+            soa = self.client_soa
+            if soa is None:
+                rdata = DNSPacket.RDATA(SOAData(self.zone, self.zone, self.serial, 0, 0, 0, 0), None, None)
+                soa = DNSPacket.Answer(self.zone, SOA_TYPE, 0x0001, 0, 0, rdata)
+            authority.append(soa)
+        header = DNSPacket.Header(flags, 1, 0, len(authority), 0)
+        return DNSPacket(header, DNSPacket.Question(self.zone, self.qtype, 0x0001), [], authority)
+
+    def read_records(self, connection, query):
+        "Yields the answer records of every message of the response, decoding one message at a time"
+        while True:
+            data = connection.receive()
+            response = DNSPacket.unpack(data)
+            if response.header.ID != query.header.ID:
+                raise DNSUnexpectedResponseException("Unexpected response: transfer message with ID {} instead of {}"
+                                                     .format(response.header.ID, query.header.ID))
+            if response.header.FLAGS.RCODE in RCODE_EXCEPTIONS:
+                exception, message = RCODE_EXCEPTIONS[response.header.FLAGS.RCODE]
+                raise exception(message)
+            if self.messages == 0 and not response.answer:
+                raise DNSUnexpectedResponseException("Unexpected response: transfer started without an SOA record")
+            self.messages += 1
+            self.bytes += len(data)
+            yield from response.answer
+
+    def __iter__(self):
+        start = time.perf_counter()
+        connection = TCPConnection(self.server, self.port, self.timeout)
+        query = self.build_query()
+        connection.connect()
+        try:
+            connection.send([query.to_bytes()])
+            records = self.read_records(connection, query)
+            first = next(records)
+            if first.TYPE != SOA_TYPE:
+                raise DNSUnexpectedResponseException("Unexpected response: transfer started without an SOA record")
+            self.soa = first
+            serial = first.RDATA.DATA.SERIAL
+            if self.qtype == IXFR_TYPE and not serial_newer(serial, self.serial):
+                self.up_to_date = True
+                return
+
+            second = next(records)
+            if self.qtype == IXFR_TYPE and second.TYPE == SOA_TYPE and second.RDATA.DATA.SERIAL != serial:
+                self.incremental = True
+                yield from self.read_differences(records, serial)
+            elif second.TYPE != SOA_TYPE:    # an SOA here ends the transfer of a zone holding only its SOA
+                self.records += 1
+                yield ("add", first)
+                yield from self.read_zone(records, second)
+            else:
+                self.records += 1
+                yield ("add", first)
+        except socket.timeout:
+            raise DNSTimeoutException("No transfer message from {} after {} seconds".format(self.server, self.timeout))
+        finally:
+            connection.close()
+            self.elapsed = time.perf_counter() - start
+
+    def read_zone(self, records, record):
+        "Adds every record up to the SOA closing a full transfer (RFC 5936)"
+        while record.TYPE != SOA_TYPE:
+            self.records += 1
+            yield ("add", record)
+            record = next(records)
+
+    def read_differences(self, records, serial):
+        """Follows the IXFR sequences of an old SOA, the records deleted, a newer SOA and the records added, up to the
+        SOA with the final serial that closes the response (RFC 1995). The first old SOA has been read"""
+        operation = "delete"
+        while True:
+            record = next(records)
+            if record.TYPE != SOA_TYPE:
+                self.records += 1
+                yield (operation, record)
+            elif operation == "delete":
+                operation = "add"
+            elif record.RDATA.DATA.SERIAL == serial:
+                return
+            else:
+                operation = "delete"    # the old SOA of the next sequence
+
+
+def record_key(record):
+    "The identity of a record in a zone: its owner, type and data, not its TTL"
+    return (record.NAME.lower(), record.TYPE, format_rdata(record))
+
+
+def format_rdata(record):
+    record_type = RECORD_TYPES.get(record.TYPE)
+    if record_type is None:
+        return "\\# {} {}".format(len(record.RDATA.DATA), record.RDATA.DATA.hex())   # RFC 3597 generic format
+    return str(record_type.formatter(record.RDATA))
+
+
+def format_record(record):
+    "A 'name ttl type data' zone line, as read by ZoneSnapshot.from_file and the test server's Zone"
+    record_type = RECORD_TYPES.get(record.TYPE)
+    type_name = record_type.name if record_type is not None else "TYPE{}".format(record.TYPE)
+    return "{}. {} {} {}".format(record.NAME, record.TTL, type_name, format_rdata(record))
+
+
+def parse_record(line):
+    name, ttl, type_name, data = line.split(None, 3)
+    name = name.rstrip(".")
+    if type_name.upper().startswith("TYPE") and data.startswith("\\#"):
+        rdata = DNSPacket.RDATA(bytes.fromhex("".join(data.split()[2:])), None, None)
+        return DNSPacket.Answer(name, int(type_name[4:]), 0x0001, int(ttl), len(rdata.DATA), rdata)
+    code = DNSPacket.Question.get_q_num(type_name.upper())
+    if code is None:
+        raise DNSClientException("Unsupported record type in zone snapshot: {}".format(type_name))
+    return DNSPacket.Answer(name, code, 0x0001, int(ttl), 0, RECORD_TYPES[code].parser(data))
+
+
+class ZoneSnapshot:
+    "The records of a zone at one serial, saved as zone file lines so a later IXFR only transfers what changed"
+
+    def __init__(self, zone):
+        self.zone = zone.rstrip(".")
+        self.records = {}   # record_key -> Answer, in transfer order
+        self.soa = None
+
+    @property
+    def serial(self):
+        return None if self.soa is None else self.soa.RDATA.DATA.SERIAL
+
+    @classmethod
+    def from_file(cls, path, zone):
+        snapshot = cls(zone)
+        with open(path) as snapshot_file:
+            for line in snapshot_file:
+                line = line.strip()
+                if line and not line.startswith(";"):
+                    snapshot.add(parse_record(line))
+        return snapshot
+
+    def add(self, record):
+        if record.TYPE == SOA_TYPE and record.NAME.lower() == self.zone.lower():
+            self.soa = record
+        else:
+            self.records[record_key(record)] = record
+
+    def delete(self, record):
+        self.records.pop(record_key(record), None)
+
+    def update(self, transfer):
+        "Applies a transfer to the snapshot: its differences, or the whole zone when the server sent one"
+        changes = 0
+        for operation, record in transfer:
+            if changes == 0 and not transfer.incremental:
+                self.records.clear()
+            getattr(self, operation)(record)
+            changes += 1
+        if transfer.soa is not None:
+            self.soa = transfer.soa
+        return changes
+
+    def __len__(self):
+        return len(self.records) + (self.soa is not None)
+
+    def __iter__(self):
+        if self.soa is not None:
+            yield self.soa
+        yield from self.records.values()
+
+    def save(self, path):
+        write_zone(self, path)
+
+
+def write_zone(records, path):
+    """Writes records as zone file lines as they come, to stdout for -. A file is written under a temporary name in
+    its directory and only replaces path once the records run out, so a transfer failing partway leaves any earlier
+    copy as it was instead of a truncated one holding the new serial"""
+    if path == "-":
+        return write_records(records, sys.stdout)
+    zone_file = tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(path)),
+                                            prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False)
+    try:
+        with zone_file:
+            count = write_records(records, zone_file)
+        os.replace(zone_file.name, path)
+    except BaseException:
+        os.unlink(zone_file.name)
+        raise
+    return count
+
+
+def write_records(records, zone_file):
+    count = 0
+    for record in records:
+        zone_file.write(format_record(record) + "\n")
+        count += 1
+    return count
+
+
+def main(args):
+    if not validate_server(args.server):
+        return 0
+    try:
+        if args.transfer == "axfr":
+            transfer = ZoneTransfer(args.server, args.name, args.p, args.t)
+            write_zone((record for _, record in transfer), args.snapshot or "-")
+        else:
+            if not args.snapshot:
+                print_error("IXFR needs --snapshot FILE holding the zone to update")
+                return 0
+            try:
+                snapshot = ZoneSnapshot.from_file(args.snapshot, args.name)
+            except FileNotFoundError:
+                snapshot = ZoneSnapshot(args.name)  # no earlier copy: the first IXFR asks for serial 0
+            transfer = ZoneTransfer(args.server, args.name, args.p, args.t, serial=snapshot.serial or 0,
+                                    soa=snapshot.soa)
+            snapshot.update(transfer)
+            if not transfer.up_to_date:
+                snapshot.save(args.snapshot)
+    except (DNSClientException, OSError) as e:
+        print_error(e)
+        return 0
+    print("{} of {} at serial {}: {} records in {} messages, {} bytes, {:.3f} seconds{}".format(
+        args.transfer.upper(), args.name, transfer.soa.RDATA.DATA.SERIAL, transfer.records, transfer.messages,
+        transfer.bytes, transfer.elapsed, ", up to date" if transfer.up_to_date else
+        ", incremental" if transfer.incremental else ""), file=sys.stderr)
+    return 1
@@ -0,0 +1,126 @@
+import unittest
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import dnsTransfer
+from dnsClient import DNSRefusedException
+from dnsTransfer import ZoneTransfer, ZoneSnapshot, record_key
+from dnsTestServer import DNSTestServer, synthetic_zone
+
+ZONE = "synthetic.example"
+
+
+class TestZoneTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = DNSTestServer(synthetic_zone(3000), transfer_records=50).start()
+        self.addCleanup(self.server.stop)
+
+    def transfer(self, serial=None, soa=None):
+        return ZoneTransfer("127.0.0.1", ZONE, self.server.port, timeout=2, serial=serial, soa=soa)
+
+    def full_zone(self):
+        return {record_key(record) for _, record in self.transfer()}
+
+    def test_axfr_yields_records_as_each_message_arrives(self):
+        transfer = self.transfer()
+        records = iter(transfer)
+        operation, soa = next(records)
+        self.assertEqual((operation, soa.TYPE, soa.RDATA.DATA.SERIAL), ("add", 6, 1))
+        self.assertEqual(transfer.messages, 1)     # nothing past the first message has been read yet
+        rest = list(records)
+        self.assertEqual(transfer.records, 1 + 2 + 3000)
+        self.assertEqual(len(rest), 2 + 3000)
+        self.assertEqual(transfer.messages, 61)    # 3005 records with both SOA copies, 50 per message
+        self.assertEqual({operation for operation, _ in rest}, {"add"})
+        self.assertEqual(rest[-1][1].NAME, "host2999.synthetic.example")
+
+    def test_ixfr_applies_only_the_changes(self):
+        snapshot = ZoneSnapshot(ZONE)
+        axfr = self.transfer()
+        snapshot.update(axfr)
+        self.server.zone.update(added=["new.synthetic.example. 300 A 10.9.9.9"],
+                                deleted=["host7.synthetic.example. 300 A 10.0.0.7"])
+        self.server.zone.update(added=['new.synthetic.example. 300 TXT "fresh record"'],
+                                deleted=["host8.synthetic.example. 300 A 10.0.0.8"])
+
+        ixfr = self.transfer(snapshot.serial, snapshot.soa)
+        self.assertEqual(snapshot.update(ixfr), 4)
+        self.assertTrue(ixfr.incremental)
+        self.assertEqual((ixfr.messages, snapshot.serial), (1, 3))
+        self.assertLess(ixfr.bytes * 50, axfr.bytes)
+        self.assertEqual({record_key(record) for record in snapshot}, self.full_zone())
+
+        up_to_date = self.transfer(snapshot.serial)
+        self.assertEqual(snapshot.update(up_to_date), 0)
+        self.assertTrue(up_to_date.up_to_date)
+
+    def test_ixfr_from_an_unknown_serial_gets_the_whole_zone(self):
+        snapshot = ZoneSnapshot(ZONE)
+        snapshot.add(dnsTransfer.parse_record("stale.synthetic.example. 300 A 10.1.1.1"))
+        self.server.zone.update(added=["new.synthetic.example. 300 A 10.9.9.9"])
+        transfer = self.transfer(serial=0)
+        snapshot.update(transfer)
+        self.assertFalse(transfer.incremental)
+        self.assertEqual((len(snapshot), snapshot.serial), (3004, 2))
+        self.assertEqual({record_key(record) for record in snapshot}, self.full_zone())
+
+    def test_zone_not_served_is_refused(self):
+        with self.assertRaises(DNSRefusedException):
+            list(ZoneTransfer("127.0.0.1", "example.org", self.server.port, timeout=2))
+
+    def test_main_keeps_a_snapshot_up_to_date(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "zone.txt")
+        args = argparse.Namespace(server="@127.0.0.1", name=ZONE, p=self.server.port, t=2, transfer="axfr",
+                                  snapshot=path)
+        with contextlib.redirect_stderr(io.StringIO()) as summary:
+            self.assertEqual(dnsTransfer.main(args), 1)
+            self.server.zone.update(added=['txt.synthetic.example. 60 TXT "a; b" "c"',
+                                           "synthetic.example. 300 MX 10 mail.synthetic.example."])
+            args.transfer = "ixfr"
+            self.assertEqual(dnsTransfer.main(args), 1)
+        self.assertIn("2 records in 1 messages", summary.getvalue())
+        self.assertIn("incremental", summary.getvalue())
+
+        snapshot = ZoneSnapshot.from_file(path, ZONE)
+        self.assertEqual(snapshot.serial, 2)
+        self.assertEqual({record_key(record) for record in snapshot}, self.full_zone())
+
+    def test_transfer_dropped_midway_leaves_the_snapshot_untouched(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "zone.txt")
+        args = argparse.Namespace(server="@127.0.0.1", name=ZONE, p=self.server.port, t=2, transfer="axfr",
+                                  snapshot=path)
+        with contextlib.redirect_stderr(io.StringIO()) as summary, contextlib.redirect_stdout(io.StringIO()):
+            self.server.transfer_cutoff = 10
+            self.assertEqual(dnsTransfer.main(args), 0)
+            self.assertEqual(os.listdir(directory.name), [])     # no partial first copy either
+
+            self.server.transfer_cutoff = None
+            self.assertEqual(dnsTransfer.main(args), 1)
+            with open(path) as snapshot_file:
+                saved = snapshot_file.read()
+            self.server.zone.update(added=["new.synthetic.example. 300 A 10.9.9.9"])
+            self.server.transfer_cutoff = 10
+            self.assertEqual(dnsTransfer.main(args), 0)
+            self.assertEqual(os.listdir(directory.name), ["zone.txt"])
+            with open(path) as snapshot_file:
+                self.assertEqual(snapshot_file.read(), saved)
+
+            # the snapshot still holds serial 1, so the next IXFR fetches the change rather than finding it current
+            args.transfer = "ixfr"
+            self.assertEqual(dnsTransfer.main(args), 1)
+        self.server.transfer_cutoff = None
+        self.assertIn("incremental", summary.getvalue())
+        snapshot = ZoneSnapshot.from_file(path, ZONE)
+        self.assertEqual(snapshot.serial, 2)
+        self.assertEqual({record_key(record) for record in snapshot}, self.full_zone())
+
+
+if __name__ == '__main__':
+    unittest.main()